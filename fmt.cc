@@ -4,18 +4,25 @@
 // Software License, Version 1.0.  See the file LICENSE or
 // http://www.boost.org/LICENSE_1_0.txt for detailed terms.
 
+#ifndef CXXFMT_FMT_CC__
+#define CXXFMT_FMT_CC__
+
 #include <cassert>  // must be first
 
-#include <fmt.h>
+#include "fmt.h"
 
 #include <cerrno>
-#include <cstdlib>  // free, strtoul
-#include <cstring>  // strerror
+#include <cstdlib>  // free
+#include <cstring>  // strcspn, strerror
 
 #include <limits>
-#include <numeric>
-#include <sstream>
+#include <memory>
+#include <mutex>
+#include <ostream>
+#include <streambuf>
 #include <stdexcept>
+#include <unordered_map>
+#include <utility>
 
 // We assume <cxxabi.h> is available, and contains both
 // abi::__cxa_current_exception_type and abi::__cxa_demangle, if the
@@ -26,6 +33,29 @@
   #include <cxxabi.h>
 #endif
 
+// Catalogs are read with mmap where it is available.  Not in
+// header-only mode, though, where the POSIX headers would be included
+// by every file that includes fmt.h, and fill the global namespace.
+#if (defined __unix__ || defined __APPLE__) && !defined CXXFMT_HEADER_ONLY
+  #define HAVE_MMAP
+  #include <fcntl.h>
+  #include <sys/mman.h>
+  #include <sys/stat.h>
+  #include <unistd.h>
+#else
+  #include <cstdio>
+#endif
+
+// GCC before 4.8 has no thread_local, only __thread, which is enough
+// for a plain integer (and which Clang accepts as well).
+#ifdef __GNUC__
+  #define CXXFMT_THREAD_LOCAL __thread
+#else
+  #define CXXFMT_THREAD_LOCAL thread_local
+#endif
+
+namespace fmt {
+
 using std::conditional;
 using std::enable_if;
 using std::exception;
@@ -37,7 +67,7 @@ using std::make_unsigned;
 using std::string;
 using std::terminate;
 
-namespace {
+namespace detail {
 
 // We must avoid writing a direct cast from void * to an integer of a
 // different size.  We don't know what size a pointer is, we cannot
@@ -114,9 +144,7 @@ struct unsigned_if_integral<T, typename enable_if<is_integral<T>::value>::type>
   typedef typename make_unsigned<T>::type type;
 };
 
-} // anonymous namespace
-
-namespace fmt {
+} // namespace detail
 
 // Error conditions in the formatter are, in general, reported by
 // emitting some sort of placeholder, surrounded by VT-220 reverse
@@ -125,6 +153,17 @@ namespace fmt {
 
 #define BEGIN_ERRMSG "\033[7m"
 #define END_ERRMSG "\033[27m"
+#define OUT_OF_MEMORY BEGIN_ERRMSG "[out of memory]" END_ERRMSG
+
+// Helper functions local to this file.  In header-only mode (see
+// fmt.h) they are inline instead of static, so that the inline
+// functions which call them have the same definition in every
+// translation unit.
+#ifdef CXXFMT_HEADER_ONLY
+#define CXXFMT_LOCAL inline
+#else
+#define CXXFMT_LOCAL static
+#endif
 
 // The exposed interface guarantees not to throw exceptions under any
 // circumstances, which means we have to intercept all exceptions and
@@ -142,6 +181,77 @@ namespace fmt {
 // exception.  The general approach is borrowed from boost::exception,
 // with additional cleverness from Monotone.
 
+namespace detail {
+
+// The number of times memory has run out on this thread, whether
+// that was reported by bad_alloc or, in exception-free mode, by
+// falling back on the emergency reserve.  See formatter::ok().
+CXXFMT_LOCAL unsigned long &
+allocation_failures() noexcept
+{
+  static CXXFMT_THREAD_LOCAL unsigned long count = 0;
+  return count;
+}
+
+// The emergency reserve (see fmt.h).  Blocks are carved off the
+// front in turn, and the whole reserve is free again once every
+// block has been given back.  The number of blocks outstanding and
+// the bytes used are kept in one word, so that both are updated at
+// once.
+struct emergency_reserve
+{
+  static const size_t size = 65536;
+  std::aligned_storage<size>::type buf;
+  std::atomic<unsigned long long> state;  // blocks << 32 | bytes used
+};
+
+CXXFMT_LOCAL emergency_reserve &
+the_reserve() noexcept
+{
+  static emergency_reserve r;
+  return r;
+}
+
+CXXFMT_FUNC void *
+reserve_allocate(size_t bytes, size_t align) noexcept
+{
+  emergency_reserve &r = the_reserve();
+  unsigned long long s = r.state.load(std::memory_order_relaxed);
+  size_t start;
+  do {
+    start = (size_t(s & 0xffffffff) + align - 1) & ~(align - 1);
+    if (align > alignof(decltype(r.buf)) || start > r.size
+        || bytes > r.size - start)
+      terminate();  // nothing else can be done
+  } while (!r.state.compare_exchange_weak(
+             s, ((s >> 32) + 1) << 32 | (start + bytes),
+             std::memory_order_acq_rel, std::memory_order_relaxed));
+
+  allocation_failures()++;
+  return reinterpret_cast<char *>(&r.buf) + start;
+}
+
+CXXFMT_FUNC bool
+reserve_deallocate(void *p) noexcept
+{
+  emergency_reserve &r = the_reserve();
+  uintptrt base = reinterpret_cast<uintptrt>(&r.buf);
+  uintptrt q = reinterpret_cast<uintptrt>(p);
+  if (q < base || q - base >= r.size)
+    return false;
+
+  unsigned long long s = r.state.load(std::memory_order_relaxed);
+  unsigned long long blocks;
+  do {
+    blocks = (s >> 32) - 1;
+  } while (!r.state.compare_exchange_weak(
+             s, blocks ? blocks << 32 | (s & 0xffffffff) : 0,
+             std::memory_order_acq_rel, std::memory_order_relaxed));
+  return true;
+}
+
+} // namespace detail
+
 template <size_t N>
 inline bool triml(string& s, const char (&leader)[N])
 {
@@ -153,7 +263,7 @@ inline bool triml(string& s, const char (&leader)[N])
   }
 }
 
-static void
+CXXFMT_LOCAL void
 trim_typename(string& tname)
 {
   // We might have a mangled name here, so make a crude attempt to
@@ -170,13 +280,14 @@ trim_typename(string& tname)
   }
 }
 
-string
+CXXFMT_FUNC string
 formatter::diagnose_current_exception()
 {
   string message(BEGIN_ERRMSG "[");
   string what;
   string type;
 
+#ifndef CXXFMT_NO_EXCEPTIONS
   // this looks silly but is the most portable way to determine
   // whether the current exception is in fact a std::exception object.
   try {
@@ -210,6 +321,7 @@ formatter::diagnose_current_exception()
       type = tname;
 #endif
   }
+#endif
 
   trim_typename(type);
   trim_typename(what);
@@ -221,8 +333,10 @@ formatter::diagnose_current_exception()
     what.clear();
     if (type == "exception")
       type = "generic exception";
-    else if (type == "bad_alloc")
+    else if (type == "bad_alloc") {
       type = "out of memory";
+      detail::allocation_failures()++;
+    }
   } else if (what.empty()) {
     what = type;
     type = "unusual exception type";
@@ -237,6 +351,23 @@ formatter::diagnose_current_exception()
   return message;
 }
 
+// Parse the run of decimal digits at 'p', which the caller has
+// checked begins with at least one digit, into 'val', and return a
+// pointer past it.  This is used instead of strtoul, which would also
+// accept leading whitespace and a sign, and may consult the locale.
+// Like strtoul, it saturates at ULONG_MAX.  It stops at 'end'.
+CXXFMT_LOCAL const char *
+parse_digits(const char *p, const char *end, unsigned long &val)
+{
+  const unsigned long max = std::numeric_limits<unsigned long>::max();
+  val = 0;
+  for (; p < end && *p >= '0' && *p <= '9'; p++) {
+    unsigned long d = *p - '0';
+    val = (val > (max - d) / 10) ? max : val * 10 + d;
+  }
+  return p;
+}
+
 // Parse a substitution.
 // The simplified grammar we accept is
 //
@@ -247,45 +378,62 @@ formatter::diagnose_current_exception()
 // align: ( '<' | '>' | '=' )
 // sign:  ( '+' | '-' | ' ' )
 // type:  ( 's' | 'c' | 'd' | 'o' | 'x' | 'X' |
-//          'e' | 'E' | 'f' | 'F' | 'g' | 'G' )
+//          'e' | 'E' | 'f' | 'F' | 'g' | 'G' | 'j' )
 //
 // index, width, precision: [0-9]+
 //
 // Expects to be called with 'p' pointing one past the initial '{'.
 // Expects caller to have dealt with doubled {.
 // Expects caller to have initialized 'spec'.
+// Never reads at or past 'end', which is treated as if it were a NUL.
 // Returns an updated 'p' pointing one past the final '}'.
 // If 'spec' has index zero on exit, the spec was ill-formed.
 
-static const char *
-parse_subst(const char *p, size_t default_index, format_spec& spec)
+CXXFMT_LOCAL const char *
+parse_subst(const char *p, const char *end, size_t default_index,
+            format_spec& spec)
 {
-  using std::strtoul;
-
-  spec.arg_index = default_index;
+  // The character at 'q', or NUL at the end of the string.
+  auto at = [end](const char *q) { return q < end ? *q : '\0'; };
+  char c;
+
+  // An index too large for format_spec::index can never name an
+  // actual argument, so clamping it to i_max still produces [missing].
+  // (parse_digits saturates, so a saturated value stays invalid.)
+  if (default_index <= format_spec::i_max)
+    spec.arg_index = default_index;
+  else
+    spec.arg_index = format_spec::i_max;
 
-  char *endp;
-  if (*p >= '0' && *p <= '9') {
-    spec.arg_index = strtoul(p, &endp, 10);
-    assert(endp > p);
-    p = endp;
-  } else if (*p == 'm') {
+  unsigned long val;
+  c = at(p);
+  if (c >= '0' && c <= '9') {
+    p = parse_digits(p, end, val);
+    if (val == std::numeric_limits<unsigned long>::max())
+      goto error;
+    else if (val <= format_spec::i_max)
+      spec.arg_index = val;
+    else
+      spec.arg_index = format_spec::i_max;
+  } else if (c == 'm') {
     spec.arg_index = format_spec::i_errno;
     p++;
   }
 
-  if (*p == '}') {
+  c = at(p);
+  if (c == '}') {
     p++;
     return p;
   }
 
-  if (*p != ':')
+  if (c != ':')
     goto error;
   p++;
 
-  if (*p == '{' || *p == '\0')
+  c = at(p);
+  if (c == '{' || c == '\0')
     goto error;
-  if (*p == '}') { // {:}
+  if (c == '}') { // {:}
     p++;
     return p;
   }
@@ -303,7 +451,7 @@ parse_subst(const char *p, size_t default_index, format_spec& spec)
   // defaults to a space character.
 
   // at this point we know that p[0] is not NUL, but p[1] still might be.
-  if (p[1] == '\0')
+  if (at(p+1) == '\0')
     goto error;
   if (p[1] == '<' || p[1] == '>' || p[1] == '=' || p[1] == '^') {
     spec.align = p[1];
@@ -317,15 +465,16 @@ parse_subst(const char *p, size_t default_index, format_spec& spec)
 
   // Unlike printf, the sign, alternate-form, and zero-fill modifiers
   // may _not_ appear in any order.
-  if (*p == '+' || *p == '-' || *p == ' ') {
-    spec.sign = *p;
-    p++;
+  c = at(p);
+  if (c == '+' || c == '-' || c == ' ') {
+    spec.sign = c;
+    c = at(++p);
   }
-  if (*p == '#') {
+  if (c == '#') {
     spec.alternate_form = true;
-    p++;
+    c = at(++p);
   }
-  if (*p == '0') {
+  if (c == '0') {
     // Python documents '0' right before the width as shorthand for an
     // '0=' alignment modifier.  If you have both '0' and a
     // conflicting alignment modifier, Python's actual behavior is not
@@ -335,33 +484,35 @@ parse_subst(const char *p, size_t default_index, format_spec& spec)
       goto error;
     spec.align = '=';
     spec.fill = '0';
-    p++;
+    c = at(++p);
   }
 
-  if (*p >= '0' && *p <= '9') {
+  if (c >= '0' && c <= '9') {
     spec.has_width = true;
-    spec.width = strtoul(p, &endp, 10);
-    assert(endp > p);
-    p = endp;
+    p = parse_digits(p, end, val);
+    spec.width = val;
+    c = at(p);
   }
 
-  if (*p == '.') {
-    p++;
+  if (c == '.') {
+    c = at(++p);
+    if (!(c >= '0' && c <= '9'))
+      goto error; // no number present after '.'
     spec.has_precision = true;
-    spec.precision = strtoul(p, &endp, 10);
-    if (endp == p) goto error; // no number present after '.'
-    p = endp;
+    p = parse_digits(p, end, val);
+    spec.precision = val;
+    c = at(p);
   }
 
-  if (*p == 's' || *p == 'c' ||
-      *p == 'd' || *p == 'o' || *p == 'x' || *p == 'X' ||
-      *p == 'e' || *p == 'E' || *p == 'f' || *p == 'F' ||
-      *p == 'g' || *p == 'G') {
-    spec.type = *p;
-    p++;
+  if (c == 's' || c == 'c' ||
+      c == 'd' || c == 'o' || c == 'x' || c == 'X' ||
+      c == 'e' || c == 'E' || c == 'f' || c == 'F' ||
+      c == 'g' || c == 'G' || c == 'j') {
+    spec.type = c;
+    c = at(++p);
   }
 
-  if (*p == '}') {
+  if (c == '}') {
     p++;
     return p;
   }
@@ -370,11 +521,8 @@ parse_subst(const char *p, size_t default_index, format_spec& spec)
   spec.reset();
   // find the next matching close brace or the end of the string
   unsigned int depth = 1;
-  for (;;) {
-    char c = *p;
-    if (*p == '\0')
-      break;
-    p++;
+  while (p < end) {
+    c = *p++;
     if (c == '{')
       depth++;
     if (c == '}') {
@@ -386,42 +534,77 @@ parse_subst(const char *p, size_t default_index, format_spec& spec)
   return p;
 }
 
+// The first 'c' in [p, end), or 'end' if there is none.
+CXXFMT_LOCAL const char *
+find_char(const char *p, const char *end, char c)
+{
+  const void *q = std::memchr(p, c, end - p);
+  return q ? static_cast<const char *>(q) : end;
+}
+
 // Parse a format string.  Python is picky about close curly braces
 // being doubled even if there is no possibility of ambiguity, so we
 // follow suit.  Python throws exceptions on ill-formed strings; in
 // the service of never throwing exceptions from this code, we
-// just reverse-video the offending construct and continue.
-
-void
-formatter::parse_format_string(const char *str)
+// just reverse-video the offending construct and continue.  The
+// number of offending constructs is returned.  If 'open_ended' is
+// true, the arguments are taken to be as many as the string refers
+// to, up to pattern::max_args, and 'nargs' is set accordingly.
+
+CXXFMT_FUNC size_t
+formatter::parse_format_string(const char *str, const char *end,
+                               bool open_ended)
 {
+  size_t errors = 0;
   segs.reserve(nargs * 2 + 1);
   specs.resize(nargs);
 
-  string cseg;
+  pmr_string cseg(segs.get_allocator());
   size_t default_index = 0;
-  std::vector<format_spec> extras; // Used only if there is more than one spec
-                                   // referring to the same argument index.
+  // Used only if there is more than one spec referring to the same
+  // argument index.
+  std::vector<format_spec, polymorphic_allocator<format_spec>>
+    extras(specs.get_allocator());
+
+  // The next '{' and '}' at or after the last place they were looked
+  // for (see below).
+  const char *open = find_char(str, end, '{');
+  const char *close = find_char(str, end, '}');
 
-  for (const char *p = str; *p; ) {
+  for (const char *p = str; p < end; ) {
     if (*p == '{') {
-      if (*(p+1) == '{') {
+      if (p+1 < end && *(p+1) == '{') {
         cseg.append(1, *p);
         p += 2;
       } else {
         format_spec spec;
-        const char *endp = parse_subst(p+1, default_index, spec);
+        const char *endp = parse_subst(p+1, end, default_index, spec);
         if (spec.arg_index == format_spec::i_invalid) {
           cseg.append(BEGIN_ERRMSG);
           cseg.append(p, endp - p);
           cseg.append(END_ERRMSG);
-        } else if (spec.arg_index >= specs.size() &&
+          errors++;
+        } else if (spec.arg_index >= (open_ended
+                                      ? pattern::max_args : specs.size()) &&
                    spec.arg_index != format_spec::i_errno) {
           // Spec requests conversion of an actual argument that isn't there.
           cseg.append(BEGIN_ERRMSG "[missing]" END_ERRMSG);
+          errors++;
+        } else if (segs.size() + 1 > format_spec::i_max) {
+          // Too many substitutions for format_spec::target to index.
+          cseg.append(BEGIN_ERRMSG);
+          cseg.append(p, endp - p);
+          cseg.append(END_ERRMSG);
+          errors++;
         } else {
-          segs.push_back(cseg);
-          segs.push_back(string());
+          // When parsing for a pattern, there are as many arguments
+          // as the format string refers to.
+          if (spec.arg_index >= specs.size() &&
+              spec.arg_index != format_spec::i_errno)
+            specs.resize(spec.arg_index + 1);
+
+          segs.push_back(std::move(cseg));
+          segs.emplace_back();
           cseg.clear();
 
           spec.target = segs.size() - 1;
@@ -439,19 +622,31 @@ formatter::parse_format_string(const char *str)
         p = endp;
       }
     } else if (*p == '}') {
-      if (*(p+1) == '}') {
+      if (p+1 < end && *(p+1) == '}') {
         cseg.append(1, *p);
         p += 2;
       } else {
         cseg.append(BEGIN_ERRMSG "}" END_ERRMSG);
+        errors++;
         p++;
       }
     } else {
-      cseg.append(1, *p);
-      p++;
+      // Copy the whole run of literal text up to the next brace (or
+      // the end of the string) at once.  memchr is much faster than
+      // looking at each character in turn, and each brace is only
+      // looked for again once 'p' has passed the last one found.
+      if (open < p)
+        open = find_char(p, end, '{');
+      if (close < p)
+        close = find_char(p, end, '}');
+      const char *q = open < close ? open : close;
+      cseg.append(p, q - p);
+      p = q;
     }
   }
-  segs.push_back(cseg);
+  segs.push_back(std::move(cseg));
+  if (open_ended)
+    nargs = specs.size();
 
   // This is quadratic in chain length, but chains of more than one or
   // two elements are unlikely to happen, so let's not worry about it
@@ -469,55 +664,123 @@ formatter::parse_format_string(const char *str)
       other->next_this_index = sind;
     }
   }
+  return errors;
+}
+
+// Make room in 'str' for 'n' more characters, growing it
+// geometrically if it must grow at all.  reserve() itself cannot be
+// trusted to do either: libstdc++ before GCC 11 shrinks the string to
+// fit whenever the request differs from the current capacity, and
+// libc++ grows it only to the size requested.
+template <typename Str>
+CXXFMT_LOCAL void
+make_room(Str &str, size_t n)
+{
+  size_t cap = str.capacity();
+  if (cap - str.size() < n)
+    str.reserve(str.size() + n > 2 * cap ? str.size() + n : 2 * cap);
 }
 
 //
 // Per-actual-type formatting subroutines.
 //
 
-static void
-do_alignment(const string &s, const format_spec &spec,
-             char type, bool error, string &out)
+// Where the text of a substitution goes: normally, appended to its
+// segment, but when only measuring (see formatted_size), it is just
+// counted, and need not actually be produced.
+class sub_out
 {
+  pmr_string *str;
+  size_t count;
+
+public:
+  explicit sub_out(pmr_string *str_) : str(str_), count(0) {}
+
+  bool counting() const { return !str; }
+  size_t counted() const { return count; }
+
+  // The allocator for any temporary storage the substitution needs.
+  polymorphic_allocator<char> get_allocator() const
+  {
+    return str ? str->get_allocator() : polymorphic_allocator<char>();
+  }
+
+  void append(const char *s, size_t n)
+  {
+    if (str)
+      str->append(s, n);
+    else
+      count += n;
+  }
+  void append(size_t n, char c)
+  {
+    if (str)
+      str->append(n, c);
+    else
+      count += n;
+  }
+  void append(const char *s) { append(s, std::strlen(s)); }
+
+  void reserve(size_t n)
+  {
+    if (str)
+      make_room(*str, n);
+  }
+};
+
+CXXFMT_LOCAL void
+do_alignment(const char *s, size_t len, const format_spec &spec,
+             char type, bool error, sub_out &out)
+{
+  // The whole substitution is appended in up to five pieces, so make
+  // room for all of it at once.
+  out.reserve((spec.has_width && spec.width > len ? spec.width : len)
+              + (error ? sizeof BEGIN_ERRMSG + sizeof END_ERRMSG - 2 : 0));
+
   if (error)
     out.append(BEGIN_ERRMSG);
 
   // is alignment actually required?
-  if (!spec.has_width || spec.width <= s.size())
-    out.append(s);
+  if (!spec.has_width || spec.width <= len)
+    out.append(s, len);
   else {
-    size_t pad = spec.width - s.size();
+    size_t pad = spec.width - len;
     char align = spec.align;
 
     if (align == '\0')
       align = (type == 's') ? '<' : '>';
 
     if (align == '<') {
-      out.append(s);
+      out.append(s, len);
       out.append(pad, spec.fill);
 
     } else if (align == '>') {
       out.append(pad, spec.fill);
-      out.append(s);
+      out.append(s, len);
 
     } else if (align == '^') {
       // If there are an odd number of padding characters required,
       // put one more on the right.
       out.append(pad/2, spec.fill);
-      out.append(s);
+      out.append(s, len);
       out.append(pad/2 + pad%2, spec.fill);
 
     } else {
       assert(align == '=');
-      unsigned int leading = 0;
-      if (type != 's' && type != 'c' && (s[0] == '-' || spec.sign != '-'))
-        leading = 1;
-      if (spec.alternate_form && (type == 'o' || type == 'x' || type == 'X'))
-        leading += 2;
+      // When only counting, 's' may be null, and it doesn't matter
+      // where the padding goes.
+      size_t leading = 0;
+      if (!out.counting()) {
+        if (type != 's' && type != 'c' && (s[0] == '-' || spec.sign != '-'))
+          leading = 1;
+        if (spec.alternate_form
+            && (type == 'o' || type == 'x' || type == 'X'))
+          leading += 2;
+      }
 
-      out.append(s.substr(0, leading));
+      out.append(s, leading);
       out.append(pad, spec.fill);
-      out.append(s.substr(leading));
+      out.append(s + leading, len - leading);
     }
   }
 
@@ -525,19 +788,118 @@ do_alignment(const string &s, const format_spec &spec,
     out.append(END_ERRMSG);
 }
 
-// The heavy lifting on numeric formatting is done by a stringstream.
+// When only counting, the length of an integer can be worked out
+// without formatting it: the sign, the base prefix, and the digits,
+// as do_numeric_format would produce them.  Floating-point numbers
+// are too complicated for that, so they are formatted regardless.
+
+template <typename T>
+CXXFMT_LOCAL bool
+count_numeric(T val, const format_spec &spec, char type, bool error,
+              sub_out &out, typename enable_if<is_integral<T>::value>::type* = 0)
+{
+  typename make_unsigned<T>::type uval = val;
+  size_t len = 0;
+  if (detail::is_negative(val)) {
+    uval = 0 - uval;
+    len++;
+  } else if (spec.sign != '-')
+    len++;
+
+  unsigned int base = 10;
+  if (type == 'o')
+    base = 8;
+  else if (type == 'x' || type == 'X')
+    base = 16;
+  if (spec.alternate_form && base != 10)
+    len += 2;
+
+  do {
+    len++;
+    uval /= base;
+  } while (uval);
+
+  do_alignment(0, len, spec, type, error, out);
+  return true;
+}
+
+template <typename T>
+CXXFMT_LOCAL bool
+count_numeric(T, const format_spec &, char, bool, sub_out &,
+              typename enable_if<!is_integral<T>::value>::type* = 0)
+{
+  return false;
+}
+
+// A stream buffer which collects what is written to it in a small
+// array, so that a number can be converted without allocating; in
+// the rare case that the output does not fit (a floating-point number
+// with a large precision, say), it is moved to a string which uses
+// the same allocator as the substitution's output.
+class num_buf : public std::streambuf
+{
+  char small[64];
+  pmr_string big;
+
+  // Move the output so far to 'big', and send everything after it
+  // there too (by leaving no room in the put area).
+  void spill()
+  {
+    big.assign(small, pptr() - small);
+    setp(0, 0);
+  }
+
+protected:
+  int_type overflow(int_type c)
+  {
+    if (pbase() == small)
+      spill();
+    if (!traits_type::eq_int_type(c, traits_type::eof()))
+      big.push_back(traits_type::to_char_type(c));
+    return traits_type::not_eof(c);
+  }
+
+  std::streamsize xsputn(const char *s, std::streamsize n)
+  {
+    if (epptr() - pptr() >= n) {
+      std::memcpy(pptr(), s, n);
+      pbump(int(n));
+      return n;
+    }
+    if (pbase() == small)
+      spill();
+    big.append(s, n);
+    return n;
+  }
+
+public:
+  explicit num_buf(const polymorphic_allocator<char> &alloc) : big(alloc)
+  {
+    setp(small, small + sizeof small);
+  }
+
+  const char *data() const { return pbase() == small ? small : big.data(); }
+  size_t size() const
+  { return pbase() == small ? size_t(pptr() - small) : big.size(); }
+};
+
+// The heavy lifting on numeric formatting is done by an ostream.
 // However, the iostreams feature set is inadequate to handle all of
 // Python's alignment, explicit sign, and explicit base features, so
 // we do that part by hand.
 
 template <typename T>
-static void
+CXXFMT_LOCAL void
 do_numeric_format(T val, const format_spec &spec,
-                  char type, bool error, string &out)
+                  char type, bool error, sub_out &out)
 {
   using std::ios;
 
-  std::ostringstream os;
+  if (out.counting() && count_numeric(val, spec, type, error, out))
+    return;
+
+  num_buf buf(out.get_allocator());
+  std::ostream os(&buf);
   os.exceptions(ios::failbit|ios::badbit|ios::eofbit);
 
   // iostreams can mark positive values with '+' but not with a space,
@@ -549,8 +911,8 @@ do_numeric_format(T val, const format_spec &spec,
   // signed integral type correctly, we need to assign to an unsigned
   // type after taking the absolute value, because of the asymmetric
   // range of such types.  this is not an issue for floating point.
-  typename unsigned_if_integral<T>::type uval;
-  if (is_negative(val)) {
+  typename detail::unsigned_if_integral<T>::type uval;
+  if (detail::is_negative(val)) {
     uval = -val;
     os << '-';
   } else {
@@ -597,13 +959,13 @@ do_numeric_format(T val, const format_spec &spec,
 
   os << uval;
 
-  do_alignment(os.str(), spec, type, error, out);
+  do_alignment(buf.data(), buf.size(), spec, type, error, out);
 }
 
-static void
+CXXFMT_LOCAL void
 do_format_unsigned_int(unsigned long long val,
                        const format_spec &spec,
-                       string &out)
+                       sub_out &out)
 {
   switch (spec.type) {
   case 'u':
@@ -626,10 +988,10 @@ do_format_unsigned_int(unsigned long long val,
   }
 }
 
-static void
+CXXFMT_LOCAL void
 do_format_signed_int(long long val,
                      const format_spec &spec,
-                     string &out)
+                     sub_out &out)
 {
   switch (spec.type) {
   case 'u':
@@ -652,10 +1014,10 @@ do_format_signed_int(long long val,
   }
 }
 
-static void
+CXXFMT_LOCAL void
 do_format_float(double val,
                 const format_spec &spec,
-                string &out)
+                sub_out &out)
 {
   switch (spec.type) {
   case 'e': case 'E':
@@ -671,12 +1033,12 @@ do_format_float(double val,
   case 'X': {
     union {
       double d;
-      uintdoublet i;
+      detail::uintdoublet i;
     } u;
     u.d = val;
     // Cast to 'unsigned long long' after extraction, so the compiler
     // won't instantiate another version of do_numeric_format
-    // if uintdoublet is a different type.
+    // if detail::uintdoublet is a different type.
     do_numeric_format((unsigned long long)(u.i), spec, spec.type, false, out);
   } return;
 
@@ -688,71 +1050,263 @@ do_format_float(double val,
 
 // This takes unsigned long long instead of the actual character so it
 // can do something sensible on overflow.
-static void
+CXXFMT_LOCAL void
 do_format_char(unsigned long long val,
                const format_spec &spec,
-               string &out)
+               sub_out &out)
 {
   if ((spec.type == 'c' || spec.type == 's')
       && val <= std::numeric_limits<unsigned char>::max()) {
     // Most modifiers are ignored; just emit the character with
     // appropriate padding.  If the precision is zero, print the
     // empty string.
+    char c = val;
     if (spec.has_precision && spec.precision == 0)
-      do_alignment(string(), spec, spec.type, false, out);
+      do_alignment(&c, 0, spec, spec.type, false, out);
     else
-      do_alignment(string(1, val), spec, spec.type, false, out);
+      do_alignment(&c, 1, spec, spec.type, false, out);
   } else
     // format as unsigned decimal, with error markers.
     do_numeric_format(val, spec, 'u', true, out);
 }
 
-static void
+// The 'j' type writes a string escaped for use within a JSON string
+// literal, as it is copied: '"' and '\\' are escaped with a
+// backslash, control characters are written as escapes, and each
+// maximal invalid UTF-8 subsequence is replaced with \ufffd.  Valid
+// UTF-8 (and DEL) is copied as is.
+
+// The length of the initial run of 'len' bytes at 's' which can be
+// copied without escaping.  Eight bytes are checked at a time: a byte
+// of 'w' needs attention if it is below 0x20, is '"' or '\\', or has
+// its high bit set, and then (counting from the least significant
+// end) the first such byte sets its own high bit in 'x'.  Borrows
+// only affect bytes after it, so the test is exact.
+CXXFMT_LOCAL size_t
+json_clean_prefix(const char *s, size_t len)
+{
+  typedef unsigned long long word;
+  const word ones = ~word(0) / 0xff;
+  size_t i = 0;
+  for (; i + sizeof(word) <= len; i += sizeof(word)) {
+    word w;
+    std::memcpy(&w, s + i, sizeof w);
+    word x = (w - ones * 0x20)
+           | ((w ^ (ones * '"')) - ones)
+           | ((w ^ (ones * '\\')) - ones)
+           | w;
+    if (x & (ones * 0x80))
+      break;
+  }
+  for (; i < len; i++) {
+    unsigned char c = s[i];
+    if (c < 0x20 || c >= 0x80 || c == '"' || c == '\\')
+      break;
+  }
+  return i;
+}
+
+// The length of the UTF-8 sequence starting with the byte at 'p',
+// which is at least 0x80.  If the sequence is invalid, 'valid' is
+// set false and the length of its maximal valid prefix (at least 1)
+// is returned.
+CXXFMT_LOCAL size_t
+utf8_sequence(const unsigned char *p, const unsigned char *end, bool &valid)
+{
+  unsigned char c = *p;
+  unsigned char lo = 0x80, hi = 0xbf;  // range of the second byte
+  size_t n;
+  if (c >= 0xc2 && c <= 0xdf)
+    n = 2;
+  else if (c >= 0xe0 && c <= 0xef) {
+    n = 3;
+    if (c == 0xe0)
+      lo = 0xa0;  // overlong
+    else if (c == 0xed)
+      hi = 0x9f;  // surrogate
+  } else if (c >= 0xf0 && c <= 0xf4) {
+    n = 4;
+    if (c == 0xf0)
+      lo = 0x90;  // overlong
+    else if (c == 0xf4)
+      hi = 0x8f;  // above U+10FFFF
+  } else {
+    valid = false;
+    return 1;
+  }
+
+  size_t i = 1;
+  for (; i < n && p + i < end; i++) {
+    if (p[i] < lo || p[i] > hi)
+      break;
+    lo = 0x80;
+    hi = 0xbf;
+  }
+  valid = (i == n);
+  return i;
+}
+
+// Append 's' to 'out', escaped; the first 'clean' bytes are known
+// not to need it.
+CXXFMT_LOCAL void
+json_escape(const char *s, size_t len, size_t clean, sub_out &out)
+{
+  const char *end = s + len;
+  const char *run = s;         // start of the bytes not yet appended
+  const char *p = s + clean;
+  while (p < end) {
+    unsigned char c = *p;
+    if (c >= 0x80) {
+      bool valid;
+      size_t n = utf8_sequence(reinterpret_cast<const unsigned char *>(p),
+                               reinterpret_cast<const unsigned char *>(end),
+                               valid);
+      if (valid)
+        p += n;
+      else {
+        out.append(run, p - run);
+        out.append("\\ufffd", 6);
+        p += n;
+        run = p;
+      }
+    } else {
+      out.append(run, p - run);
+      char esc[6] = { '\\', 0, '0', '0', 0, 0 };
+      switch (c) {
+      case '"':  esc[1] = '"';  out.append(esc, 2); break;
+      case '\\': esc[1] = '\\'; out.append(esc, 2); break;
+      case '\b': esc[1] = 'b';  out.append(esc, 2); break;
+      case '\f': esc[1] = 'f';  out.append(esc, 2); break;
+      case '\n': esc[1] = 'n';  out.append(esc, 2); break;
+      case '\r': esc[1] = 'r';  out.append(esc, 2); break;
+      case '\t': esc[1] = 't';  out.append(esc, 2); break;
+      default:
+        esc[1] = 'u';
+        esc[4] = "0123456789abcdef"[c >> 4];
+        esc[5] = "0123456789abcdef"[c & 0xf];
+        out.append(esc, 6);
+        break;
+      }
+      p++;
+      run = p;
+    }
+    p += json_clean_prefix(p, end - p);
+  }
+  out.append(run, p - run);
+}
+
+CXXFMT_LOCAL void
+do_format_json(const char *s, size_t len,
+               const format_spec &spec,
+               sub_out &out)
+{
+  size_t clean = json_clean_prefix(s, len);
+  if (clean == len) {
+    do_alignment(s, len, spec, 's', false, out);
+    return;
+  }
+
+  // The escaped length, found by a dry run, lets the output grow
+  // just once, and is needed for padding.
+  sub_out counter(0);
+  json_escape(s, len, clean, counter);
+  size_t elen = counter.counted();
+  size_t pad = spec.has_width && spec.width > elen ? spec.width - elen : 0;
+  size_t left = 0;
+  if (spec.align == '>' || spec.align == '=')
+    left = pad;
+  else if (spec.align == '^')
+    left = pad/2;
+
+  if (out.counting()) {
+    out.append(elen + pad, spec.fill);
+    return;
+  }
+  out.reserve(elen + pad);
+  out.append(left, spec.fill);
+  json_escape(s, len, clean, out);
+  out.append(pad - left, spec.fill);
+}
+
+CXXFMT_LOCAL void
 do_format_str(const string &val,
               const format_spec &spec,
-              string &out)
+              sub_out &out)
 {
   // Truncate to precision, pad to width.
-  if (!spec.has_precision)
-    do_alignment(val, spec, 's', spec.type != 's', out);
+  size_t len = val.size();
+  if (spec.has_precision && spec.precision < len)
+    len = spec.precision;
+  if (spec.type == 'j')
+    do_format_json(val.data(), len, spec, out);
   else
-    do_alignment(val.substr(0, spec.precision),
-                 spec, 's', spec.type != 's', out);
+    do_alignment(val.data(), len, spec, 's', spec.type != 's', out);
 }
 
-static void
+CXXFMT_LOCAL void
 do_format_cstr(const char *val,
                const format_spec &spec,
-               string &out)
+               sub_out &out)
 {
   // Truncate to precision, pad to width.
-  // In the with-precision case, we can't just convert directly to a
-  // C++ string because the (const char *, size_t) constructor does
-  // *not* look for a nul-terminator.
+  // In the with-precision case, we can't just use strlen, because
+  // 'val' need not be nul-terminated within the precision.
   // strnlen is not sufficiently portable to use here :(
 
+  size_t slen;
   if (!spec.has_precision)
-    do_alignment(val, spec, 's', spec.type != 's', out);
+    slen = std::strlen(val);
   else {
-    size_t slen = 0;
+    slen = 0;
     for (const char *p = val; *p && slen < spec.precision; p++)
       slen++;
-
-    do_alignment(string(val, slen), spec, 's', spec.type != 's', out);
   }
+  if (spec.type == 'j')
+    do_format_json(val, slen, spec, out);
+  else
+    do_alignment(val, slen, spec, 's', spec.type != 's', out);
 }
 
-void
+CXXFMT_FUNC bool
+formatter::ok() const noexcept
+{
+  return detail::allocation_failures() == failures;
+}
+
+// In exception-free mode, once memory has run out, nothing more is
+// formatted: the result will only be an [out of memory] marker, and
+// the emergency reserve must be given back soon.
+CXXFMT_FUNC bool
+formatter::stopped() const noexcept
+{
+#ifdef CXXFMT_NO_EXCEPTIONS
+  return !ok();
+#else
+  return false;
+#endif
+}
+
+// Where the output for 'spec' should go (see sub_out).
+CXXFMT_FUNC pmr_string *
+formatter::target(const format_spec &spec)
+{
+  return measuring ? 0 : &segs.at(spec.target);
+}
+
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, unsigned char val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 's';
 
@@ -760,7 +1314,7 @@ formatter::format_sub(size_t i, unsigned char val) noexcept
       case 'c':
       case 's':
       default:
-        do_format_char(val, *spec, segs.at(spec->target));
+        do_format_char(val, *spec, out);
         break;
 
       case 'd':
@@ -768,13 +1322,14 @@ formatter::format_sub(size_t i, unsigned char val) noexcept
       case 'o':
       case 'x':
       case 'X':
-        do_format_unsigned_int(val, *spec, segs.at(spec->target));
+        do_format_unsigned_int(val, *spec, out);
         break;
       }
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -786,23 +1341,26 @@ formatter::format_sub(size_t i, unsigned char val) noexcept
   }
 }
 
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, long long val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 'd';
 
       switch (spec->type) {
       case 'c':
-        do_format_char(val, *spec, segs.at(spec->target));
+        do_format_char(val, *spec, out);
         break;
 
       case 'd':
@@ -811,13 +1369,14 @@ formatter::format_sub(size_t i, long long val) noexcept
       case 'x':
       case 'X':
       default:
-        do_format_signed_int(val, *spec, segs.at(spec->target));
+        do_format_signed_int(val, *spec, out);
         break;
       }
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -829,23 +1388,26 @@ formatter::format_sub(size_t i, long long val) noexcept
   }
 }
 
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, unsigned long long val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 'u';
 
       switch (spec->type) {
       case 'c':
-        do_format_char(val, *spec, segs.at(spec->target));
+        do_format_char(val, *spec, out);
         break;
 
       case 'd':
@@ -854,13 +1416,14 @@ formatter::format_sub(size_t i, unsigned long long val) noexcept
       case 'x':
       case 'X':
       default:
-        do_format_unsigned_int(val, *spec, segs.at(spec->target));
+        do_format_unsigned_int(val, *spec, out);
         break;
       }
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -874,17 +1437,20 @@ formatter::format_sub(size_t i, unsigned long long val) noexcept
 
 // Raw pointers are printed in lowercase hexadecimal with an
 // appropriate number of leading zeros, unless we are told otherwise.
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, const void *val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 'x';
       if (!spec->has_width) {
@@ -893,12 +1459,12 @@ formatter::format_sub(size_t i, const void *val) noexcept
         spec->fill = '0';
         spec->align = '>';
       }
-      do_format_unsigned_int(uintptrt(val), *spec,
-                             segs.at(spec->target));
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      do_format_unsigned_int(detail::uintptrt(val), *spec, out);
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -910,24 +1476,28 @@ formatter::format_sub(size_t i, const void *val) noexcept
   }
 }
 
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, double val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 'g';
-      do_format_float(val, *spec, segs.at(spec->target));
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      do_format_float(val, *spec, out);
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -939,26 +1509,30 @@ formatter::format_sub(size_t i, double val) noexcept
   }
 }
 
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, const char *val) noexcept
 {
   // only this function has to worry about errno.
-  if (i >= specs.size() && i != format_spec::i_errno)
+  if (i >= nargs && i != format_spec::i_errno)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = (i == format_spec::i_errno
                        ? &first_errno_spec : &specs[i]);
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 's';
-      do_format_cstr(val, *spec, segs.at(spec->target));
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      do_format_cstr(val, *spec, out);
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -970,25 +1544,28 @@ formatter::format_sub(size_t i, const char *val) noexcept
   }
 }
 
-void
+CXXFMT_FUNC void
 formatter::format_sub(size_t i, const string &val) noexcept
 {
-  if (i >= specs.size())
+  if (i >= nargs)
     return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
   format_spec *spec = &specs[i];
   if (spec->arg_index == format_spec::i_invalid)
     return; // argument not used
   assert(spec->arg_index == i);
   for (;;) {
-    try {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
       if (spec->type == '\0')
         spec->type = 's';
-      do_format_str(val, *spec, segs.at(spec->target));
-
-    } catch (...) {
-      try {
-        segs.at(spec->target) = diagnose_current_exception();
-      } catch (...) {
+      do_format_str(val, *spec, out);
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
         terminate();
       }
     }
@@ -1000,65 +1577,692 @@ formatter::format_sub(size_t i, const string &val) noexcept
   }
 }
 
-void
+// Substitute a [missing] marker for each use of argument 'i', which
+// a pattern refers to but the caller did not supply.
+CXXFMT_FUNC void
+formatter::mark_missing(size_t i)
+{
+  for (format_spec *spec = &specs[i];
+       spec->arg_index != format_spec::i_invalid; ) {
+    sub_out out(target(*spec));
+    out.append(BEGIN_ERRMSG "[missing]" END_ERRMSG);
+    measured += out.counted();
+
+    i = spec->next_this_index;
+    if (i == format_spec::i_invalid)
+      break;
+    spec = &specs[i];
+  }
+}
+
+CXXFMT_FUNC void
 formatter::format_exc(size_t i) noexcept
 {
-  try {
+  CXXFMT_TRY {
     format_sub(i, diagnose_current_exception());
-  } catch (...) {
+  } CXXFMT_CATCH_ALL {
     terminate();
   }
 }
 
+CXXFMT_FUNC void
+formatter::join_sep(size_t i, const char *sep) noexcept
+{
+  if (i >= nargs)
+    return; // argument not used (probably a can't-happen)
+  if (stopped())
+    return;
+  format_spec *spec = &specs[i];
+  if (spec->arg_index == format_spec::i_invalid)
+    return; // argument not used
+  size_t len = std::strlen(sep);
+  for (;;) {
+    CXXFMT_TRY {
+      sub_out out(target(*spec));
+      out.append(sep, len);
+      measured += out.counted();
+    } CXXFMT_CATCH_ALL {
+      CXXFMT_TRY {
+        segs.at(spec->target).assign(diagnose_current_exception().c_str());
+      } CXXFMT_CATCH_ALL {
+        terminate();
+      }
+    }
+
+    i = spec->next_this_index;
+    if (i == format_spec::i_invalid)
+      break;
+    spec = &specs[i];
+  }
+}
+
 // Public interface.
 
+namespace detail {
+
+class new_delete_memory_resource : public memory_resource
+{
+public:
+#ifdef CXXFMT_NO_EXCEPTIONS
+  void *allocate(size_t bytes, size_t)
+  { return ::operator new(bytes, std::nothrow); }
+#else
+  void *allocate(size_t bytes, size_t)
+  { return ::operator new(bytes); }
+#endif
+  void deallocate(void *p, size_t, size_t) noexcept
+  { ::operator delete(p); }
+};
+
+} // namespace detail
+
+// The resource is constructed in static storage, and never destroyed,
+// so that strings destroyed during static destruction can still use it.
+CXXFMT_FUNC memory_resource *
+new_delete_resource() noexcept
+{
+  typedef detail::new_delete_memory_resource resource;
+  static std::aligned_storage<sizeof(resource),
+                              alignof(resource)>::type storage;
+  static memory_resource *const res = ::new (&storage) resource;
+  return res;
+}
+
+// Save 'errno' before doing _anything_ else.  This won't be good
+// enough if evaluation of the parent argument list clobbered it,
+// but that's a "you get to keep both pieces" scenario.
+// TODO: Needs Windows smarts.
+CXXFMT_FUNC
 formatter::formatter(size_t nargs_, const char *msg) noexcept
-  : nargs(nargs_)
+  : formatter(nargs_, msg, std::strlen(msg), errno, false,
+              new_delete_resource())
 {
-  // Save 'errno' before doing _anything_ else.  This won't be good
-  // enough if evaluation of the parent argument list clobbered it,
-  // but that's a "you get to keep both pieces" scenario.
-  // TODO: Needs Windows smarts.
-  int saved_errno = errno;
+}
 
-  try {
-    parse_format_string(msg);
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, format_string msg) noexcept
+  : formatter(nargs_, msg.data, msg.size, errno, false,
+              new_delete_resource())
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const pattern &pat) noexcept
+  : formatter(nargs_, pat, errno, false, new_delete_resource())
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const char *msg, measure_only) noexcept
+  : formatter(nargs_, msg, std::strlen(msg), errno, true,
+              new_delete_resource())
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, format_string msg, measure_only) noexcept
+  : formatter(nargs_, msg.data, msg.size, errno, true,
+              new_delete_resource())
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const pattern &pat, measure_only) noexcept
+  : formatter(nargs_, pat, errno, true, new_delete_resource())
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const char *msg,
+                     memory_resource &res) noexcept
+  : formatter(nargs_, msg, std::strlen(msg), errno, false, &res)
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, format_string msg,
+                     memory_resource &res) noexcept
+  : formatter(nargs_, msg.data, msg.size, errno, false, &res)
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const pattern &pat,
+                     memory_resource &res) noexcept
+  : formatter(nargs_, pat, errno, false, &res)
+{
+}
+
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const char *msg, size_t len,
+                     int saved_errno, bool measuring_,
+                     memory_resource *res) noexcept
+  : nargs(nargs_), base(0),
+    failures(detail::allocation_failures()), segs(res), specs(res),
+    measuring(measuring_), measured(0)
+{
+  CXXFMT_TRY {
+    parse_format_string(msg, msg + len);
 
     // If we're asked to print strerror(errno), take care of that now.
     if (first_errno_spec.target != format_spec::i_invalid) {
       format_sub(format_spec::i_errno, std::strerror(saved_errno));
     }
 
-  } catch (...) {
-    try {
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
       nargs = 0;
+      measured = 0;
       first_errno_spec.reset();
       specs.clear();
       segs.resize(1);
-      segs[0] = diagnose_current_exception();
-    } catch (...) {
+      segs[0].assign(diagnose_current_exception().c_str());
+    } CXXFMT_CATCH_ALL {
       terminate();
     }
   }
 }
 
-string
+CXXFMT_FUNC
+formatter::formatter(const char *msg, size_t len, size_t &errors) noexcept
+  : nargs(0), base(0), failures(detail::allocation_failures()),
+    measuring(false), measured(0)
+{
+  CXXFMT_TRY {
+    errors = parse_format_string(msg, msg + len, true);
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
+      errors = 1;
+      nargs = 0;
+      first_errno_spec.reset();
+      specs.clear();
+      segs.resize(1);
+      segs[0].assign(diagnose_current_exception().c_str());
+    } CXXFMT_CATCH_ALL {
+      terminate();
+    }
+  }
+
+#ifdef CXXFMT_NO_EXCEPTIONS
+  // A pattern outlives this constructor, so if memory ran out while
+  // parsing it, it becomes the marker now.  Its storage is given back
+  // first, so that the emergency reserve is not held onto.
+  if (!ok()) {
+    errors = 1;
+    nargs = 0;
+    first_errno_spec.reset();
+    decltype(specs)().swap(specs);
+    decltype(segs)(1).swap(segs);
+    segs[0].assign(OUT_OF_MEMORY);
+  }
+#endif
+}
+
+// The literal text stays in the pattern; only the substitutions are
+// made here.
+CXXFMT_FUNC
+formatter::formatter(size_t nargs_, const pattern &pat, int saved_errno,
+                     bool measuring_, memory_resource *res) noexcept
+  : nargs(nargs_ < pat.parsed.nargs ? nargs_ : pat.parsed.nargs),
+    base(&pat.parsed), failures(detail::allocation_failures()),
+    segs(res), specs(res), measuring(measuring_), measured(0)
+{
+  CXXFMT_TRY {
+    segs.resize(base->segs.size());
+    specs = base->specs;
+    first_errno_spec = base->first_errno_spec;
+
+    for (size_t i = nargs; i < base->nargs; i++)
+      mark_missing(i);
+
+    if (first_errno_spec.target != format_spec::i_invalid) {
+      format_sub(format_spec::i_errno, std::strerror(saved_errno));
+    }
+
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
+      nargs = 0;
+      base = 0;
+      measured = 0;
+      first_errno_spec.reset();
+      specs.clear();
+      segs.resize(1);
+      segs[0].assign(diagnose_current_exception().c_str());
+    } CXXFMT_CATCH_ALL {
+      terminate();
+    }
+  }
+}
+
+CXXFMT_FUNC
+pattern::pattern(const char *msg) noexcept
+  : parsed(msg, std::strlen(msg), nerrors)
+{
+}
+
+CXXFMT_FUNC
+pattern::pattern(format_string msg) noexcept
+  : parsed(msg.data, msg.size, nerrors)
+{
+}
+
+CXXFMT_FUNC string
 formatter::finish() noexcept
 {
-  try {
-    return std::accumulate(segs.begin(), segs.end(), string(""));
+  string out;
+  finish(out);
+  return out;
+}
 
-  } catch (...) {
-    try {
-      return diagnose_current_exception();
-    } catch (...) {
+CXXFMT_FUNC size_t
+formatter::size() const noexcept
+{
+  size_t total = measured;
+  for (size_t k = 0; k < segs.size(); k++)
+    total += seg(k).size();
+  return total;
+}
+
+template <typename Str> CXXFMT_FUNC void
+formatter::finish_into(Str& out) noexcept
+{
+  size_t len = out.size();
+  CXXFMT_TRY {
+    if (!stopped()) {
+      size_t total = 0;
+      for (size_t k = 0; k < segs.size(); k++)
+        total += seg(k).size();
+      make_room(out, total);
+      for (size_t k = 0; k < segs.size(); k++)
+        out.append(seg(k).data(), seg(k).size());
+    }
+
+#ifdef CXXFMT_NO_EXCEPTIONS
+    // Memory ran out, so the result is only a marker.  This
+    // formatter's storage is given back first, so that the marker is
+    // likely to fit, and the marker is put in a fresh string, so that
+    // 'out' does not hold onto the emergency reserve.
+    if (stopped()) {
+      decltype(segs)(segs.get_allocator()).swap(segs);
+      decltype(specs)(specs.get_allocator()).swap(specs);
+      Str fresh(out.data(), len, out.get_allocator());
+      fresh.append(OUT_OF_MEMORY);
+      out.swap(fresh);
+    }
+#endif
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
+      out.resize(len);
+      out.append(diagnose_current_exception().c_str());
+    } CXXFMT_CATCH_ALL {
+      terminate();
+    }
+  }
+}
+
+CXXFMT_FUNC void
+formatter::finish(string& out) noexcept
+{
+  finish_into(out);
+}
+
+CXXFMT_FUNC void
+formatter::finish(pmr_string& out) noexcept
+{
+  finish_into(out);
+}
+
+// Deferred formatting.
+
+CXXFMT_FUNC void
+detail::deferred_writer::format_exc(size_t n) noexcept
+{
+  CXXFMT_TRY {
+    format_sub(n, formatter::diagnose_current_exception());
+  } CXXFMT_CATCH_ALL {
+    terminate();
+  }
+}
+
+template <typename T>
+CXXFMT_LOCAL T
+get_arg(const char *&p)
+{
+  T v;
+  std::memcpy(&v, p, sizeof v);
+  p += sizeof v;
+  return v;
+}
+
+CXXFMT_FUNC void
+deferred::render_arg(formatter& state, size_t i, const char *&p) noexcept
+{
+  switch (*p++) {
+  case 'c': state.format_sub(i, get_arg<unsigned char>(p)); break;
+  case 'd': state.format_sub(i, get_arg<long long>(p)); break;
+  case 'u': state.format_sub(i, get_arg<unsigned long long>(p)); break;
+  case 'f': state.format_sub(i, get_arg<double>(p)); break;
+  case 'p': state.format_sub(i, get_arg<const void *>(p)); break;
+  case 's': {
+    size_t len = get_arg<size_t>(p);
+    // The copy is NUL-terminated, so unless the string had
+    // embedded NULs, it can be formatted in place.
+    if (!std::memchr(p, '\0', len))
+      state.format_sub(i, p);
+    else {
+      CXXFMT_TRY {
+        state.format_sub(i, string(p, len));
+      } CXXFMT_CATCH_ALL {
+        state.format_exc(i);
+      }
+    }
+    p += len + 1;
+  } break;
+  case 'j': {
+    assert(*p == 's');
+    p++;
+    size_t len = get_arg<size_t>(p);
+    const char *sep = p;
+    p += len + 1;
+    for (bool first = true; *p != 'e'; first = false) {
+      if (!first)
+        state.join_sep(i, sep);
+      render_arg(state, i, p);
+    }
+    p++;
+  } break;
+  default:
+    assert(!"corrupt deferred record");
+    terminate();
+  }
+}
+
+CXXFMT_FUNC string
+deferred::render(const void *rec) noexcept
+{
+  detail::deferred_header header;
+  std::memcpy(&header, rec, sizeof header);
+  formatter state(header.nargs, header.msg, std::strlen(header.msg),
+                  header.saved_errno, false, new_delete_resource());
+
+  const char *p = static_cast<const char *>(rec) + sizeof header;
+  for (size_t i = 0; i < header.nargs; i++)
+    render_arg(state, i, p);
+  return state.finish();
+}
+
+CXXFMT_FUNC
+deferred_ring::deferred_ring(size_t capacity)
+  : head(0), tail(0)
+{
+  size_t size = 64;
+  while (size < capacity)
+    size *= 2;
+  buf = new char[size];
+  mask = size - 1;
+}
+
+CXXFMT_FUNC
+deferred_ring::~deferred_ring()
+{
+  delete[] buf;
+}
+
+// Mark the 'len' bytes at 'off', up to the end of the buffer, as
+// padding.  If there isn't room for a header, the consumer knows to
+// skip them anyway.
+CXXFMT_FUNC void
+deferred_ring::skip(size_t off, size_t len) noexcept
+{
+  if (len >= sizeof(detail::deferred_header)) {
+    detail::deferred_header header = detail::deferred_header();
+    header.size = len;
+    std::memcpy(buf + off, &header, sizeof header);
+  }
+}
+
+CXXFMT_FUNC bool
+deferred_ring::pop(string& out) noexcept
+{
+  size_t t = tail.load(std::memory_order_relaxed);
+  for (;;) {
+    if (t == head.load(std::memory_order_acquire))
+      return false;
+    size_t off = t & mask;
+    if (mask + 1 - off < sizeof(detail::deferred_header)) {
+      t += mask + 1 - off;
+      continue;
+    }
+    detail::deferred_header header;
+    std::memcpy(&header, buf + off, sizeof header);
+    if (!header.msg) {
+      t += header.size;
+      continue;
+    }
+    out = deferred::render(buf + off);
+    tail.store(t + header.size, std::memory_order_release);
+    return true;
+  }
+}
+
+// Message catalogs.
+
+struct catalog::entries
+{
+  std::vector<std::unique_ptr<const pattern>> by_id;
+};
+
+struct catalog::registry
+{
+  std::mutex lock;    // Held while assigning IDs, and while loading.
+  std::unordered_map<string, size_t> ids;
+};
+
+CXXFMT_FUNC
+catalog::catalog()
+  : names(new registry)
+{}
+
+CXXFMT_FUNC
+catalog::~catalog()
+{}
+
+CXXFMT_LOCAL bool
+is_blank(char c)
+{
+  return c == ' ' || c == '\t';
+}
+
+// Parse the catalog 'text' into a new set of entries, and if there
+// were no errors, make them current.  Each error message begins with
+// 'where' and the line number.
+CXXFMT_FUNC bool
+catalog::load_text(format_string text, const char *where, string *errors)
+{
+  std::lock_guard<std::mutex> lock(names->lock);
+  std::unordered_map<string, size_t>& ids = names->ids;
+  std::shared_ptr<entries> e = std::make_shared<entries>();
+  size_t nerrors = 0;
+
+  const char *p = text.data;
+  const char *end = text.data + text.size;
+  for (size_t line = 1; p < end; line++) {
+    const char *eol = find_char(p, end, '\n');
+    const char *next = eol < end ? eol + 1 : end;
+    if (eol > p && eol[-1] == '\r')
+      eol--;
+
+    while (p < eol && is_blank(*p))
+      p++;
+    if (p == eol || *p == '#') {
+      p = next;
+      continue;
+    }
+
+    const char *name = p;
+    while (p < eol && *p != '=' && !is_blank(*p))
+      p++;
+    const char *name_end = p;
+    while (p < eol && is_blank(*p))
+      p++;
+    if (p == eol || *p != '=' || name == name_end) {
+      if (errors)
+        format_append(*errors, "{}{}: expected 'name = template'\n",
+                      where, line);
+      nerrors++;
+      p = next;
+      continue;
+    }
+    p++;
+    while (p < eol && is_blank(*p))
+      p++;
+
+    size_t id = ids.insert(std::make_pair(string(name, name_end),
+                                          ids.size())).first->second;
+    if (e->by_id.size() <= id)
+      e->by_id.resize(id + 1);
+    if (e->by_id[id]) {
+      if (errors)
+        format_append(*errors, "{}{}: duplicate message '{}'\n",
+                      where, line, string(name, name_end));
+      nerrors++;
+    } else {
+      e->by_id[id].reset(new pattern(format_string(p, eol - p)));
+      if (e->by_id[id]->errors()) {
+        if (errors)
+          format_append(*errors, "{}{}: malformed template for '{}'\n",
+                        where, line, string(name, name_end));
+        nerrors++;
+      }
+    }
+    p = next;
+  }
+
+  if (nerrors)
+    return false;
+  std::atomic_store(&current, std::shared_ptr<const entries>(std::move(e)));
+  return true;
+}
+
+CXXFMT_FUNC bool
+catalog::load(format_string text, string *errors) noexcept
+{
+  bool ok = false;
+  CXXFMT_TRY {
+    ok = load_text(text, "line ", errors);
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
+      if (errors)
+        format_append(*errors, "{}\n",
+                      formatter::diagnose_current_exception());
+    } CXXFMT_CATCH_ALL {
       terminate();
     }
   }
+  return ok;
+}
+
+CXXFMT_FUNC bool
+catalog::load(const char *path, string *errors) noexcept
+{
+  bool ok = false;
+  CXXFMT_TRY {
+    string where = fmt::format("{}:", path);
+#ifdef HAVE_MMAP
+    // The text is parsed straight out of the mapping; the patterns
+    // keep copies of what they need, so it is unmapped afterward.
+    struct mapping {
+      void *addr = MAP_FAILED;
+      size_t len = 0;
+      ~mapping() { if (addr != MAP_FAILED) munmap(addr, len); }
+    } m;
+    struct stat st;
+    int fd = ::open(path, O_RDONLY);
+    if (fd == -1 || fstat(fd, &st) == -1) {
+      if (errors)
+        format_append(*errors, "{} {m}\n", where);
+    } else if (st.st_size == 0) {
+      ok = load_text(format_string("", 0), where.c_str(), errors);
+    } else {
+      m.len = st.st_size;
+      m.addr = mmap(0, m.len, PROT_READ, MAP_PRIVATE, fd, 0);
+      if (m.addr == MAP_FAILED) {
+        if (errors)
+          format_append(*errors, "{} {m}\n", where);
+      } else {
+        ok = load_text(format_string(static_cast<const char *>(m.addr),
+                                     m.len),
+                       where.c_str(), errors);
+      }
+    }
+    if (fd != -1)
+      ::close(fd);
+#else
+    string text;
+    std::FILE *f = std::fopen(path, "rb");
+    if (!f) {
+      if (errors)
+        format_append(*errors, "{} {m}\n", where);
+    } else {
+      char buf[4096];
+      size_t n;
+      while ((n = std::fread(buf, 1, sizeof buf, f)) > 0)
+        text.append(buf, n);
+      if (std::ferror(f)) {
+        if (errors)
+          format_append(*errors, "{} {m}\n", where);
+      } else {
+        ok = load_text(format_string(text.data(), text.size()),
+                       where.c_str(), errors);
+      }
+      std::fclose(f);
+    }
+#endif
+  } CXXFMT_CATCH_ALL {
+    CXXFMT_TRY {
+      if (errors)
+        format_append(*errors, "{}\n",
+                      formatter::diagnose_current_exception());
+    } CXXFMT_CATCH_ALL {
+      terminate();
+    }
+  }
+  return ok;
+}
+
+CXXFMT_FUNC size_t
+catalog::id(const char *name)
+{
+  std::lock_guard<std::mutex> lock(names->lock);
+  std::unordered_map<string, size_t>& ids = names->ids;
+  return ids.insert(std::make_pair(string(name), ids.size())).first->second;
+}
+
+CXXFMT_FUNC std::shared_ptr<const pattern>
+catalog::get(size_t id) const noexcept
+{
+  std::shared_ptr<const entries> e = std::atomic_load(&current);
+  if (e && id < e->by_id.size() && e->by_id[id])
+    // Shares ownership of the whole set of entries.
+    return std::shared_ptr<const pattern>(e, e->by_id[id].get());
+
+  static const pattern unknown(BEGIN_ERRMSG "[unknown message]" END_ERRMSG);
+  return std::shared_ptr<const pattern>(std::shared_ptr<const pattern>(),
+                                        &unknown);
 }
 
 } // namespace fmt
 
+#undef CXXFMT_LOCAL
+#undef BEGIN_ERRMSG
+#undef END_ERRMSG
+#undef OUT_OF_MEMORY
+#undef HAVE_CXA_EXCEPTION_INFO
+#undef HAVE_MMAP
+#undef CXXFMT_THREAD_LOCAL
+
+#endif // CXXFMT_FMT_CC__
+
 // Local Variables:
 // mode: c++
 // c-file-offsets: ((innamespace . 0))
@@ -7,11 +7,53 @@
 #ifndef CXXFMT_FMT_H__
 #define CXXFMT_FMT_H__
 
+#include <atomic>
+#include <cerrno>
 #include <cstddef>
+#include <cstring>
+#include <iterator>
+#include <memory>
+#include <new>
 #include <string>
 #include <type_traits>
+#include <utility>
 #include <vector>
 
+// If CXXFMT_HEADER_ONLY is defined before this header is included,
+// the whole library is defined inline by this header (which includes
+// fmt.cc at the end), and fmt.cc need not be compiled and linked
+// separately.  The compiler can then inline and specialize the
+// conversion code at each call site without link-time optimization.
+#ifdef CXXFMT_HEADER_ONLY
+#define CXXFMT_FUNC inline
+#else
+#define CXXFMT_FUNC
+#endif
+
+// Exception-free mode.  When exceptions are disabled (for instance
+// by -fno-exceptions), or CXXFMT_NO_EXCEPTIONS is defined, the
+// library catches nothing: CXXFMT_TRY and CXXFMT_CATCH_ALL make the
+// handlers dead code, so no landing pads are generated for them.
+// Errors the library detects itself are still reported with
+// reverse-video markers.  Running out of memory is reported by
+// formatter::ok() and the result of format_append, and the result
+// is then an [out of memory] marker (see reserve_allocate, below).
+// Any other exception terminates the program, as it does in any code
+// built this way.
+#if !defined CXXFMT_NO_EXCEPTIONS && !(defined __cpp_exceptions         \
+                                       || defined __EXCEPTIONS          \
+                                       || defined _CPPUNWIND)
+#define CXXFMT_NO_EXCEPTIONS
+#endif
+
+#ifdef CXXFMT_NO_EXCEPTIONS
+#define CXXFMT_TRY if (true)
+#define CXXFMT_CATCH_ALL if (false)
+#else
+#define CXXFMT_TRY try
+#define CXXFMT_CATCH_ALL catch (...)
+#endif
+
 namespace fmt {
 
 namespace detail {
@@ -43,17 +85,24 @@ CXXFMT_HAS_MEM_FUNC(what);
 
 struct format_spec
 {
-  // Special arg_index values.
-  static const size_t i_invalid = -1;  // This format_spec is invalid.
-  static const size_t i_errno   = -2;  // This format_spec applies to
-                                       //   strerror(errno).
+  // Indices are stored narrower than size_t so that a parsed format
+  // string, which holds one format_spec per substitution, stays small.
+  // Values that do not fit are clamped by the parser (see
+  // parse_subst and parse_format_string).
+  typedef unsigned int index;
 
-  size_t arg_index;       // Argument index.
-  size_t next_this_index; // Index in the 'specs' array of the next spec
-                          // that uses the same argument index, if any;
-                          // i_invalid otherwise.
-  size_t target;          // Index in the 'segments' array where the
-                          // formatted string should be placed.
+  // Special arg_index values.
+  static const index i_invalid = -1;  // This format_spec is invalid.
+  static const index i_errno   = -2;  // This format_spec applies to
+                                      //   strerror(errno).
+  static const index i_max     = -3;  // Largest ordinary index.
+
+  index arg_index;       // Argument index.
+  index next_this_index; // Index in the 'specs' array of the next spec
+                         // that uses the same argument index, if any;
+                         // i_invalid otherwise.
+  index target;          // Index in the 'segments' array where the
+                         // formatted string should be placed.
 
   unsigned int width;
   unsigned int precision;
@@ -74,43 +123,155 @@ struct format_spec
   void reset() { *this = format_spec(); }
 };
 
-class formatter
+// A range of elements, each of which is formatted with the same
+// spec, with 'sep' between them: see join() below.
+template <typename It>
+struct join_view
 {
-  size_t nargs;
-  std::vector<std::string> segs;
-  std::vector<format_spec> specs;
-  format_spec first_errno_spec;
+  It first;
+  It last;
+  const char *sep;
+};
 
-  // Internal subroutines.
-  void parse_format_string(const char *str);
+// A format string given by pointer and length, which need not be
+// NUL-terminated: for instance, a slice of a larger buffer or of a
+// memory-mapped file.  Nothing at or past data + size is read, and
+// NULs before that are ordinary characters.
+struct format_string
+{
+  const char *data;
+  size_t size;
 
-  std::string diagnose_current_exception();
+  format_string(const char *data_, size_t size_)
+    : data(data_), size(size_)
+  {}
+};
 
-  // Base format categories.  These methods do the actual work of
-  // rendering each substitution.
-  void format_sub(size_t, unsigned char) noexcept;
-  void format_sub(size_t, long long) noexcept;
-  void format_sub(size_t, unsigned long long) noexcept;
-  void format_sub(size_t, double) noexcept;
-  void format_sub(size_t, const char *) noexcept;
-  void format_sub(size_t, const void *) noexcept;
-  void format_sub(size_t, const std::string &) noexcept;
+// Memory resources.  Normally the library's internal storage, and the
+// strings it returns, come from the global heap; a caller can instead
+// supply a memory_resource (modeled on std::pmr::memory_resource,
+// which C++11 lacks) for all of it to come from: for instance, an
+// arena which is freed all at once.  In exception-free mode, allocate
+// reports failure by returning null, rather than by throwing.
+class memory_resource
+{
+public:
+  virtual ~memory_resource() {}
+  virtual void *allocate(size_t bytes, size_t align) = 0;
+  virtual void deallocate(void *p, size_t bytes, size_t align) noexcept = 0;
+};
 
-  // Called when a format_sub method throws an exception.
-  void format_exc(size_t n) noexcept;
+// The resource which uses operator new and operator delete.
+memory_resource *new_delete_resource() noexcept;
+
+namespace detail {
 
-  // Adapters pick the appropriate base category for every possible
-  // argument.
+// Exception-free mode has no bad_alloc to report a failed allocation
+// with, and the standard containers cannot cope with a null pointer.
+// So when a memory_resource fails, polymorphic_allocator takes the
+// memory from a small emergency reserve instead, and counts the
+// failure.  A formatter which sees the count change stops formatting
+// and produces an [out of memory] marker, giving the reserve back.
+// Only if the reserve is exhausted too does the program terminate.
+void *reserve_allocate(size_t bytes, size_t align) noexcept;
+bool reserve_deallocate(void *p) noexcept;
+
+} // namespace detail
+
+// An allocator which gets its memory from a memory_resource.  Like
+// std::pmr::polymorphic_allocator, it passes itself on to elements
+// of a container which can take an allocator (such as pmr_string),
+// so that they use the same resource as the container.
+template <typename T>
+class polymorphic_allocator
+{
+  template <typename U> friend class polymorphic_allocator;
+  memory_resource *res;
+
+public:
+  typedef T value_type;
+
+  polymorphic_allocator() noexcept : res(new_delete_resource()) {}
+  polymorphic_allocator(memory_resource *res_) noexcept : res(res_) {}
+  template <typename U>
+  polymorphic_allocator(const polymorphic_allocator<U> &other) noexcept
+    : res(other.res)
+  {}
 
+  T *allocate(size_t n)
+  {
+    void *p = res->allocate(n * sizeof(T), alignof(T));
+#ifdef CXXFMT_NO_EXCEPTIONS
+    if (!p)
+      p = detail::reserve_allocate(n * sizeof(T), alignof(T));
+#endif
+    return static_cast<T *>(p);
+  }
+  void deallocate(T *p, size_t n) noexcept
+  {
+#ifdef CXXFMT_NO_EXCEPTIONS
+    if (detail::reserve_deallocate(p))
+      return;
+#endif
+    res->deallocate(p, n * sizeof(T), alignof(T));
+  }
+
+  template <typename U, typename... Args>
+  typename std::enable_if<
+    std::is_constructible<U, Args..., const polymorphic_allocator &>::value
+  >::type
+  construct(U *p, Args&&... args)
+  { ::new (static_cast<void *>(p)) U(std::forward<Args>(args)..., *this); }
+
+  template <typename U, typename... Args>
+  typename std::enable_if<
+    !std::is_constructible<U, Args..., const polymorphic_allocator &>::value
+  >::type
+  construct(U *p, Args&&... args)
+  { ::new (static_cast<void *>(p)) U(std::forward<Args>(args)...); }
+
+  memory_resource *resource() const noexcept { return res; }
+};
+
+template <typename T, typename U> inline bool
+operator==(const polymorphic_allocator<T> &a,
+           const polymorphic_allocator<U> &b) noexcept
+{
+  return a.resource() == b.resource();
+}
+
+template <typename T, typename U> inline bool
+operator!=(const polymorphic_allocator<T> &a,
+           const polymorphic_allocator<U> &b) noexcept
+{
+  return a.resource() != b.resource();
+}
+
+typedef std::basic_string<char, std::char_traits<char>,
+                          polymorphic_allocator<char>> pmr_string;
+
+namespace detail {
+
+// Adapters pick the appropriate base category for every possible
+// argument.  They are shared by each class that consumes a pack of
+// arguments (the 'Sink'), which must provide the base categories as
+// overloads of format_sub, format_exc, and the join_begin, join_sep
+// and join_end hooks used for ranges, and befriend this class.
+template <typename Sink>
+class format_adapters
+{
+  Sink& sink() { return static_cast<Sink&>(*this); }
+
+protected:
   // Convert 'signed char' and 'char' to 'unsigned char'.
   void format_sub(size_t n, signed char t)
-  { format_sub(n, (unsigned char)(t)); }
+  { sink().format_sub(n, (unsigned char)(t)); }
   void format_sub(size_t n, char t)
-  { format_sub(n, (unsigned char)(t)); }
+  { sink().format_sub(n, (unsigned char)(t)); }
 
   // Convert 'float' to 'double'.
   void format_sub(size_t n, float t)
-  { format_sub(n, (double)(t)); }
+  { sink().format_sub(n, (double)(t)); }
 
   // Convert all integral, non-char types to 'long long' with the same
   // signedness.  Note that if 'long' and/or 'int' are the same size
@@ -126,7 +287,7 @@ class formatter
                      && sizeof(T) > 1
                      && sizeof(T) <= sizeof(unsigned long long))
                   >::type* = 0)
-  { format_sub(n, (unsigned long long)(t)); }
+  { sink().format_sub(n, (unsigned long long)(t)); }
 
   template <typename T>
   void format_sub(size_t n, T t,
@@ -137,7 +298,7 @@ class formatter
                      && sizeof(T) > 1
                      && sizeof(T) <= sizeof(long long))
                   >::type* = 0)
-  { format_sub(n, (long long)(t)); }
+  { sink().format_sub(n, (long long)(t)); }
 
   // Convert enums to their underlying integral type.
   template <typename T>
@@ -145,14 +306,14 @@ class formatter
                   typename std::enable_if<
                     std::is_enum<T>::value
                   >::type* = 0)
-  { format_sub(n, (typename std::underlying_type<T>::type)(t)); }
+  { sink().format_sub(n, (typename std::underlying_type<T>::type)(t)); }
 
   // Convert any object that can be converted to a string, either by
   // construction or by member methods.  These can invoke arbitrary
   // code, so they must trap exceptions.
 #define CXXFMT_FORMAT_SUB_WITH_CATCH(n, expr)  do {                     \
-    try                             { format_sub(n, expr); }            \
-    catch (...)                     { format_exc(n); }                  \
+    CXXFMT_TRY                      { sink().format_sub(n, expr); }     \
+    CXXFMT_CATCH_ALL                { sink().format_exc(n); }           \
   } while (0)
 
   template <typename T>
@@ -191,24 +352,168 @@ class formatter
   // Convert arbitrary pointers to 'void *'.
   template <typename T>
   void format_sub(size_t n, const T* t)
-  { format_sub(n, reinterpret_cast<const void *>(t)); }
-
-public:
-  formatter(size_t nargs, const char *msg) noexcept;
+  { sink().format_sub(n, reinterpret_cast<const void *>(t)); }
 
-  std::string finish() noexcept;
+  // Format each element of a range in turn, straight into the
+  // output.  Iterating can invoke arbitrary code, so this must trap
+  // exceptions too.
+  template <typename It>
+  void format_sub(size_t n, const join_view<It>& j)
+  {
+    sink().join_begin(n, j.sep);
+    CXXFMT_TRY {
+      for (It i = j.first; i != j.last; ++i) {
+        if (i != j.first)
+          sink().join_sep(n, j.sep);
+        sink().format_sub(n, *i);
+      }
+    } CXXFMT_CATCH_ALL {
+      sink().format_exc(n);
+    }
+    sink().join_end(n);
+  }
 
+public:
   // Recursive template to prepare a whole argpack of substitutions.
   void format_subs(size_t) {}
 
   template <typename X, typename... XS> void
   format_subs(size_t n, X&& x, XS&&... xs)
   {
-    format_sub(n, x);
+    sink().format_sub(n, x);
     format_subs(n+1, xs...);
   }
 };
 
+class deferred_writer;
+
+} // namespace detail
+
+class pattern;
+
+class formatter : private detail::format_adapters<formatter>
+{
+  friend class detail::format_adapters<formatter>;
+  friend class detail::deferred_writer;
+  friend class deferred;
+  friend class pattern;
+  friend class catalog;
+
+  size_t nargs;
+  const formatter *base; // For a formatter made from a pattern, the
+                         // pattern's own formatter, whose segments
+                         // hold the literal text: see seg().
+  unsigned long failures; // Allocation failures on this thread before
+                          // the formatter was made: see ok().
+  std::vector<pmr_string, polymorphic_allocator<pmr_string>> segs;
+  std::vector<format_spec, polymorphic_allocator<format_spec>> specs;
+  format_spec first_errno_spec;
+  bool measuring;     // If true, substitutions are only counted...
+  size_t measured;    // ... and this is their total length.
+
+  // Used by deferred::render, to substitute the errno saved when
+  // the arguments were captured.
+  formatter(size_t nargs, const char *msg, size_t len, int saved_errno,
+            bool measuring, memory_resource *res) noexcept;
+
+  // Used by pattern, to parse 'msg' for however many arguments it
+  // refers to, storing the number of malformed substitutions in
+  // 'errors'.
+  formatter(const char *msg, size_t len, size_t &errors) noexcept;
+
+  formatter(size_t nargs, const pattern &pat, int saved_errno,
+            bool measuring, memory_resource *res) noexcept;
+
+  // Internal subroutines.
+  size_t parse_format_string(const char *str, const char *end,
+                             bool open_ended = false);
+  pmr_string *target(const format_spec &spec);
+  void mark_missing(size_t i);
+  bool stopped() const noexcept;
+  template <typename Str> void finish_into(Str &out) noexcept;
+
+  // Even-numbered segments are literal text, odd-numbered ones are
+  // substitutions.
+  const pmr_string &seg(size_t k) const
+  { return base && !(k & 1) ? base->segs[k] : segs[k]; }
+
+  static std::string diagnose_current_exception();
+
+  // Base format categories.  These methods do the actual work of
+  // rendering each substitution.
+  void format_sub(size_t, unsigned char) noexcept;
+  void format_sub(size_t, long long) noexcept;
+  void format_sub(size_t, unsigned long long) noexcept;
+  void format_sub(size_t, double) noexcept;
+  void format_sub(size_t, const char *) noexcept;
+  void format_sub(size_t, const void *) noexcept;
+  void format_sub(size_t, const std::string &) noexcept;
+  using detail::format_adapters<formatter>::format_sub;
+
+  // Called when a format_sub method throws an exception.
+  void format_exc(size_t n) noexcept;
+
+  // Elements of a range are formatted one after another into the
+  // same place, so only the separators need doing.
+  void join_begin(size_t, const char *) noexcept {}
+  void join_sep(size_t n, const char *sep) noexcept;
+  void join_end(size_t) noexcept {}
+
+public:
+  formatter(size_t nargs, const char *msg) noexcept;
+  formatter(size_t nargs, format_string msg) noexcept;
+  formatter(size_t nargs, const pattern &pat) noexcept;
+
+  // A formatter whose storage comes from 'res'.
+  formatter(size_t nargs, const char *msg, memory_resource &res) noexcept;
+  formatter(size_t nargs, format_string msg, memory_resource &res) noexcept;
+  formatter(size_t nargs, const pattern &pat, memory_resource &res) noexcept;
+
+  // A formatter which only measures the length of its result, which
+  // is then returned by size(), instead of producing it.
+  struct measure_only {};
+  formatter(size_t nargs, const char *msg, measure_only) noexcept;
+  formatter(size_t nargs, format_string msg, measure_only) noexcept;
+  formatter(size_t nargs, const pattern &pat, measure_only) noexcept;
+
+  std::string finish() noexcept;
+  void finish(std::string& out) noexcept;
+  void finish(pmr_string& out) noexcept;
+  size_t size() const noexcept;
+
+  // False if memory ran out while formatting.  Normally the
+  // substitution which ran out is replaced by an [out of memory]
+  // marker; in exception-free mode, the whole result is.
+  bool ok() const noexcept;
+
+  using detail::format_adapters<formatter>::format_subs;
+};
+
+// A format string parsed once, ahead of time, so that formatting
+// with it does no parsing at all.  A pattern may refer to arguments
+// 0 through max_args - 1; when it is used, arguments it refers to
+// that are not supplied are [missing], and the rest are ignored.
+class pattern
+{
+  friend class formatter;
+
+  size_t nerrors;     // Set while 'parsed' is constructed.
+  formatter parsed;
+
+public:
+  static const size_t max_args = 256;
+
+  explicit pattern(const char *msg) noexcept;
+  explicit pattern(format_string msg) noexcept;
+
+  // The number of arguments the pattern refers to.
+  size_t nargs() const noexcept { return parsed.nargs; }
+
+  // The number of malformed substitutions in the format string.
+  // They are still rendered with reverse-video markers, as usual.
+  size_t errors() const noexcept { return nerrors; }
+};
+
 //
 // This is the exposed interface.
 //
@@ -222,8 +527,426 @@ format(const char *msg, XS&&... xs)
   return state.finish();
 }
 
+template <typename... XS> inline std::string
+format(format_string msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg);
+  state.format_subs(0, xs...);
+  return state.finish();
+}
+
+template <typename... XS> inline std::string
+format(const pattern& pat, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, pat);
+  state.format_subs(0, xs...);
+  return state.finish();
+}
+
+// Like format, but appends the result to 'out', so a string which is
+// reused for many calls soon stops needing to grow.  Returns false if
+// memory ran out (see formatter::ok).
+template <typename... XS> inline bool
+format_append(std::string& out, const char *msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg);
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+template <typename... XS> inline bool
+format_append(std::string& out, format_string msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg);
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+template <typename... XS> inline bool
+format_append(std::string& out, const pattern& pat, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, pat);
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+// The length of the string which format(msg, xs...) would return,
+// without producing it.  Numbers are not formatted, except for
+// floating-point numbers.
+template <typename... XS> inline size_t
+formatted_size(const char *msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, formatter::measure_only());
+  state.format_subs(0, xs...);
+  return state.size();
+}
+
+template <typename... XS> inline size_t
+formatted_size(format_string msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, formatter::measure_only());
+  state.format_subs(0, xs...);
+  return state.size();
+}
+
+template <typename... XS> inline size_t
+formatted_size(const pattern& pat, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, pat, formatter::measure_only());
+  state.format_subs(0, xs...);
+  return state.size();
+}
+
+// Like format, but all the memory used, including that for the
+// result, comes from 'res'.
+template <typename... XS> inline pmr_string
+format(memory_resource& res, const char *msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, res);
+  state.format_subs(0, xs...);
+  pmr_string out(&res);
+  state.finish(out);
+  return out;
+}
+
+template <typename... XS> inline pmr_string
+format(memory_resource& res, format_string msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, res);
+  state.format_subs(0, xs...);
+  pmr_string out(&res);
+  state.finish(out);
+  return out;
+}
+
+template <typename... XS> inline pmr_string
+format(memory_resource& res, const pattern& pat, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, pat, res);
+  state.format_subs(0, xs...);
+  pmr_string out(&res);
+  state.finish(out);
+  return out;
+}
+
+// Like format_append, but all the memory used comes from the
+// resource of 'out'.
+template <typename... XS> inline bool
+format_append(pmr_string& out, const char *msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, *out.get_allocator().resource());
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+template <typename... XS> inline bool
+format_append(pmr_string& out, format_string msg, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, msg, *out.get_allocator().resource());
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+template <typename... XS> inline bool
+format_append(pmr_string& out, const pattern& pat, XS&&... xs)
+{
+  size_t nargs = sizeof...(xs);
+  formatter state(nargs, pat, *out.get_allocator().resource());
+  state.format_subs(0, xs...);
+  state.finish(out);
+  return state.ok();
+}
+
+// Format the elements of 'range' (or of [first, last)) with the
+// spec of the substitution the join is passed to, separated by
+// 'sep', as in
+//
+//   format("{:>4x}", join(vec, ","))
+//
+// The range is not copied, so this should only be used within the
+// format call.
+template <typename Range> inline
+join_view<decltype(std::begin(std::declval<const Range&>()))>
+join(const Range& range, const char *sep)
+{
+  return { std::begin(range), std::end(range), sep };
+}
+
+template <typename It> inline join_view<It>
+join(It first, It last, const char *sep)
+{
+  return { first, last, sep };
+}
+
+//
+// Message catalogs.  A catalog is loaded from a file of named
+// templates, one per line:
+//
+//   # Comments and blank lines are ignored.
+//   disk_full = Disk {0} is full ({1} bytes free).
+//   copy_failed = Could not copy {1} to {0}: {m}
+//
+// The template is the rest of the line after '=' and any spaces.
+// Every template is parsed into a pattern when the file is loaded,
+// and if any of them is malformed, the whole load fails and the
+// catalog is left as it was.  Each name has a numeric ID, which stays
+// the same from one load to the next, and looking up a pattern by ID
+// takes constant time: so a program can find the IDs of its messages
+// once, then load catalogs for different languages as it pleases.
+// Loading can be done while other threads format from the catalog;
+// they see either the old contents or the new, never a mixture.
+//
+
+class catalog
+{
+  struct entries;
+  struct registry;
+
+  std::shared_ptr<const entries> current; // Only accessed atomically.
+  std::unique_ptr<registry> names;        // IDs assigned so far.
+
+  bool load_text(format_string text, const char *where,
+                 std::string *errors);
+
+public:
+  catalog();
+  ~catalog();
+
+  catalog(const catalog&) = delete;
+  catalog& operator=(const catalog&) = delete;
+
+  // Load the file at 'path', or the catalog text 'text', replacing
+  // the current contents.  Returns true on success.  On failure, the
+  // contents are unchanged, and if 'errors' is not null, a line
+  // describing each problem found is appended to it.
+  bool load(const char *path, std::string *errors = 0) noexcept;
+  bool load(format_string text, std::string *errors = 0) noexcept;
+
+  // The ID of the message named 'name'.  IDs are assigned on first
+  // use, whether or not the current contents define the name.
+  size_t id(const char *name);
+
+  // The pattern for message 'id'.  If the current contents do not
+  // define it, this is a pattern which formats as an [unknown message]
+  // marker.  The pattern remains valid as long as the returned pointer
+  // is kept, even if the catalog is reloaded meanwhile.
+  std::shared_ptr<const pattern> get(size_t id) const noexcept;
+
+  template <typename... XS> std::string
+  format(size_t id, XS&&... xs) const
+  {
+    return fmt::format(*get(id), xs...);
+  }
+};
+
+//
+// Deferred formatting.  deferred::capture records the format string
+// pointer, errno, and a compact binary copy of the arguments (reduced
+// to their base categories; strings are copied), which is much
+// cheaper than formatting them; deferred::render does the formatting
+// later, perhaps on another thread.  The format string itself is not
+// copied, so it must outlive the record: normally it is a literal.
+//
+
+namespace detail {
+
+struct deferred_header
+{
+  const char *msg;      // null for padding (see deferred_ring)
+  size_t size;          // of the whole record, in bytes
+  int saved_errno;
+  unsigned int nargs;
+};
+
+// Each argument is recorded as a tag naming its base category,
+// followed by its value; strings are recorded as their length, then
+// their bytes and a terminating NUL.  A range is recorded as 'j', its
+// separator (as a string), its elements, and 'e'.
+class deferred_writer : private format_adapters<deferred_writer>
+{
+  friend class format_adapters<deferred_writer>;
+
+  char *start;
+  char *p;
+  char *end;
+  deferred_header header;
+
+  void put(const void *v, size_t n) noexcept
+  {
+    if (!p || n > size_t(end - p)) {
+      p = end = 0;  // out of room
+      return;
+    }
+    std::memcpy(p, v, n);
+    p += n;
+  }
+
+  template <typename T>
+  void put_arg(char tag, T v) noexcept
+  {
+    put(&tag, 1);
+    put(&v, sizeof v);
+  }
+
+  void put_str(const char *s, size_t len) noexcept
+  {
+    put_arg('s', len);
+    put(s, len);
+    put("", 1);
+  }
+
+  // Base format categories.
+  void format_sub(size_t, unsigned char v) noexcept { put_arg('c', v); }
+  void format_sub(size_t, long long v) noexcept { put_arg('d', v); }
+  void format_sub(size_t, unsigned long long v) noexcept { put_arg('u', v); }
+  void format_sub(size_t, double v) noexcept { put_arg('f', v); }
+  void format_sub(size_t, const void *v) noexcept { put_arg('p', v); }
+  void format_sub(size_t, const char *v) noexcept
+  { put_str(v, std::strlen(v)); }
+  void format_sub(size_t, const std::string &v) noexcept
+  { put_str(v.data(), v.size()); }
+  using format_adapters<deferred_writer>::format_sub;
+
+  void format_exc(size_t n) noexcept;
+
+  void join_begin(size_t, const char *sep) noexcept
+  {
+    put("j", 1);
+    put_str(sep, std::strlen(sep));
+  }
+  void join_sep(size_t, const char *) noexcept {}
+  void join_end(size_t) noexcept { put("e", 1); }
+
+public:
+  deferred_writer(void *buf, size_t len, const char *msg, size_t nargs)
+    noexcept
+    : start(static_cast<char *>(buf)), p(start), end(start + len)
+  {
+    header.saved_errno = errno;
+    header.msg = msg;
+    header.size = 0;
+    header.nargs = nargs;
+    put(&header, sizeof header);
+  }
+
+  using format_adapters<deferred_writer>::format_subs;
+
+  // Returns the size of the record, or 0 if it didn't fit.
+  size_t finish() noexcept
+  {
+    if (!p)
+      return 0;
+    header.size = p - start;
+    std::memcpy(start, &header, sizeof header);
+    return header.size;
+  }
+};
+
+} // namespace detail
+
+class deferred
+{
+public:
+  // Record a call to format(msg, xs...) in the 'len' bytes at 'buf'.
+  // Returns the size of the record, or 0 if it didn't fit.
+  template <typename... XS> static size_t
+  capture(void *buf, size_t len, const char *msg, XS&&... xs) noexcept
+  {
+    detail::deferred_writer w(buf, len, msg, sizeof...(xs));
+    w.format_subs(0, xs...);
+    return w.finish();
+  }
+
+  // The size of the record at 'rec'.
+  static size_t size(const void *rec) noexcept
+  {
+    detail::deferred_header header;
+    std::memcpy(&header, rec, sizeof header);
+    return header.size;
+  }
+
+  // Format the record at 'rec'.
+  static std::string render(const void *rec) noexcept;
+
+private:
+  static void render_arg(formatter& state, size_t i, const char *&p)
+    noexcept;
+};
+
+// A lock-free ring buffer of deferred records, for one producer
+// thread and one consumer thread: for instance, threads which log by
+// pushing records, and a logging thread which pops them.
+class deferred_ring
+{
+  char *buf;
+  size_t mask;
+  std::atomic<size_t> head;     // bytes ever pushed; set by the producer
+  char pad[64];                 // keep 'head' and 'tail' on separate lines
+  std::atomic<size_t> tail;     // bytes ever popped; set by the consumer
+
+  void skip(size_t off, size_t len) noexcept;
+
+public:
+  // The capacity is in bytes, and is rounded up to a power of two.
+  explicit deferred_ring(size_t capacity);
+  ~deferred_ring();
+
+  deferred_ring(const deferred_ring&) = delete;
+  deferred_ring& operator=(const deferred_ring&) = delete;
+
+  // Producer side.  Record a call to format(msg, xs...).  Returns
+  // false, recording nothing, if the ring is too full.
+  template <typename... XS> bool
+  push(const char *msg, XS&&... xs) noexcept
+  {
+    size_t h = head.load(std::memory_order_relaxed);
+    size_t room = mask + 1 - (h - tail.load(std::memory_order_acquire));
+    size_t off = h & mask;
+    size_t contig = mask + 1 - off;
+    size_t n;
+    if (room <= contig)
+      n = deferred::capture(buf + off, room, msg, xs...);
+    else if (!(n = deferred::capture(buf + off, contig, msg, xs...))) {
+      // Records are never split, so wrap around to the start.
+      skip(off, contig);
+      h += contig;
+      n = deferred::capture(buf, room - contig, msg, xs...);
+    }
+    if (!n)
+      return false;
+    head.store(h + n, std::memory_order_release);
+    return true;
+  }
+
+  // Consumer side.  Format the oldest record into 'out', and discard
+  // it.  Returns false if the ring is empty.
+  bool pop(std::string& out) noexcept;
+};
+
 } // namespace fmt
 
+#ifdef CXXFMT_HEADER_ONLY
+#include "fmt.cc"
+#endif
+
 #endif // fmt.h
 
 // Local Variables:
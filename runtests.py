@@ -15,15 +15,28 @@
 # Currently does not know how to invoke compilers that don't conform
 # to the Unix "cc" command line convention (most significantly, MSVC++)
 
+import argparse
+import concurrent.futures
 import configparser
 import contextlib
+import copy
+import ctypes
+import ctypes.util
 import errno
+import hashlib
 import json
+import math
 import os
 import os.path
+import re
+import select
+import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 #
 # Utility functions
@@ -56,6 +69,106 @@ def mkstemp_autodel(suffix="", prefix="tmp", dir=None, text=False,
                     raise
 
 
+def cache_dir(*subdirs):
+    """Return the name of the directory in which results that can be
+       reused across runs, and across source trees, are kept; create
+       it if necessary.  This is $CXXFMT_CACHE_DIR if set, otherwise
+       a 'cxxfmt' directory under the XDG cache directory.  Any
+       'subdirs' are appended to the name.  Returns None if caching
+       has been disabled by setting $CXXFMT_CACHE_DIR to the empty
+       string."""
+    base = os.environ.get("CXXFMT_CACHE_DIR")
+    if base is None:
+        base = os.environ.get("XDG_CACHE_HOME")
+        if not base:
+            base = os.path.join(os.path.expanduser("~"), ".cache")
+        base = os.path.join(base, "cxxfmt")
+    elif base == "":
+        return None
+
+    d = os.path.join(base, *subdirs)
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def replace_file(fname, contents):
+    """Atomically replace the contents of 'fname' with 'contents'
+       (a str), so that concurrent readers never see a partial file."""
+    d = os.path.dirname(fname) or "."
+    (handle, tmpname) = tempfile.mkstemp(prefix=".tmp", dir=d)
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write(contents)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def call_with_usage(argv, **kwargs):
+    """Run 'argv' as subprocess.call would, passing along 'kwargs'.
+       Returns a tuple of its exit status (negative if killed by a
+       signal), the elapsed wall-clock time in seconds, and its
+       resource usage as reported by os.wait4.  On Linux, this
+       includes the peak memory use of any processes it waited for,
+       such as the compiler proper under a driver program."""
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, **kwargs)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return (proc.returncode, wall, usage)
+
+
+def section_sizes(fname):
+    """Return a dictionary giving the total size of 'fname' and the
+       sizes of its text, data, and bss sections, so far as they can
+       be determined."""
+    sizes = {"size": os.path.getsize(fname)}
+    if shutil.which("size"):
+        try:
+            out = subprocess.check_output(["size", fname],
+                                          stderr=subprocess.DEVNULL,
+                                          encoding="utf-8")
+            text, data, bss = out.splitlines()[1].split()[:3]
+            sizes.update(text=int(text), data=int(data), bss=int(bss))
+        except (OSError, subprocess.CalledProcessError, ValueError,
+                IndexError):
+            pass
+    return sizes
+
+
+def template_footprint(fname,
+                       pattern=r"fmt::detail::format_adapters<[\w:]+>"
+                               r"::format_subs?\b"):
+    """Return the number and total size of the out-of-line function
+       definitions in object file 'fname' whose demangled names match
+       'pattern' (by default, instantiations of the format_sub and
+       format_subs adapter templates, for every sink), or None if that
+       cannot be determined."""
+    if not shutil.which("nm"):
+        return None
+    try:
+        out = subprocess.check_output(["nm", "-C", "-S", "--defined-only",
+                                       fname],
+                                      stderr=subprocess.DEVNULL,
+                                      encoding="utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    count = 0
+    total = 0
+    for line in out.splitlines():
+        fields = line.split(None, 3)
+        if (len(fields) == 4 and fields[2] in "TtWw"
+                and re.search(pattern, fields[3])):
+            count += 1
+            total += int(fields[1], 16)
+    return {"count": count, "bytes": total}
+
+
 # credit to stackoverflow user 'Obtuse':
 # http://stackoverflow.com/a/6849299/388520
 class lazy_property(object):
@@ -78,18 +191,51 @@ class lazy_property(object):
 #
 # Compiler invocation
 #
+
+# Build profiles; see CompilerTraits.profile_flags.
+PROFILES = ("O2", "O3", "native", "lto", "pgo", "header", "noexc")
+
 class CompilerTraits(object):
     """Interface for traits classes that describe the peculiarities of
        a particular family of compilers."""
 
-    def compile_cmd(self, src, obj):
+    def compile_cmd(self, src, obj, opt=None):
         """Return an argument vector which will compile source file
-           'src' into object file 'obj'."""
+           'src' into object file 'obj'.  'opt', if not None, is a
+           list of optimization flags (see profile_flags()) to use
+           instead of the defaults."""
         raise NotImplementedError
 
-    def link_cmd(self, objs, libs, exe):
+    def preprocess_cmd(self, src, opt=None):
+        """Return an argument vector which will write the preprocessed
+           form of source file 'src' to standard output, under the
+           same conditions as compile_cmd()."""
+        raise NotImplementedError
+
+    def link_cmd(self, objs, libs, exe, opt=None):
         """Return an argument vector which will link object files OBJS
-           and libraries LIBS to produce executable EXE."""
+           and libraries LIBS to produce executable EXE, with the
+           optimization flags 'opt' if not None."""
+        raise NotImplementedError
+
+    def thread_libs(self):
+        """Return the extra link arguments needed by a program which
+           uses std::thread."""
+        raise NotImplementedError
+
+    def profile_flags(self, profile, stage=None, data=None):
+        """Return the optimization flags for the build profile named
+           'profile' (one of PROFILES).  For the "pgo" profile,
+           'stage' is "generate" for the instrumented build or "use"
+           for the optimized build, and 'data' is the directory in
+           which the profile data is kept."""
+        raise NotImplementedError
+
+    def pgo_merge(self, cc, data, verbose):
+        """Prepare the profile data written to directory 'data' by
+           programs built by compiler 'cc' in the "generate" stage
+           for use by the "use" stage.  Returns True on success,
+           False on failure."""
         raise NotImplementedError
 
     def version_cmd(self):
@@ -97,6 +243,25 @@ class CompilerTraits(object):
            identify itself."""
         raise NotImplementedError
 
+    def target_cmd(self, opt):
+        """Return an argument vector which will cause the compiler to
+           describe, on standard output or standard error, the target
+           it generates code for given the optimization flags 'opt'.
+           This is what distinguishes one host's "-march=native" from
+           another's."""
+        raise NotImplementedError
+
+    def time_trace_flags(self):
+        """Return additional arguments for compile_cmd() which cause
+           the compiler to report where it spent its time."""
+        raise NotImplementedError
+
+    def time_trace_report(self, obj, stderr):
+        """Digest the report produced by time_trace_flags() when
+           compiling 'obj', given the compiler's error output 'stderr'.
+           Returns a dictionary."""
+        raise NotImplementedError
+
     def probe_flags(self):
         """Generate a sequence of possible additional command line
            arguments to try with this compiler.  Each list entry
@@ -108,15 +273,53 @@ class CompilerTraits(object):
 class CT_Unix(CompilerTraits):
     """A compiler whose command line conforms to Unixy conventions."""
 
-    def compile_cmd(self, src, obj):
-        return ["-I.", "-O2", "-o", obj, "-c", src]
+    profiles = {
+        "O2": ["-O2"],
+        "O3": ["-O3"],
+        "native": ["-O3", "-march=native"],
+        "lto": ["-O3", "-flto"],
+        "pgo": ["-O3"],
+        # Header-only mode: everything is compiled into the program
+        # that includes fmt.h, and fmt.cc compiles to nothing.
+        "header": ["-O2", "-DCXXFMT_HEADER_ONLY"],
+        # Exception-free mode; see CXXFMT_NO_EXCEPTIONS in fmt.h.
+        "noexc": ["-O2", "-fno-exceptions"],
+        # Not for general use: see coverage_job().
+        "cover": ["-O2", "-fsanitize-coverage=trace-pc"],
+    }
+
+    def cflags(self, opt=None):
+        return ["-I."] + (["-O2"] if opt is None else opt)
+
+    def compile_cmd(self, src, obj, opt=None):
+        return self.cflags(opt) + ["-o", obj, "-c", src]
+
+    def preprocess_cmd(self, src, opt=None):
+        return self.cflags(opt) + ["-E", src]
 
-    def link_cmd(self, objs, libs, exe):
-        return ["-o", exe] + objs + libs
+    def link_cmd(self, objs, libs, exe, opt=None):
+        return (opt or []) + ["-o", exe] + objs + libs
+
+    def thread_libs(self):
+        return ["-pthread"]
 
     def version_cmd(self):
         return ["--version"]
 
+    def profile_flags(self, profile, stage=None, data=None):
+        flags = list(self.profiles[profile])
+        if stage == "generate":
+            flags.append("-fprofile-generate=" + data)
+        elif stage == "use":
+            flags.extend(self.pgo_use_flags(data))
+        return flags
+
+    def pgo_use_flags(self, data):
+        return ["-fprofile-use=" + data]
+
+    def pgo_merge(self, cc, data, verbose):
+        return True
+
 
 class CT_Gcc(CT_Unix):
     """GNU Compiler Collection."""
@@ -126,6 +329,28 @@ class CT_Gcc(CT_Unix):
             (["-std=c++11"], [])
         ]
 
+    def time_trace_flags(self):
+        return ["-ftime-report"]
+
+    def target_cmd(self, opt):
+        return opt + ["-Q", "--help=target"]
+
+    _time_report_re = re.compile(r"""^\s*(\S.*?)\s*:
+                                     \s*[0-9.]+\s*\(\s*[0-9]+%\)
+                                     \s*[0-9.]+\s*\(\s*[0-9]+%\)
+                                     \s*([0-9.]+)\s*\(""", re.VERBOSE)
+
+    def time_trace_report(self, obj, stderr):
+        # GCC only reports time per compiler phase, so the cost of
+        # the adapter templates cannot be separated from that of
+        # template instantiation in general.
+        phases = {}
+        for line in stderr.splitlines():
+            m = self._time_report_re.match(line)
+            if m:
+                phases[m.group(1)] = float(m.group(2))
+        return {"phases": phases}
+
 
 class CT_Clang(CT_Unix):
     """LLVM compilers."""
@@ -137,11 +362,87 @@ class CT_Clang(CT_Unix):
             (["-std=c++11", "-stdlib=libc++"], [])
         ]
 
+    def time_trace_flags(self):
+        return ["-ftime-trace"]
+
+    # Clang has no equivalent of GCC's --help=target, but the
+    # commands its driver would run include the resolved target CPU
+    # and features.
+    def target_cmd(self, opt):
+        return opt + ["-###", "-x", "c++", "-c", "-o", os.devnull,
+                      os.devnull]
+
+    # Clang writes raw profiles which must be merged with a version of
+    # llvm-profdata that matches the compiler.
+    def pgo_use_flags(self, data):
+        return ["-fprofile-use=" + os.path.join(data, "default.profdata")]
+
+    def pgo_merge(self, cc, data, verbose):
+        ccdir = os.path.dirname(os.path.realpath(shutil.which(cc.prog)
+                                                 or cc.prog))
+        for tool in (os.path.join(ccdir, "llvm-profdata"),
+                     "llvm-profdata-{}".format(cc.ccmaj),
+                     "llvm-profdata"):
+            tool = shutil.which(tool)
+            if tool:
+                break
+        else:
+            if verbose >= 1:
+                sys.stderr.write("{}: cannot find llvm-profdata\n"
+                                 .format(cc.prog))
+            return False
+
+        raws = [os.path.join(data, f) for f in sorted(os.listdir(data))
+                if f.endswith(".profraw")]
+        argv = [tool, "merge", "-o",
+                os.path.join(data, "default.profdata")] + raws
+        if verbose == 2:
+            sys.stderr.write(" ".join(argv) + "\n")
+        return subprocess.call(argv) == 0
+
+    def time_trace_report(self, obj, stderr):
+        # -ftime-trace writes a Chrome trace next to the object file.
+        # Instantiations nest, so merge overlapping events rather
+        # than summing them.
+        with open(os.path.splitext(obj)[0] + ".json") as f:
+            events = json.load(f)["traceEvents"]
+
+        totals = {}
+        spans = []
+        for e in events:
+            if e.get("ph") != "X":
+                continue
+            name = e["name"]
+            if name.startswith("Total "):
+                totals[name[6:]] = e["dur"] / 1e6
+            elif (name in ("InstantiateFunction", "InstantiateClass")
+                  and re.search(r"\bformat_subs?\b",
+                                e.get("args", {}).get("detail", ""))):
+                spans.append((e["ts"], e["ts"] + e["dur"]))
+
+        adapters = 0
+        end = None
+        for start, stop in sorted(spans):
+            if end is None or start > end:
+                adapters += stop - start
+                end = stop
+            elif stop > end:
+                adapters += stop - end
+                end = stop
+        return {"totals": totals, "format_sub_instantiation": adapters / 1e6}
+
 
 class Compiler(object):
     """A particular compiler installed on this computer, which can be
        invoked to compile and link programs"""
 
+    # Build profile settings; see with_profile().  These are class
+    # attributes so that save() does not record them.
+    profile = None
+    pgo_stage = None
+    pgo_data = None
+    pgo_job = None
+
     def __init__(self, prog, flags, libs, props, traits):
         """Constructor for Compiler instances.  'prog' is the compiler
            executable.  'flags' are extra command line arguments to
@@ -161,6 +462,38 @@ class Compiler(object):
         for k, v in props.items():
             setattr(self, k, v)
 
+    def with_profile(self, profile, stage=None, data=None, job=None):
+        """Return a copy of this compiler which builds with the build
+           profile named 'profile' (see CompilerTraits.profile_flags,
+           which also explains 'stage' and 'data').  For the "use"
+           stage, 'job' is the job which trains the instrumented
+           program; every compilation depends on it.  The copy's tag,
+           and the names of the files it produces, are suffixed with
+           the profile name.  The default profile, "O2", builds
+           exactly as this compiler does, so this compiler is
+           returned unchanged."""
+        if profile == "O2":
+            return self
+        cc = copy.copy(self)
+        cc.profile = profile
+        cc.pgo_stage = stage
+        cc.pgo_data = data
+        cc.pgo_job = job
+        cc.tag = self.tag + "+" + profile
+        root, ext = os.path.splitext(self.otag)
+        cc.otag = root + "+" + profile + ext
+        root, ext = os.path.splitext(self.etag)
+        cc.etag = root + "+" + profile + ext
+        return cc
+
+    def opt_flags(self):
+        """Return the optimization flags for this compiler's build
+           profile, or None to use the defaults."""
+        if self.profile is None:
+            return None
+        return self.traits.profile_flags(self.profile, self.pgo_stage,
+                                         self.pgo_data)
+
     def objname(self, src):
         """Return an appropriately labeled name for an object file
            compiled from source file 'src' with this compiler."""
@@ -171,22 +504,69 @@ class Compiler(object):
            compiler, beginning with 'base'."""
         return os.path.splitext(base)[0] + self.etag
 
-    def compile(self, src, verbose=1):
+    def compile(self, src, verbose=1, cache=None, stats=None,
+                time_trace=False):
         """Compile source file 'src'.  The object file will be named
            self.objname(src).  Returns True on success, False on failure.
-           'verbose' is passed through to invoke()."""
+           'verbose' is passed through to invoke().  If 'cache' is not
+           None, it is an ObjectCache which is consulted before
+           compiling, and updated afterward.
+
+           If 'stats' is not None, it should be a dictionary; the cost
+           of the compilation and the size of the object file are
+           recorded in it, and the cache is not used.  If 'time_trace'
+           is also true, the compiler's own report of where it spent
+           its time is recorded under 'time_trace'."""
         obj = self.objname(src)
-        return self.invoke(self.traits.compile_cmd(src, obj),
-                           obj, verbose)
+        args = self.traits.compile_cmd(src, obj, self.opt_flags())
+        if stats is not None:
+            if time_trace:
+                args = self.traits.time_trace_flags() + args
+            if not self.invoke(args, obj, verbose, stats):
+                return False
+            stderr = stats.pop("stderr")
+            stats.update(section_sizes(obj))
+            stats["format_sub"] = template_footprint(obj)
+            if time_trace:
+                stats["time_trace"] = \
+                    self.traits.time_trace_report(obj, stderr)
+            return True
+
+        # Instrumented objects embed the name of their profile data
+        # file, which is derived from the object file name, and the
+        # cache key does not cover the profile data itself.
+        if cache is None or self.pgo_stage is not None:
+            return self.invoke(args, obj, verbose)
+
+        key = cache.key(self, src, args, obj)
+        if key is not None and cache.fetch(key, obj):
+            if verbose >= 1:
+                sys.stderr.write("{} {}...ok (cached)\n"
+                                 .format(self.prog, obj))
+            return True
+        if not self.invoke(args, obj, verbose):
+            return False
+        if key is not None:
+            cache.store(key, obj)
+        return True
 
-    def link(self, objs, exe, verbose=1):
-        """Link 'objs' (a list of object file names) together.  The
-           resulting executable will be named self.exename(exe).
+    def link(self, objs, exe, verbose=1, stats=None, libs=[]):
+        """Link 'objs' (a list of object file names) together, with
+           'libs' in addition to the usual libraries.  The resulting
+           executable will be named self.exename(exe).
            Returns True on success, False on failure.
-           'verbose' is passed through to invoke()."""
+           'verbose' is passed through to invoke().  If 'stats' is
+           not None, the cost of linking and the size of the
+           executable are recorded in it."""
         exe = self.exename(exe)
-        return self.invoke(self.traits.link_cmd(objs, self.libs, exe),
-                           exe, verbose)
+        if not self.invoke(self.traits.link_cmd(objs, self.libs + libs, exe,
+                                                self.opt_flags()),
+                           exe, verbose, stats):
+            return False
+        if stats is not None:
+            del stats["stderr"]
+            stats.update(section_sizes(exe))
+        return True
 
     @lazy_property
     def DEVNULL(_):
@@ -206,7 +586,7 @@ class Compiler(object):
             except AttributeError:
                 return os.open(os.devnull, os.O_RDWR)
 
-    def invoke(self, args, label, verbose):
+    def invoke(self, args, label, verbose, stats=None):
         """Invoke this compiler, passing 'args' on the command line.
            'verbose' says how much to report about this invocation.
            It takes one of the following numeric values:
@@ -214,6 +594,10 @@ class Compiler(object):
               1: report success or failure.
               2: print full command line and error messages.
            'label' is used when verbose=1 to describe this invocation.
+           If 'stats' is not None, it should be a dictionary, in which
+           the wall-clock time, CPU time, and peak memory use (in
+           kilobytes) of the compiler are recorded, along with its
+           error output (as 'stderr').
            Returns True for a successful compilation, False otherwise.
         """
         if verbose < 0 or verbose > 2:
@@ -222,14 +606,32 @@ class Compiler(object):
         argv = [self.prog] + self.flags + args
         if verbose == 2:
             sys.stderr.write(" ".join(argv) + "\n")
-            rv = subprocess.call(argv, stdin=self.DEVNULL)
+            output = None
         else:
             if verbose == 1:
                 sys.stderr.write("{} {}...".format(argv[0], label))
+            output = self.DEVNULL
+
+        if stats is None:
             rv = subprocess.call(argv,
                                  stdin=self.DEVNULL,
-                                 stdout=self.DEVNULL,
-                                 stderr=self.DEVNULL)
+                                 stdout=output,
+                                 stderr=output)
+        else:
+            with tempfile.TemporaryFile() as errf:
+                rv, wall, usage = call_with_usage(argv,
+                                                  stdin=self.DEVNULL,
+                                                  stdout=output,
+                                                  stderr=errf)
+                errf.seek(0)
+                stderr = errf.read().decode("utf-8", "replace")
+            if verbose == 2:
+                sys.stderr.write(stderr)
+            stats.update(wall=wall,
+                         user=usage.ru_utime,
+                         sys=usage.ru_stime,
+                         maxrss_kb=usage.ru_maxrss,
+                         stderr=stderr)
         if rv == 0:
             if verbose == 1:
                 sys.stderr.write("ok\n")
@@ -369,9 +771,13 @@ int main()
         """Subroutine of 'probe_compilers' (below).  Find out which version of
            which compiler 'prog' is, and which C++ runtime library it
            offers, when invoked with 'extra_args'.  'prog' should be
-           an absolute pathname to an executable."""
+           an absolute pathname to an executable.
+
+           This may be called from several threads at once, so progress
+           messages are accumulated and written out in one piece."""
 
         source = cls.identify_source()
+        msg = ""
         with mkstemp_autodel(suffix=".exe", prefix="id-") as exe:
             try:
                 # This is how g++ and clang++ want to be invoked.
@@ -382,8 +788,7 @@ int main()
                 else:
                     cc_stderr = cls.DEVNULL
                     if verbose == 1:
-                        sys.stderr.write("probe " + " ".join(argv[:-3])
-                                         + "...")
+                        msg = "probe " + " ".join(argv[:-3]) + "..."
                 subprocess.check_call(argv,
                                       stdin=cls.DEVNULL,
                                       stdout=cls.DEVNULL,
@@ -398,13 +803,9 @@ int main()
                 # so it can wait.
                 if verbose >= 1:
                     if e.returncode < 0:
-                        sys.stderr.write("{} signal {}\n".format(
-                            e.cmd[0], -e.returncode
-                        ))
+                        msg += "{} signal {}\n".format(e.cmd[0], -e.returncode)
                     else:
-                        sys.stderr.write("{} exit {}\n".format(
-                            e.cmd[0], e.returncode
-                        ))
+                        msg += "{} exit {}\n".format(e.cmd[0], e.returncode)
 
                 output = """{ "cxx11" : 0,
                               "cc"    : "unknown",
@@ -430,11 +831,13 @@ int main()
         props["etag"] = etag
 
         if verbose >= 1 and not fail:
-            sys.stderr.write(tag)
+            msg += tag
             if props["cxx11"] == 1:
-                sys.stderr.write(" (ok)\n")
+                msg += " (ok)\n"
             else:
-                sys.stderr.write(" (not C++11)\n")
+                msg += " (not C++11)\n"
+        if msg:
+            sys.stderr.write(msg)
         return props
 
     @classmethod
@@ -445,7 +848,7 @@ int main()
             output = subprocess.check_output([prog] + CT_Unix().version_cmd(),
                                              stderr=cls.DEVNULL,
                                              encoding="utf-8")
-        except subprocess.CalledProcessError:
+        except (OSError, subprocess.CalledProcessError):
             return None
 
         output = output.lower()
@@ -457,24 +860,321 @@ int main()
             return None
 
     @classmethod
-    def probe_compilers(cls, progs, verbose=0):
+    def probe_compilers(cls, progs, verbose=0, cache=None, trace=None):
+        """Identify each of the compilers named in 'progs', and
+           return a list of Compiler objects for every usable
+           combination of compiler and 'probe_flags'.  If 'cache'
+           is not None, it is a ProbeCache consulted for results
+           from previous runs, and updated with the results of any
+           new probes.  Probes not satisfied from the cache are run
+           concurrently.  If 'trace' is not None, it is a Trace to
+           which each probe adds a record of its run."""
+        if cache is None:
+            cache = ProbeCache(None)
+
+        def identify(prog, args):
+            start = time.monotonic()
+            props = cls.identify(prog, args, verbose)
+            if trace is not None:
+                trace.add("probe " + " ".join([prog] + args), "probe",
+                          start, time.monotonic(),
+                          lane=threading.current_thread().name,
+                          tag=props["tag"], cxx11=props["cxx11"])
+            return props
+
+        # Make sure the identification program exists before any
+        # threads go looking for it.
+        cls.identify_source()
+
+        # Several names may lead to the same cache entry, so the
+        # lookups are done serially, and each entry is worked on
+        # once; only the probes themselves need the pool.
+        progs = sorted(set(progs))
+        entries = [cache.lookup(prog) for prog in progs]
+        unique = list({id(entry): entry for entry in entries}.values())
+        with concurrent.futures.ThreadPoolExecutor(
+                thread_name_prefix="probe") as pool:
+
+            def pick_traits_if_needed(entry):
+                if "traits" not in entry and entry["path"] is not None:
+                    traits = cls.pick_traits(entry["invoked"])
+                    entry["traits"] = (None if traits is None
+                                       else traits.__class__.__name__)
+
+            list(pool.map(pick_traits_if_needed, unique))
+
+            pending = []
+            submitted = set()
+            for prog, entry in zip(progs, entries):
+                if entry["traits"] is None:
+                    if verbose >= 1 and entry["path"] is None:
+                        sys.stderr.write("cannot find " + prog + "\n")
+                    elif verbose >= 1:
+                        sys.stderr.write("no known traits for " + prog + "\n")
+                    continue
+                traits = globals()[entry["traits"]]()
+                for flags, libs in traits.probe_flags():
+                    key = json.dumps([flags, libs])
+                    if (key not in entry["probes"]
+                            and (id(entry), key) not in submitted):
+                        submitted.add((id(entry), key))
+                        pending.append((entry, key, pool.submit(
+                            identify, prog, flags + libs)))
+
+            fresh = set()
+            for entry, key, future in pending:
+                entry["probes"][key] = future.result()
+                fresh.add((id(entry), key))
+
         compilers = []
-        for prog in progs:
-            traits = cls.pick_traits(prog)
-            if traits is None:
-                if verbose >= 1:
-                    sys.stderr.write("no known traits for " + prog + "\n")
+        for prog, entry in zip(progs, entries):
+            if entry["traits"] is None:
                 continue
-
+            traits = globals()[entry["traits"]]()
             for flags, libs in traits.probe_flags():
-                props = cls.identify(prog, flags + libs, verbose)
+                key = json.dumps([flags, libs])
+                props = entry["probes"][key]
+                if verbose >= 1 and (id(entry), key) not in fresh:
+                    sys.stderr.write("probe {}...{} (cached)\n".format(
+                        " ".join([prog] + flags + libs), props["tag"]))
                 if props["cxx11"] == 1:
                     compilers.append(cls(prog, flags, libs, props, traits))
 
+        cache.save()
         return compilers
 
 
-def find_compilers(candidates, verbose):
+class ProbeCache(object):
+    """Persistent record of the results of probing compilers, so that
+       toolchains which have not changed are never re-probed, even in
+       a fresh checkout.  Results are keyed by the name the compiler
+       is invoked by (as found on $PATH) together with the executable
+       it resolves to, since one executable may behave differently
+       depending on its name (clang and clang++, or every compiler
+       under ccache masquerade); each entry is valid only while the
+       executable's size, modification time, and SHA-256 hash are
+       unchanged.  Failed probes are saved as well; since they may
+       depend on libraries installed later rather than on the
+       compiler, 'refresh' discards everything saved, so that every
+       compiler is probed afresh.
+
+       If 'fname' is None, nothing is loaded or saved."""
+
+    def __init__(self, fname, refresh=False):
+        self.fname = fname
+        self.entries = {}
+        self.identities = {}
+        if fname is not None and not refresh:
+            try:
+                with open(fname) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def identity(path):
+        """Return a dictionary identifying the executable 'path'."""
+        st = os.stat(path)
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                h.update(block)
+        return {
+            "path": path,
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "sha256": h.hexdigest()
+        }
+
+    def lookup(self, prog):
+        """Return the cache entry for the compiler named 'prog',
+           creating a fresh one if there was none or it was stale.
+           An entry has the keys of identity(), plus 'probes', which
+           maps JSON-encoded [flags, libs] pairs to the properties
+           returned by Compiler.identify, plus 'traits' (the traits
+           class name, or None if the compiler is unusable) once
+           that has been determined.  If 'prog' cannot be found at
+           all, 'path' and 'traits' will be None."""
+        invoked = shutil.which(prog)
+        if invoked is None:
+            return {"path": None, "traits": None, "probes": {}}
+        invoked = os.path.abspath(invoked)
+        path = os.path.realpath(invoked)
+        ident = self.identities.get(path)
+        if ident is None:
+            ident = self.identities[path] = self.identity(path)
+
+        key = json.dumps([invoked, path])
+        entry = self.entries.get(key)
+        if entry is None or any(entry.get(k) != v for k, v in ident.items()):
+            entry = dict(ident, invoked=invoked, probes={})
+            self.entries[key] = entry
+        return entry
+
+    def save(self):
+        if self.fname is not None:
+            replace_file(self.fname, json.dumps(self.entries, indent=2,
+                                                sort_keys=True))
+
+
+class ObjectCache(object):
+    """Cache of compiled object files, in the manner of ccache.  The
+       cache key for an object file is a hash of the preprocessed
+       translation unit, the identity of the compiler (its 'tag',
+       'ccver', and 'lib'), and the complete command line used to
+       compile it; if the command line asks for code tuned to the host
+       ("-march=native" and the like), the compiler's description of
+       what that means on this host is included as well.  Objects are
+       stored as files in 'dirname'; whenever the total size exceeds
+       'max_size' bytes, the least recently used objects are discarded
+       until it is back under 90% of that.  The directory is only
+       scanned for its total size once per run, and again when
+       objects must be discarded; in between, the total is kept up to
+       date as objects are stored."""
+
+    def __init__(self, dirname, max_size):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+        self.targets = {}
+
+    def key(self, cc, src, args, obj):
+        """Compute the cache key for compiling 'src' into 'obj' with
+           compiler 'cc' and command line arguments 'args'.  Returns
+           None if the source file cannot be preprocessed; the real
+           compilation will then report the problem."""
+        try:
+            pre = subprocess.check_output(
+                [cc.prog] + cc.flags
+                + cc.traits.preprocess_cmd(src, cc.opt_flags()),
+                stdin=cc.DEVNULL, stderr=cc.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        target = b""
+        if any(a.endswith("=native") for a in args):
+            target = self.target(cc)
+            if target is None:
+                return None
+
+        # The object file name does not affect the contents of the
+        # object file, so leave it out.
+        cmd = [cc.prog] + cc.flags + ["<obj>" if a == obj else a
+                                      for a in args]
+        h = hashlib.sha256()
+        h.update(json.dumps([cc.tag, cc.ccver, cc.lib, cmd]).encode("utf-8"))
+        h.update(b"\0")
+        h.update(target)
+        h.update(b"\0")
+        h.update(pre)
+        return h.hexdigest()
+
+    def target(self, cc):
+        """Return the compiler's description of the target selected
+           by the optimization flags of 'cc' on this host, or None if
+           it cannot be obtained.  Computed once per run for each
+           compiler and set of flags."""
+        cmd = [cc.prog] + cc.flags + cc.traits.target_cmd(cc.opt_flags())
+        tkey = json.dumps(cmd)
+        with self.lock:
+            if tkey in self.targets:
+                return self.targets[tkey]
+        try:
+            target = subprocess.run(cmd, stdin=cc.DEVNULL,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            target = None
+        with self.lock:
+            self.targets[tkey] = target
+        return target
+
+    def entry(self, key):
+        return os.path.join(self.dirname, key + ".o")
+
+    def fetch(self, key, obj):
+        """If there is a cached object for 'key', copy it to 'obj'
+           and return True; otherwise return False."""
+        ent = self.entry(key)
+        try:
+            shutil.copyfile(ent, obj)
+        except FileNotFoundError:
+            return False
+        # Mark the entry as recently used.
+        try:
+            os.utime(ent)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, obj):
+        """Record 'obj' as the object file for 'key'."""
+        ent = self.entry(key)
+        (handle, tmpname) = tempfile.mkstemp(prefix=".tmp", dir=self.dirname)
+        os.close(handle)
+        try:
+            shutil.copyfile(obj, tmpname)
+            size = os.stat(tmpname).st_size
+            try:
+                size -= os.stat(ent).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmpname, ent)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+        with self.lock:
+            if self.size is None:
+                self.evict()
+            else:
+                self.size += size
+                if self.size > self.max_size:
+                    self.evict()
+
+    def evict(self):
+        """Discard least recently used objects until the cache is
+           within its size limit, and record its total size.  Must be
+           called with self.lock held."""
+        entries = []
+        total = 0
+        with os.scandir(self.dirname) as it:
+            for de in it:
+                if de.name.endswith(".o") and de.is_file():
+                    st = de.stat()
+                    entries.append((st.st_mtime, st.st_size, de.path))
+                    total += st.st_size
+        self.size = total
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        target = self.max_size * 9 // 10
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+    @classmethod
+    def default(cls):
+        """Return an ObjectCache in the standard location, with the size
+           limit taken from $CXXFMT_CACHE_MAXSIZE (in megabytes,
+           default 512), or None if caching is disabled."""
+        cdir = cache_dir("objects")
+        if cdir is None:
+            return None
+        max_size = int(os.environ.get("CXXFMT_CACHE_MAXSIZE", "512"))
+        return cls(cdir, max_size * 1024 * 1024)
+
+
+def find_compilers(candidates, verbose, trace=None, reprobe=False):
     if len(candidates) == 0:
         candidates = ["g++", "clang++"]
     candidates = set(candidates)
@@ -486,7 +1186,10 @@ def find_compilers(candidates, verbose):
         for cc in compilers:
             candidates.discard(cc.prog)
 
-    compilers.extend(Compiler.probe_compilers(candidates, verbose))
+    cdir = cache_dir()
+    cache = ProbeCache(cdir and os.path.join(cdir, "probes.json"), reprobe)
+    compilers.extend(Compiler.probe_compilers(candidates, verbose, cache,
+                                              trace))
 
     if len(compilers) == 0:
         raise RuntimeError("no usable compilers identified")
@@ -494,6 +1197,120 @@ def find_compilers(candidates, verbose):
     return compilers
 
 
+#
+# Timing traces.
+#
+def cpu_time():
+    """Return the CPU time used so far by this process and all of its
+       finished children, in seconds."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Trace(object):
+    """Record of when each step of a test run started and finished,
+       which can be written out in the Chrome trace-event format (for
+       chrome://tracing or Perfetto).  Steps are assigned to 'lanes',
+       which appear as threads in the trace viewer.  Safe to use from
+       several threads at once."""
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.events = []
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, cat, start, end, lane="jobs", **args):
+        """Record a step named 'name', of category 'cat', which ran
+           from time 'start' to time 'end' (as returned by
+           time.monotonic) in lane 'lane'.  'args' are recorded with
+           the step, and shown by the trace viewer when it is
+           selected."""
+        with self.lock:
+            tid = self.lanes.setdefault(lane, len(self.lanes))
+            self.events.append({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": round((start - self.origin) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "args": args,
+            })
+
+    def write(self, fname):
+        """Write out the trace as JSON to 'fname'."""
+        with self.lock:
+            meta = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                     "args": {"name": lane}}
+                    for lane, tid in self.lanes.items()]
+            events = meta + self.events
+        replace_file(fname, json.dumps({"traceEvents": events,
+                                        "displayTimeUnit": "ms"},
+                                       indent=1) + "\n")
+
+
+def critical_path(job):
+    """Return the chain of jobs, ending with 'job', whose run times add
+       up to the longest total along any path through the dependency
+       graph: that is, the least time in which all of 'job' could be
+       done if independent jobs ran in parallel.  Returns a tuple of
+       that time and the list of jobs, dependencies first."""
+    memo = {}
+
+    def longest(j):
+        if id(j) not in memo:
+            best = (0, [])
+            for dep in j.deps:
+                cand = longest(dep)
+                if cand[0] > best[0]:
+                    best = cand
+            memo[id(j)] = (best[0] + j.elapsed, best[1] + [j])
+        return memo[id(j)]
+
+    return longest(job)
+
+
+def trace_summary(top, probe_time):
+    """Print a summary of the time taken by the jobs reachable from
+       'top': the critical path through them, and the total run time
+       of the jobs for each compiler.  'probe_time' is the time spent
+       identifying compilers, which precedes all jobs."""
+    total, chain = critical_path(top)
+    sys.stderr.write("\ncritical path: {:.2f} s (+ {:.2f} s probing)\n"
+                     .format(total, probe_time))
+    for job in chain:
+        if job.elapsed < 0.0005:
+            continue
+        line = "  {:8.3f} s  {}".format(job.elapsed, job.trace_name())
+        shard_times = getattr(job, "shard_times", None)
+        if shard_times:
+            slowest = max(range(len(shard_times)),
+                          key=shard_times.__getitem__)
+            line += " (slowest shard {}: {:.3f} s, mean {:.3f} s)".format(
+                slowest, shard_times[slowest],
+                sum(shard_times) / len(shard_times))
+        sys.stderr.write(line + "\n")
+
+    seen = set()
+    by_cc = {}
+    stack = [top]
+    while stack:
+        job = stack.pop()
+        if id(job) in seen:
+            continue
+        seen.add(id(job))
+        stack.extend(job.deps)
+        cc = getattr(job, "cc", None)
+        if cc is not None:
+            by_cc[cc.tag] = by_cc.get(cc.tag, 0) + job.elapsed
+    if by_cc:
+        sys.stderr.write("time by compiler:\n")
+        for tag, t in sorted(by_cc.items(), key=lambda kv: -kv[1]):
+            sys.stderr.write("  {:8.3f} s  {}\n".format(t, tag))
+
+
 #
 # Test jobs and their interdependencies.
 #
@@ -512,7 +1329,14 @@ class Job(object):
 
        A base Job object doesn't do anything when executed other than
        invoke all of its dependencies.  Subclasses can override the
-       run() method to do something."""
+       run() method to do something.
+
+       The time taken by run() is recorded as self.elapsed.  If
+       Job.trace is not None, it is a Trace, to which each job of a
+       subclass with a 'trace_cat' adds a record of its run."""
+
+    trace = None
+    trace_cat = None
 
     def __init__(self, verbose, deps, output=None):
         self.deps = deps
@@ -520,6 +1344,7 @@ class Job(object):
         self.verbose = verbose
         self.result = None  # not yet executed
         self.mtime_ = None  # not yet checked
+        self.elapsed = 0
 
     def update_mtime(self):
         if self.output is None:
@@ -562,14 +1387,53 @@ class Job(object):
             if dep_result is not True:
                 self.result = dep_result
                 return dep_result
+
+        start = time.monotonic()
+        cpu = cpu_time()
         self.result = self.run()
+        self.elapsed = time.monotonic() - start
+        if Job.trace is not None and self.trace_cat is not None:
+            Job.trace.add(self.trace_name(), self.trace_cat,
+                          start, start + self.elapsed,
+                          cpu=round(cpu_time() - cpu, 6),
+                          **self.trace_args())
+
         if self.result is True:
             self.update_mtime()
         return self.result
 
+    def reset(self, _seen=None):
+        """Forget whether this job and all of its dependencies have
+           been executed and when their outputs were last modified, so
+           that they can be executed again after some of the files
+           they depend on have changed."""
+        if _seen is None:
+            _seen = set()
+        if id(self) in _seen:
+            return
+        _seen.add(id(self))
+        self.result = None
+        self.mtime_ = None
+        self.elapsed = 0
+        for dep in self.deps:
+            dep.reset(_seen)
+
     def run(self):
         return True  # success
 
+    def trace_name(self):
+        """Return a short description of this job, for traces."""
+        return "{} {}".format(self.trace_cat or "job", self.output)
+
+    def trace_args(self):
+        """Return a dictionary of details of this job's run, for
+           traces."""
+        args = {"status": "ok" if self.result is True else "failed"}
+        cc = getattr(self, "cc", None)
+        if cc is not None:
+            args["compiler"] = cc.tag
+        return args
+
 
 class FileDep(Job):
     """Pseudo-job to model a dependency on a file that is not created
@@ -587,32 +1451,67 @@ class FileDep(Job):
 
 class CompileJob(Job):
     """Job to compile one source file with a specified compiler.
-       Dependencies have no particular significance."""
-    def __init__(self, verbose, deps, cc, src):
+       Dependencies have no particular significance.  If 'cache' is
+       not None, it is an ObjectCache to consult before compiling.
+
+       If 'measure' is true, the job always runs, and the cost of the
+       compilation is recorded in self.stats (see Compiler.compile,
+       which also explains 'time_trace').
+
+       Both stages of a profile-guided build write the same files, so
+       if 'cc' is building either stage, the job always runs, and the
+       "use" stage also depends on the training job."""
+    trace_cat = "compile"
+
+    def __init__(self, verbose, deps, cc, src, cache=None, measure=False,
+                 time_trace=False):
         self.cc = cc
         self.src = src
+        self.cache = cache
+        self.stats = {} if measure else None
+        self.time_trace = time_trace
+        if cc.pgo_job is not None:
+            deps = [cc.pgo_job] + deps
         Job.__init__(self, verbose, deps, output=cc.objname(src))
 
+    def uptodate(self):
+        if self.stats is not None or self.cc.pgo_stage is not None:
+            return False
+        return Job.uptodate(self)
+
     def run(self):
-        return self.cc.compile(self.src, self.verbose)
+        return self.cc.compile(self.src, self.verbose, self.cache,
+                               self.stats, self.time_trace)
 
 
 class LinkJob(Job):
-    """Job to link one or more object files with a specified compiler.
-       Each CompileJob in the dependencies contributes its object file
-       to the link."""
-    def __init__(self, verbose, deps, cc, exebase):
+    """Job to link one or more object files with a specified compiler,
+       and any extra 'libs'.  Each CompileJob in the dependencies
+       contributes its object file to the link."""
+    trace_cat = "link"
+
+    def __init__(self, verbose, deps, cc, exebase, measure=False, libs=[]):
         self.cc = cc
         self.exebase = exebase
+        self.libs = libs
         self.objs = [dep.output for dep in deps if isinstance(dep, CompileJob)]
+        self.stats = {} if measure else None
         Job.__init__(self, verbose, deps, output=cc.exename(exebase))
 
+    def uptodate(self):
+        if self.stats is not None or self.cc.pgo_stage is not None:
+            return False
+        return Job.uptodate(self)
+
     def run(self):
-        return self.cc.link(self.objs, self.exebase, self.verbose)
+        return self.cc.link(self.objs, self.exebase, self.verbose,
+                            self.stats, self.libs)
 
 
 class RunJob(Job):
     """Job to run a program with arguments."""
+    trace_cat = "run"
+
     def __init__(self, verbose, deps, argv, output=None):
         Job.__init__(self, verbose, deps, output)
         self.argv = argv
@@ -628,7 +1527,7 @@ class RunJob(Job):
         elif self.verbose == 2:
             sys.stderr.write(" ".join(argv) + "\n")
 
-        rv = subprocess.call(argv)
+        rv = self.spawn(argv)
         self.exitcode = rv
         if rv == 0:
             if self.verbose == 1:
@@ -641,45 +1540,710 @@ class RunJob(Job):
                 sys.stderr.write("exit {}\n".format(rv))
         return False
 
+    def spawn(self, argv):
+        """Run the program 'argv' and return its exit status.
+           Subclasses may override this to capture its output."""
+        return subprocess.call(argv)
+
+    def trace_name(self):
+        return "{} {}".format(self.trace_cat, self.argv[0])
+
+    def trace_args(self):
+        args = Job.trace_args(self)
+        args["argv"] = self.argv
+        if hasattr(self, "exitcode"):
+            args["exitcode"] = self.exitcode
+        return args
+
 
 class TestJob(RunJob):
     """Job to run a test program, namely the program generated by the
        first LinkJob in the dependencies. 'args' can be used to specify
-       extra arguments to this program."""
-    def __init__(self, verbose, deps, args=[]):
+       extra arguments to this program.
+
+       If 'shards' is greater than 1, that many copies of the program
+       are run in parallel, each running a different subset of the
+       test blocks (see the --shard option of the generated program),
+       and their reports are merged.  If 'block_times' is true, the
+       time taken by each test block is reported as well.
+
+       If 'alloc_budgets' is true, the program is run in
+       allocation-accounting mode, so that blocks which allocate more
+       memory than their budgets fail; if 'block_allocs' is also true,
+       each block's allocation statistics are reported."""
+    trace_cat = "test"
+
+    def __init__(self, verbose, deps, args=[], shards=1, block_times=False,
+                 alloc_budgets=False, block_allocs=False):
         exe = None
         for dep in deps:
             if isinstance(dep, LinkJob):
                 exe = dep.output
+                self.cc = dep.cc
                 break
         if exe is None:
             raise ValueError("no LinkJob in dependencies")
 
+        args = list(args)
         if verbose >= 2:
             if len(args) >= 1 and args[-1] == "-q":
                 args.pop()
             else:
                 args.append("-v")
-
+        if block_times:
+            args.append("-t")
+        if alloc_budgets:
+            args.append("-a")
+
+        self.shards = shards
+        self.shard_times = None
+        self.block_times = block_times
+        self.alloc_budgets = alloc_budgets
+        self.block_allocs = block_allocs and alloc_budgets
         RunJob.__init__(self, verbose, deps, [os.path.join(".", exe)] + args)
 
+    def spawn(self, argv):
+        n = self.shards
+        if n <= 1 and not self.block_times and not self.alloc_budgets:
+            return RunJob.spawn(self, argv)
+
+        start = time.monotonic()
+        procs = [
+            subprocess.Popen(argv[:1] + ["--shard", "{}/{}".format(i, n)]
+                             + argv[1:],
+                             stdout=subprocess.PIPE, encoding="utf-8")
+            for i in range(n)
+        ]
+
+        def finish(i):
+            out = procs[i].communicate()[0]
+            end = time.monotonic()
+            if Job.trace is not None:
+                Job.trace.add("shard {}/{} {}".format(i, n, argv[0]),
+                              "shard", start, end,
+                              lane="{} shard {}".format(argv[0], i),
+                              exitcode=procs[i].returncode)
+            return out, end - start
+
+        with concurrent.futures.ThreadPoolExecutor(n) as pool:
+            outputs, self.shard_times = zip(*pool.map(finish, range(n)))
+
+        # Split each shard's report into per-block pieces, then put
+        # them back in the order the unsharded program would have
+        # used.  Block J of shard I is block J*N + I overall.
+        times = []
+        allocs = []
+        reports = []
+        for out in outputs:
+            blocks = []
+            for line in out.splitlines(True):
+                if line.startswith("time "):
+                    ms, name = line[5:].rstrip("\n").split(" ", 1)
+                    times.append((float(ms), name))
+                elif line.startswith("allocs "):
+                    mx, mean, nbytes, name = \
+                        line[7:].rstrip("\n").split(" ", 3)
+                    allocs.append((int(mx), float(mean), float(nbytes),
+                                   name))
+                elif line.startswith("test ") or not blocks:
+                    blocks.append(line)
+                else:
+                    blocks[-1] += line
+            reports.append(blocks)
+
+        merged = []
+        for j in range(max(len(blocks) for blocks in reports)):
+            for blocks in reports:
+                if j < len(blocks):
+                    merged.append(blocks[j])
+        sys.stdout.write("".join(merged))
+        sys.stdout.flush()
+
+        if self.block_times:
+            sys.stderr.write("\n")
+            for ms, name in sorted(times, reverse=True):
+                sys.stderr.write("{:10.3f} ms  {}\n".format(ms, name))
+
+        if self.block_allocs:
+            sys.stderr.write("\n   max   mean  bytes/call\n")
+            for mx, mean, nbytes, name in sorted(allocs, reverse=True):
+                sys.stderr.write("{:6d} {:6.2f} {:11.1f}  {}\n"
+                                 .format(mx, mean, nbytes, name))
+
+        for p in procs:
+            if p.returncode != 0:
+                return p.returncode
+        return 0
+
+
+class BenchJob(RunJob):
+    """Job to run the benchmark program generated by 'ljob' (a LinkJob),
+       passing it 'args', 'repeat' times over.  The program's output,
+       which is JSON, is parsed and summarized (see bench_summary)
+       as self.results.  If 'threads' is nonzero, the program is then
+       run once more, with up to that many threads, and the output of
+       its scaling benchmark is added to the results as "scaling"."""
+    trace_cat = "bench"
+
+    def __init__(self, verbose, ljob, args=[], repeat=1, threads=0):
+        self.cc = ljob.cc
+        self.repeat = repeat
+        self.threads = threads
+        self.results = None
+        RunJob.__init__(self, verbose, [ljob],
+                        [os.path.join(".", ljob.output)] + args)
+
+    def spawn(self, argv):
+        runs = []
+        for _ in range(self.repeat):
+            proc = subprocess.run(argv, stdout=subprocess.PIPE,
+                                  encoding="utf-8")
+            if proc.returncode != 0:
+                return proc.returncode
+            runs.append(json.loads(proc.stdout))
+        self.results = bench_summary(runs)
+
+        if self.threads:
+            proc = subprocess.run(argv[:1] + ["--threads", str(self.threads)]
+                                  + argv[1:],
+                                  stdout=subprocess.PIPE, encoding="utf-8")
+            if proc.returncode != 0:
+                return proc.returncode
+            self.results["scaling"] = json.loads(proc.stdout)
+        return 0
+
+
+class TrainJob(RunJob):
+    """Job to run the instrumented program generated by 'ljob' (a
+       LinkJob whose compiler is building the "generate" stage of a
+       profile-guided build), passing it 'args', to collect profile
+       data for the "use" stage.  Any profile data left over from
+       earlier runs is discarded first.  The program's output is
+       discarded."""
+    trace_cat = "train"
+
+    def __init__(self, verbose, ljob, args=[]):
+        self.cc = ljob.cc
+        RunJob.__init__(self, verbose, [ljob],
+                        [os.path.join(".", ljob.output)] + args)
+
+    def run(self):
+        shutil.rmtree(self.cc.pgo_data, ignore_errors=True)
+        os.makedirs(self.cc.pgo_data)
+        return (RunJob.run(self)
+                and self.cc.traits.pgo_merge(self.cc, self.cc.pgo_data,
+                                             self.verbose))
+
+    def spawn(self, argv):
+        return subprocess.call(argv, stdout=subprocess.DEVNULL)
+
+
+class CoverJob(Job):
+    """Job to record which code in fmt.cc each test case reaches, for
+       choosing the cases in the smoke test (see test_fmt_gen.py
+       --smoke).  Runs the test program generated by each LinkJob in
+       'deps', whose fmt.cc must have been compiled for coverage
+       recording, with the -c option, and writes the combined results
+       to 'output' as JSON.
+
+       The results are keyed on a hash of the files named by
+       'sources', and recorded afresh only when that changes or when
+       'refresh' is true: changes to anything else can only make the
+       smoke test weaker, and recording them takes as long as running
+       every test."""
+    trace_cat = "cover"
+
+    def __init__(self, verbose, deps, output, sources, refresh=False):
+        self.sources = sources
+        self.refresh = refresh
+        Job.__init__(self, verbose, deps, output)
+
+    def digest(self):
+        """Return a hash of the contents of the files 'sources'."""
+        h = hashlib.sha256()
+        for fname in self.sources:
+            with open(fname, "rb") as f:
+                h.update(f.read())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def uptodate(self):
+        if self.refresh or self.mtime() == 0:
+            return False
+        try:
+            with open(self.output) as f:
+                return json.load(f).get("sources") == self.digest()
+        except (OSError, ValueError):
+            return False
+
+    def run(self):
+        # Having been refreshed once, the results are up to date until
+        # asked for again (which matters in --watch mode).
+        self.refresh = False
+
+        # Code reached is identified by (program, number) pairs, which
+        # are renumbered consecutively across all programs.
+        ids = {}
+        blocks = {}
+        for prog, ljob in enumerate(dep for dep in self.deps
+                                    if isinstance(dep, LinkJob)):
+            argv = [os.path.join(".", ljob.output), "-q", "-c"]
+            if self.verbose == 1:
+                sys.stderr.write(argv[0] + " -c...")
+            elif self.verbose == 2:
+                sys.stderr.write(" ".join(argv) + "\n")
+            proc = subprocess.run(argv, stdout=subprocess.PIPE,
+                                  encoding="utf-8")
+            # Failing tests do not spoil the coverage data.
+            if proc.returncode < 0:
+                if self.verbose > 0:
+                    sys.stderr.write("signal {}\n".format(-proc.returncode))
+                return False
+            if self.verbose == 1:
+                sys.stderr.write("ok\n")
+
+            for line in proc.stdout.splitlines():
+                if not line.startswith("cover "):
+                    continue
+                index, rest = line[6:].split(" ", 1)
+                index = int(index)
+                if rest.startswith("= "):
+                    prev, name = rest[2:].split(" ", 1)
+                    cases = blocks.setdefault(name, [])
+                    reached = cases[int(prev)][prog]
+                else:
+                    n, rest = rest.split(" ", 1)
+                    fields = rest.split(" ", int(n))
+                    name = fields.pop()
+                    cases = blocks.setdefault(name, [])
+                    reached = frozenset(
+                        ids.setdefault((prog, int(f)), len(ids))
+                        for f in fields)
+                while len(cases) <= index:
+                    cases.append({})
+                cases[index][prog] = reached
+
+        # Only the first of the cases which reach the same code in
+        # every program could be chosen, so leave the rest out.
+        data = {"sources": self.digest(), "blocks": {}}
+        for name, cases in blocks.items():
+            coverage = {}
+            seen = set()
+            for index, reached in enumerate(cases):
+                union = frozenset().union(*reached.values())
+                if union not in seen:
+                    seen.add(union)
+                    coverage[index] = sorted(union)
+            data["blocks"][name] = {"cases": len(cases),
+                                    "coverage": coverage}
+        replace_file(self.output, json.dumps(data) + "\n")
+        return True
+
 
 #
-# In-tree main test driver.
+# Watching for changes to source files.
 #
-def main():
-    verbose = 1
-    args = sys.argv[1:]
-    if len(args) > 0:
-        if args[0] == '-v':
-            verbose += 1
-            args.pop(0)
-        elif args[0] == '-q':
-            verbose -= 1
-            args.pop(0)
-
-    compilers = find_compilers(args, verbose)
+def file_watcher(fnames):
+    """Return an object whose wait() method blocks until at least one
+       of the files 'fnames' has changed, and returns a list of those
+       that have.  Uses inotify if possible, otherwise polls."""
+    try:
+        return InotifyWatcher(fnames)
+    except (OSError, AttributeError):
+        return PollWatcher(fnames)
+
+
+class PollWatcher(object):
+    """Watch for changes to 'fnames' by checking their modification
+       times and sizes every 'interval' seconds."""
+
+    def __init__(self, fnames, interval=0.5):
+        self.fnames = fnames
+        self.interval = interval
+        self.stamps = self.scan()
+
+    def scan(self):
+        stamps = {}
+        for fname in self.fnames:
+            try:
+                st = os.stat(fname)
+                stamps[fname] = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stamps[fname] = None
+        return stamps
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            stamps = self.scan()
+            changed = [f for f in self.fnames
+                       if stamps[f] != self.stamps[f]]
+            self.stamps = stamps
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watch for changes to 'fnames' using Linux's inotify, called
+       through ctypes.  The directories containing the files are
+       watched, rather than the files themselves, so that files which
+       are replaced by renaming (as many editors do) are still
+       noticed.  Once a change is seen, further events are collected
+       until none has arrived for 'settle' seconds, so that an editor
+       saving several files counts as one change."""
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    event_header = "iIII"  # struct inotify_event, less its name
+
+    def __init__(self, fnames, settle=0.1):
+        self.settle = settle
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.names = {}
+        self.wds = {}
+        for fname in fnames:
+            dirname, basename = os.path.split(os.path.abspath(fname))
+            if dirname not in self.wds:
+                wd = libc.inotify_add_watch(
+                    self.fd, os.fsencode(dirname),
+                    self.IN_MODIFY | self.IN_CLOSE_WRITE
+                    | self.IN_MOVED_TO | self.IN_CREATE)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    os.close(self.fd)
+                    raise OSError(err, os.strerror(err), dirname)
+                self.wds[dirname] = wd
+            self.names[(self.wds[dirname], os.fsencode(basename))] = fname
+
+    def read_events(self):
+        changed = set()
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        hdr = struct.calcsize(self.event_header)
+        pos = 0
+        while pos + hdr <= len(buf):
+            wd, _, _, namelen = struct.unpack_from(self.event_header,
+                                                   buf, pos)
+            name = buf[pos + hdr:pos + hdr + namelen].rstrip(b"\0")
+            pos += hdr + namelen
+            fname = self.names.get((wd, name))
+            if fname is not None:
+                changed.add(fname)
+        return changed
+
+    def wait(self):
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            changed |= self.read_events()
+        while select.select([self.fd], [], [], self.settle)[0]:
+            changed |= self.read_events()
+        return sorted(changed)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watched_files(top):
+    """Return the names of all the files which the jobs reachable
+       from 'top' depend on but do not create (see FileDep)."""
+    fnames = set()
+    seen = set()
+    stack = [top]
+    while stack:
+        job = stack.pop()
+        if id(job) in seen:
+            continue
+        seen.add(id(job))
+        if isinstance(job, FileDep):
+            fnames.add(job.output)
+        stack.extend(job.deps)
+    return sorted(fnames)
+
+
+#
+# Benchmark statistics.
+#
+def median_ci(samples, z=1.96):
+    """Return the median of 'samples' and a distribution-free
+       confidence interval for it, as a tuple (median, low, high).
+       The interval is bounded by the order statistics whose ranks
+       lie 'z' standard deviations either side of the middle of the
+       binomial distribution (95% for the default 'z'); with very
+       few samples, it is the full range of the samples."""
+    xs = sorted(samples)
+    n = len(xs)
+    if n % 2:
+        median = xs[n // 2]
+    else:
+        median = (xs[n // 2 - 1] + xs[n // 2]) / 2
+    half = z * math.sqrt(n) / 2
+    lo = max(int(math.floor(n / 2 - half)), 0)
+    hi = min(int(math.ceil(n / 2 + half)), n - 1)
+    return (median, xs[lo], xs[hi])
+
+
+def bench_summary(runs):
+    """Combine the results of several runs of the benchmark program.
+       The result has the same shape as the output of a single run,
+       but each measurement is the median over all runs; the
+       per-run 'ns_per_call' values are kept as 'samples', and the
+       confidence interval for their median as 'ns_per_call_ci'."""
+    summary = {
+        "min_time_ms": runs[0]["min_time_ms"],
+        "runs": len(runs),
+        "families": {}
+    }
+    for name, family in runs[0]["families"].items():
+        out = {"cases": family["cases"]}
+        for impl in family:
+            if impl == "cases":
+                continue
+            m = {}
+            for key in family[impl]:
+                samples = [r["families"][name][impl][key] for r in runs]
+                med, lo, hi = median_ci(samples)
+                m[key] = med
+                if key == "ns_per_call":
+                    m["ns_per_call_ci"] = [lo, hi]
+                    m["samples"] = samples
+            out[impl] = m
+        summary["families"][name] = out
+    return summary
+
+
+# The number of recorded runs whose median is the baseline.
+BENCH_BASELINE_RUNS = 5
+
+def bench_compare(past, current, threshold):
+    """Compare the fmt::format timings in 'current' (a bench_summary)
+       with those in 'past' (a list of bench_summaries, oldest first).
+       The baseline for each family is the median of its timings in
+       the last BENCH_BASELINE_RUNS entries of 'past', so that no one
+       unusually fast or slow run decides the outcome.  Return a list
+       of (family, baseline, current median, current CI) tuples for
+       each family which has become slower by more than 'threshold'
+       (a fraction), even allowing for measurement noise: that is,
+       the lower bound of the current confidence interval must exceed
+       the baseline by more than the threshold."""
+    regressions = []
+    for name, family in sorted(current["families"].items()):
+        olds = [run["families"][name]["fmt"]["ns_per_call"]
+                for run in past if name in run["families"]]
+        if not olds:
+            continue
+        old = median_ci(olds[-BENCH_BASELINE_RUNS:])[0]
+        new = family["fmt"]["ns_per_call"]
+        ci = family["fmt"]["ns_per_call_ci"]
+        if ci[0] > old * (1 + threshold):
+            regressions.append((name, old, new, ci))
+    return regressions
+
+
+def bench_gate(results, histfile, threshold, record, accept, verbose):
+    """Compare each compiler's benchmark 'results' with the recent
+       results recorded in the history file 'histfile' for the same
+       compiler tag (see bench_compare), and report any regressions.
+       If 'record' is true, append these results to the history, but
+       only if there were no regressions, or 'accept' is true: else
+       one slow run would become part of the baseline, and the
+       regression would pass from then on.  Returns True if there
+       were no regressions."""
+    try:
+        with open(histfile) as f:
+            history = json.load(f)
+    except FileNotFoundError:
+        history = {}
+
+    ok = True
+    for tag, current in sorted(results.items()):
+        past = history.get(tag)
+        if not past:
+            if verbose >= 1:
+                sys.stderr.write("{}: no baseline recorded\n".format(tag))
+            continue
+        regressions = bench_compare(past, current, threshold)
+        for name, old, new, ci in regressions:
+            sys.stderr.write("REGRESSION {}: {}: {:.1f} ns/call "
+                             "(95% CI {:.1f}-{:.1f}), was {:.1f} "
+                             "(+{:.1f}%)\n".format(
+                                 tag, name, new, ci[0], ci[1], old,
+                                 (new / old - 1) * 100))
+        if regressions:
+            ok = False
+        elif verbose >= 1:
+            sys.stderr.write("{}: no regressions\n".format(tag))
+
+    if record and not ok and not accept:
+        sys.stderr.write("not recording results with regressions "
+                         "(use --bench-accept to record them anyway)\n")
+    elif record:
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        for tag, current in results.items():
+            history.setdefault(tag, []).append(dict(current, date=stamp))
+        replace_file(histfile,
+                     json.dumps(history, indent=2, sort_keys=True) + "\n")
+    return ok
+
+
+def profile_report(results, profiles):
+    """Print a table comparing the fmt::format timings in 'results'
+       (a dictionary of bench_summary results indexed by compiler tag,
+       each with a 'build' entry naming its profile) across the build
+       'profiles', for each compiler.  Each family's time is given
+       relative to the first profile, followed by the geometric mean
+       of those ratios."""
+    by_cc = {}
+    for tag, result in results.items():
+        profile = result["build"]["profile"]
+        base = tag[:-len(profile) - 1] if profile != "O2" else tag
+        by_cc.setdefault(base, {})[profile] = result
+
+    for base, runs in sorted(by_cc.items()):
+        present = [p for p in profiles if p in runs]
+        if len(present) < 2:
+            continue
+        first = runs[present[0]]["families"]
+        sys.stderr.write("{}: ns/call relative to {}\n"
+                         .format(base, present[0]))
+        sys.stderr.write("  {:<28}".format("family")
+                         + "".join("{:>9}".format(p) for p in present)
+                         + "\n")
+        logs = {p: [] for p in present}
+        for name in sorted(first):
+            ref = first[name]["fmt"]["ns_per_call"]
+            row = "  {:<28}{:>9.1f}".format(name, ref)
+            for p in present[1:]:
+                family = runs[p]["families"].get(name)
+                if family is None or not ref:
+                    row += "{:>9}".format("-")
+                    continue
+                ratio = family["fmt"]["ns_per_call"] / ref
+                logs[p].append(math.log(ratio))
+                row += "{:>9.3f}".format(ratio)
+            sys.stderr.write(row + "\n")
+
+        row = "  {:<28}{:>9}".format("geometric mean", "")
+        for p in present[1:]:
+            if logs[p]:
+                row += "{:>9.3f}".format(math.exp(sum(logs[p])
+                                                  / len(logs[p])))
+            else:
+                row += "{:>9}".format("-")
+        sys.stderr.write(row + "\n")
+
+
+def scaling_report(results):
+    """Print, for each compiler's benchmark 'results' which include a
+       scaling run (see BenchJob), a table of each family's scaling
+       efficiency -- its throughput with N threads, divided by N
+       times its throughput with one -- and its per-call p99 latency
+       with the most threads.  Each family is followed by the
+       efficiency of the probes for the shared state it uses, the
+       least efficient of which is its likeliest bottleneck."""
+    for tag, result in sorted(results.items()):
+        scaling = result.get("scaling")
+        if not scaling:
+            continue
+        families = scaling["families"]
+        counts = [r["threads"] for r in
+                  next(iter(families.values()))["runs"]]
+        probes = {name[len("probe "):]: family["runs"][-1]["efficiency"]
+                  for name, family in families.items()
+                  if name.startswith("probe ")}
+
+        sys.stderr.write("{}: scaling efficiency by threads\n".format(tag))
+        sys.stderr.write("  {:<28}".format("family")
+                         + "".join("{:>7}".format(n) for n in counts)
+                         + "{:>10}\n".format("p99 ns"))
+        for name, family in sorted(families.items()):
+            runs = family["runs"]
+            sys.stderr.write("  {:<28}".format(name)
+                             + "".join("{:>7.2f}".format(r["efficiency"])
+                                       for r in runs)
+                             + "{:>10.0f}\n".format(runs[-1]["p99_ns"]))
+            if name.startswith("probe "):
+                continue
+            uses = sorted((probes[u], u) for u in family["uses"]
+                          if u in probes)
+            if uses:
+                sys.stderr.write("    uses " + ", ".join(
+                    "{} ({:.2f})".format(u, e) for e, u in uses) + "\n")
+
 
+#
+# In-tree main test driver.
+#
+def profile_jobs(verbose, compilers, profiles, objcache, train="bench",
+                 measure=False, time_trace=False):
+    """Construct the jobs that compile fmt.cc with each compiler in
+       each of the build 'profiles'.  Returns a list of compilers, one
+       for each combination (see Compiler.with_profile), and a
+       parallel list of CompileJobs, to which 'measure' and
+       'time_trace' are passed down.  Profile-guided builds are
+       trained by running the instrumented benchmark program if
+       'train' is "bench", or the test program if it is "tests"."""
+    fmtccdep = FileDep("fmt.cc")
+    fmthdep = FileDep("fmt.h")
+    if train == "bench":
+        prog = "bench_fmt"
+        gen = RunJob(verbose, [FileDep("test_fmt_gen.py")],
+                     ["test_fmt_gen.py", "--bench", "bench_fmt.cc"],
+                     output="bench_fmt.cc")
+        args = ["--min-time", "20"]
+    else:
+        prog = "test_fmt"
+        gen = RunJob(verbose, [FileDep("test_fmt_gen.py")],
+                     ["test_fmt_gen.py", "test_fmt.cc"],
+                     output="test_fmt.cc")
+        args = ["-q"]
+
+    pcs = []
+    fmtobjs = []
+    for cc in compilers:
+        for profile in profiles:
+            if profile == "pgo":
+                data = os.path.abspath(
+                    "pgo" + os.path.splitext(cc.otag)[0])
+                gen_cc = cc.with_profile(profile, "generate", data)
+                fmtobj = CompileJob(verbose, [fmtccdep, fmthdep], gen_cc,
+                                    "fmt.cc", objcache)
+                cjob = CompileJob(verbose, [gen, fmthdep], gen_cc,
+                                  prog + ".cc", objcache)
+                ljob = LinkJob(verbose, [cjob, fmtobj], gen_cc, prog)
+                pc = cc.with_profile(profile, "use", data,
+                                     TrainJob(verbose, ljob, args))
+            else:
+                pc = cc.with_profile(profile)
+            pcs.append(pc)
+            fmtobjs.append(CompileJob(verbose, [fmtccdep, fmthdep], pc,
+                                      "fmt.cc", objcache, measure,
+                                      time_trace))
+    return pcs, fmtobjs
+
+
+
+def coverage_job(verbose, compilers, objcache, refresh=False):
+    """Construct the job that records the coverage of fmt.cc by each
+       test case, using each compiler, for the smoke test (see
+       CoverJob).  The test program itself is compiled as usual, and
+       only fmt.cc is compiled for coverage recording.  Header-only
+       profiles are skipped, since their fmt.cc compiles to nothing
+       and the code under test is in the test program."""
     testgen = RunJob(verbose,
                      [FileDep("test_fmt_gen.py")],
                      ["test_fmt_gen.py", "test_fmt.cc"],
@@ -687,23 +2251,306 @@ def main():
     fmtccdep = FileDep("fmt.cc")
     fmthdep = FileDep("fmt.h")
 
+    ljobs = []
+    seen = set()
+    for cc in compilers:
+        flags = cc.opt_flags() or []
+        if cc.etag in seen or "-DCXXFMT_HEADER_ONLY" in flags:
+            continue
+        seen.add(cc.etag)
+        cov = cc.with_profile("cover")
+        # The cover profile replaces the compiler's own, but fmt.cc
+        # must still be built in the same exception mode as the test
+        # program it is linked with.
+        if "-fno-exceptions" in flags:
+            cov.flags = cov.flags + ["-fno-exceptions"]
+        cjob = CompileJob(verbose, [testgen, fmthdep], cc, "test_fmt.cc",
+                          objcache)
+        fmtobj = CompileJob(verbose, [fmtccdep, fmthdep], cov, "fmt.cc",
+                            objcache)
+        ljobs.append(LinkJob(verbose, [cjob, fmtobj], cov, "test_fmt"))
+    return CoverJob(verbose, ljobs, "smoke-coverage.json",
+                    ["fmt.cc", "test_fmt_gen.py"], refresh)
+
+
+def test_jobs(verbose, compilers, fmtobjs, objcache, shards=1,
+              block_times=False, alloc_budgets=True, block_allocs=False,
+              measure=False, time_trace=False, coverjob=None):
+    """Construct the jobs that generate, build, and run the test
+       program for each compiler.  If 'coverjob' is not None, it is a
+       job producing coverage data (see coverage_job), and the smoke
+       test generated from that data is used instead of the full
+       test program.  'measure' and 'time_trace' are passed down to
+       the CompileJobs and LinkJobs (see CompileJob); the remaining
+       arguments are passed down to each TestJob."""
+    if coverjob is None:
+        prog = "test_fmt"
+        testgen = RunJob(verbose,
+                         [FileDep("test_fmt_gen.py")],
+                         ["test_fmt_gen.py", "test_fmt.cc"],
+                         output="test_fmt.cc")
+    else:
+        prog = "test_fmt_smoke"
+        testgen = RunJob(verbose,
+                         [FileDep("test_fmt_gen.py"), coverjob],
+                         ["test_fmt_gen.py", "--smoke", coverjob.output,
+                          "test_fmt_smoke.cc"],
+                         output="test_fmt_smoke.cc")
+    fmthdep = FileDep("fmt.h")
+
     cjobs = [
-        [CompileJob(verbose, [testgen, fmthdep], cc, "test_fmt.cc"),
-         CompileJob(verbose, [fmtccdep, fmthdep], cc, "fmt.cc")]
-        for cc in compilers
+        [CompileJob(verbose, [testgen, fmthdep], cc, prog + ".cc", objcache,
+                    measure, time_trace),
+         fmtobj]
+        for cc, fmtobj in zip(compilers, fmtobjs)
     ]
     ljobs = [
-        LinkJob(verbose, objs, cc, "test_fmt")
+        LinkJob(verbose, objs, cc, prog, measure)
         for (objs, cc) in zip(cjobs, compilers)
     ]
-    tjobs = [
-        TestJob(verbose, [ljob], ["-q"])
+    return [
+        TestJob(verbose, [ljob], ["-q"], shards, block_times,
+                alloc_budgets, block_allocs)
         for ljob in ljobs
     ]
 
-    all = Job(verbose, tjobs)
-    all.execute()
+
+def bench_jobs(verbose, compilers, fmtobjs, objcache, args=[], repeat=1,
+               threads=0):
+    """Construct the jobs that generate, build, and run the benchmark
+       program for each compiler, passing it 'args', 'repeat' times
+       over, and then running its scaling benchmark with up to
+       'threads' threads if that is nonzero."""
+    benchgen = RunJob(verbose,
+                      [FileDep("test_fmt_gen.py")],
+                      ["test_fmt_gen.py", "--bench", "bench_fmt.cc"],
+                      output="bench_fmt.cc")
+    fmthdep = FileDep("fmt.h")
+
+    # Compilers with the same identity build into the same files, so
+    # there is no point benchmarking more than one of them.
+    bjobs = []
+    seen = set()
+    for cc, fmtobj in zip(compilers, fmtobjs):
+        if cc.etag in seen:
+            continue
+        seen.add(cc.etag)
+        cjob = CompileJob(verbose, [benchgen, fmthdep], cc, "bench_fmt.cc",
+                          objcache)
+        ljob = LinkJob(verbose, [cjob, fmtobj], cc, "bench_fmt",
+                       libs=cc.traits.thread_libs())
+        bjobs.append(BenchJob(verbose, ljob, args, repeat, threads))
+    return bjobs
+
+
+def build_stats(jobs):
+    """Collect the statistics recorded by the measured CompileJobs and
+       LinkJobs among the dependencies of 'jobs' (which should have
+       been constructed by test_jobs).  Returns a dictionary indexed
+       by compiler tag and then by output file name."""
+    stats = {}
+    for job in jobs:
+        for ljob in job.deps:
+            if not isinstance(ljob, LinkJob) or ljob.stats is None:
+                continue
+            entry = stats.setdefault(ljob.cc.tag, {})
+            for cjob in ljob.deps:
+                if isinstance(cjob, CompileJob) and cjob.stats:
+                    entry[cjob.src] = cjob.stats
+            if ljob.stats:
+                entry[ljob.output] = ljob.stats
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Compile and test cxxfmt with each of COMPILERS.")
+    ap.add_argument("-v", "--verbose", action="store_const", dest="verbose",
+                    const=2, default=1,
+                    help="print full command lines and error messages")
+    ap.add_argument("-q", "--quiet", action="store_const", dest="verbose",
+                    const=0, help="print nothing but errors")
+    ap.add_argument("-j", "--shards", metavar="N", type=int,
+                    default=os.cpu_count() or 1,
+                    help="split each test program into N shards, run in "
+                    "parallel (default: the number of CPUs)")
+    ap.add_argument("--block-times", action="store_true",
+                    help="report how long each block of tests takes")
+    ap.add_argument("--no-alloc-budgets", dest="alloc_budgets",
+                    action="store_false",
+                    help="don't check the number of allocations made by "
+                    "each test against its budget")
+    ap.add_argument("--block-allocs", action="store_true",
+                    help="report the allocations made by each block of "
+                    "tests")
+    ap.add_argument("--smoke", action="store_true",
+                    help="run only the smoke test: the fewest test cases "
+                    "needed to reach all the code in fmt.cc that the "
+                    "full test program reaches")
+    ap.add_argument("--update-smoke", action="store_true",
+                    help="record which code each test case reaches "
+                    "afresh, then run the smoke test")
+    ap.add_argument("--watch", action="store_true",
+                    help="after running the tests, wait for source files "
+                    "to change, then rebuild what depends on them and "
+                    "run the tests again, until interrupted")
+    ap.add_argument("--bench", metavar="RESULTS",
+                    help="instead of running the tests, build and run the "
+                    "benchmark suite, and write its results to the JSON "
+                    "file RESULTS")
+    ap.add_argument("--bench-repeat", metavar="N", type=int, default=5,
+                    help="run the benchmark program N times and report "
+                    "the median of each measurement (default 5)")
+    ap.add_argument("--bench-min-time", metavar="MS", type=float,
+                    help="time each benchmark family for at least MS "
+                    "milliseconds per run")
+    ap.add_argument("--bench-history", metavar="FILE",
+                    default="bench-history.json",
+                    help="compare benchmark results with the median of "
+                    "the last few results recorded in FILE for each "
+                    "compiler, and fail if any have regressed (default "
+                    "bench-history.json)")
+    ap.add_argument("--bench-threshold", metavar="PCT", type=float,
+                    default=5.0,
+                    help="how much slower than the recorded results a "
+                    "benchmark must be to count as a regression "
+                    "(default 5%%)")
+    ap.add_argument("--bench-record", action="store_true",
+                    help="append the benchmark results to the history "
+                    "file, if there were no regressions")
+    ap.add_argument("--bench-accept", action="store_true",
+                    help="with --bench-record, record the results even "
+                    "if there were regressions, making them part of the "
+                    "baseline")
+    ap.add_argument("--bench-threads", metavar="N", type=int, default=0,
+                    help="also measure how the benchmarks scale when run "
+                    "by up to N threads at once")
+    ap.add_argument("--profiles", metavar="LIST",
+                    help="build with each of a comma-separated LIST of "
+                    "build profiles: " + ", ".join(PROFILES)
+                    + " (default O2,header,noexc for tests, O2 for "
+                    "--bench)")
+    ap.add_argument("--pgo-train", choices=("bench", "tests"),
+                    default="bench",
+                    help="train profile-guided builds with the benchmark "
+                    "program (default) or the test program")
+    ap.add_argument("--build-stats", metavar="FILE",
+                    help="rebuild the test program from scratch, and "
+                    "write the time and memory taken by each compilation, "
+                    "and the size of its output, to the JSON file FILE")
+    ap.add_argument("--time-trace", action="store_true",
+                    help="with --build-stats, also record the compiler's "
+                    "own breakdown of where it spent its time")
+    ap.add_argument("--trace", metavar="FILE",
+                    help="write the start and end times of each step to "
+                    "FILE in Chrome trace-event format, and summarize "
+                    "the critical path through them")
+    ap.add_argument("--reprobe", action="store_true",
+                    help="identify compilers afresh, ignoring the results "
+                    "saved from earlier runs (including failures)")
+    ap.add_argument("compilers", nargs="*",
+                    help="compilers to use (default: as last time, or "
+                    "g++ and clang++)")
+    args = ap.parse_args()
+    verbose = args.verbose
+    if args.profiles is None:
+        args.profiles = "O2" if args.bench else "O2,header,noexc"
+    profiles = args.profiles.split(",")
+    for profile in profiles:
+        if profile not in PROFILES:
+            ap.error("unknown build profile: " + profile)
+    if args.watch and args.bench:
+        ap.error("--watch cannot be used with --bench")
+
+    if args.trace:
+        Job.trace = Trace()
+    start = time.monotonic()
+    cpu = cpu_time()
+    compilers = find_compilers(args.compilers, verbose, Job.trace,
+                               args.reprobe)
+    probe_time = time.monotonic() - start
+    if Job.trace is not None:
+        Job.trace.add("find compilers", "probe", start, start + probe_time,
+                      cpu=round(cpu_time() - cpu, 6))
+    objcache = ObjectCache.default()
+
+    measure = args.build_stats is not None and not args.bench
+    compilers, fmtobjs = profile_jobs(verbose, compilers, profiles,
+                                      objcache, args.pgo_train,
+                                      measure, args.time_trace)
+
+    if args.bench:
+        bargs = []
+        if args.bench_min_time is not None:
+            bargs = ["--min-time", str(args.bench_min_time)]
+        jobs = bench_jobs(verbose, compilers, fmtobjs, objcache, bargs,
+                          args.bench_repeat, args.bench_threads)
+    else:
+        coverjob = None
+        if args.smoke or args.update_smoke:
+            coverjob = coverage_job(verbose, compilers, objcache,
+                                    args.update_smoke)
+        jobs = test_jobs(verbose, compilers, fmtobjs, objcache,
+                         args.shards, args.block_times,
+                         args.alloc_budgets, args.block_allocs,
+                         measure, args.time_trace, coverjob)
+
+    all = Job(verbose, jobs)
+    ok = all.execute()
+    if Job.trace is not None:
+        Job.trace.write(args.trace)
+        trace_summary(all, probe_time)
+
+    # The compilers, and the job graph, are reused for every run, so
+    # only the jobs downstream of the changed files are redone.
+    if args.watch:
+        fnames = watched_files(all)
+        watcher = file_watcher(fnames)
+        try:
+            while True:
+                sys.stderr.write("[{}] {}; watching {}\n".format(
+                    time.strftime("%H:%M:%S"),
+                    "ok" if ok is True else "FAILED",
+                    ", ".join(fnames)))
+                changed = watcher.wait()
+                if verbose >= 1:
+                    sys.stderr.write("changed: {}\n"
+                                     .format(", ".join(changed)))
+                all.reset()
+                ok = all.execute()
+                if Job.trace is not None:
+                    Job.trace.write(args.trace)
+                    trace_summary(all, 0)
+        except KeyboardInterrupt:
+            sys.stderr.write("\n")
+        finally:
+            watcher.close()
+
+    if args.bench:
+        results = {
+            job.cc.tag: dict(job.results, build={
+                "profile": job.cc.profile or "O2",
+                "flags": job.cc.flags + (job.cc.opt_flags() or []),
+            })
+            for job in jobs if job.results is not None
+        }
+        replace_file(args.bench,
+                     json.dumps(results, indent=2, sort_keys=True) + "\n")
+        if verbose >= 1:
+            profile_report(results, profiles)
+            scaling_report(results)
+        if ok is True:
+            ok = bench_gate(results, args.bench_history,
+                            args.bench_threshold / 100, args.bench_record,
+                            args.bench_accept, verbose)
+
+    if measure:
+        replace_file(args.build_stats,
+                     json.dumps(build_stats(jobs), indent=2,
+                                sort_keys=True) + "\n")
+
+    return 0 if ok is True else 1
 
 
 assert __name__ == '__main__'
-main()
+sys.exit(main())
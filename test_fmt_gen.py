@@ -10,12 +10,14 @@
 # and run the result.  The output of that program should be
 # self-explanatory.
 
+import contextlib
 import curses.ascii
 import functools
 import itertools
 import json
 import math
 import re
+import string
 import sys
 import textwrap
 
@@ -42,12 +44,19 @@ def tosymbol(name, _tosymbol_re=re.compile(r"[^A-Za-z0-9_]+")):
 
 @functools.total_ordering
 class TestCaseType(object):
-    """POD structure containing all information required for one subtest."""
+    """POD structure containing all information required for one subtest.
+       'alloc_budget', if not None, is the largest number of memory
+       allocations that a single format() call for a subtest of this
+       type may make, in allocation-accounting mode (see process1_T).
+       Budgets are set to what the library currently needs, so that
+       any regression shows up as a test failure; tighten them as
+       allocations are eliminated."""
     allcasetypes = {}
 
-    def __init__(self, vtypes, caseprinter):
+    def __init__(self, vtypes, caseprinter, alloc_budget=None):
         self.vtypes = vtypes
         self.caseprinter = caseprinter
+        self.alloc_budget = alloc_budget
         self.symbol = tosymbol(caseprinter.__name__)
 
         if self.symbol in self.allcasetypes:
@@ -78,21 +87,22 @@ class TestCaseType(object):
 class caseprint(object):
     """Decorator to facilitate creation of TestCaseTypes from
        case printer functions."""
-    def __init__(self, vtypes):
+    def __init__(self, vtypes, alloc_budget=None):
         if not isinstance(vtypes, tuple):
             self.vtypes = (vtypes,)
         else:
             self.vtypes = vtypes
+        self.alloc_budget = alloc_budget
 
     def __call__(self, fn):
-        return TestCaseType(self.vtypes, fn)
+        return TestCaseType(self.vtypes, fn, self.alloc_budget)
 
 
 # Python string literals can be set off with single quotes, and repr()
 # prefers that form, so it usually doesn't produce a valid C string
 # literal.  But the JSON string literal syntax is the same as the C
 # string literal syntax, so we can use json.dumps() instead.
-@caseprint(())
+@caseprint((), alloc_budget=4)
 def case_a0(spec, output):
     # The spec may contain deliberate syntax errors marked with angle
     # brackets.  They are removed from 'spec', and replaced with VT220
@@ -115,22 +125,22 @@ def case_a1(spec, override_spec, val, cval):
     return json.dumps(spec) + ", " + json.dumps(formatted) + ", " + cval
 
 
-@caseprint('const char*')
+@caseprint('const char*', alloc_budget=2)
 def case_a1_cs(val, spec):
     return case_a1(spec, spec, val, json.dumps(val))
 
 
-@caseprint('int')
+@caseprint('int', alloc_budget=2)
 def case_a1_is(val, spec):
     return case_a1(spec, spec, val, str(val))
 
 
-@caseprint('unsigned int')
+@caseprint('unsigned int', alloc_budget=2)
 def case_a1_iu(val, spec):
     return case_a1(spec, spec, val, str(val))
 
 
-@caseprint('long long')
+@caseprint('long long', alloc_budget=6)
 def case_a1_lls(val, spec):
     # Special case -(2**63), which may trigger "integer constant is so
     # large that it is unsigned" warnings even when properly suffixed.
@@ -141,12 +151,12 @@ def case_a1_lls(val, spec):
     return case_a1(spec, spec, val, sval)
 
 
-@caseprint('unsigned long long')
+@caseprint('unsigned long long', alloc_budget=6)
 def case_a1_llu(val, spec):
     return case_a1(spec, spec, val, str(val)+"LLU")
 
 
-@caseprint('float')
+@caseprint('float', alloc_budget=2)
 def case_a1_f(val, spec):
     ospec = spec
     # Python's no-typecode behavior for floats is not exactly
@@ -156,7 +166,7 @@ def case_a1_f(val, spec):
     return case_a1(spec, ospec, val, str(val))
 
 
-@caseprint('char')
+@caseprint('char', alloc_budget=2)
 def case_a1_c(val, spec):
     # Python has no stock way to print a valid C character literal.
     if len(val) > 1:
@@ -174,6 +184,43 @@ def case_a1_c(val, spec):
     return case_a1(spec, ospec, val, cval)
 
 
+def c_literal(b):
+    """Render the bytes 'b' as a C string literal.  json.dumps() will
+       not do here, because it writes control characters as \\u
+       escapes, which C++ does not accept."""
+    return '"' + "".join(chr(c) if 0x20 <= c < 0x7f and c not in b'"\\?'
+                         else "\\{:03o}".format(c)
+                         for c in b) + '"'
+
+
+_json_spec_re = re.compile(r"\A(?:(?P<fill>.)?(?P<align>[<>=^]))?"
+                           r"(?P<width>[0-9]+)?(?:\.(?P<prec>[0-9]+))?\Z")
+
+
+@caseprint('const char*', alloc_budget=4)
+def case_a1_json(val, spec):
+    # Python has no 'j' type, so the expected output is worked out
+    # here: the string (as UTF-8, truncated to the precision in bytes)
+    # is escaped as by json.dumps, with invalid UTF-8 replaced as by
+    # the 'replace' error handler, and then padded to the width in
+    # bytes.  (Unlike case_a1_cs, the output is often too long for the
+    # small-string buffer, hence the larger allocation budget.)
+    if isinstance(val, str):
+        val = val.encode("utf-8")
+    m = _json_spec_re.match(spec)
+    if m.group("prec") is not None:
+        val = val[:int(m.group("prec"))]
+    esc = (json.dumps(val.decode("utf-8", "replace"), ensure_ascii=False)
+           [1:-1].replace("�", "\\ufffd").encode("utf-8"))
+    pad = max(int(m.group("width") or 0) - len(esc), 0)
+    fill = (m.group("fill") or " ").encode("utf-8")
+    align = m.group("align") or "<"
+    left = pad if align in ">=" else pad // 2 if align == "^" else 0
+    expected = fill * left + esc + fill * (pad - left)
+    return (json.dumps("{:" + spec + "j}") + ", " + c_literal(expected) +
+            ", " + c_literal(val))
+
+
 @caseprint(("const char *", "const char *", "const char *"))
 def case_a3_s_s_s(spec, v1, v2, v3, exp=None):
     if exp is None:
@@ -250,6 +297,7 @@ class TestProcess(object):
         """)
 
     all_process_fns = {}
+    needs_exceptions = False
 
     def __init__(self, name, args, targs, body):
         symbol = tosymbol(name)
@@ -297,8 +345,11 @@ process_generic = TestProcess(
     ("const caseT (&cases)[n]", "bool (*process1)(const caseT&)"),
     ("typename caseT", "size_t n"),
     """\
-  for (const caseT* c = cases; c < cases+n; c++)
+  for (const caseT* c = cases; c < cases+n; c++) {
+    cover_begin();
     success &= process1(*c);
+    cover_end(tag, c - cases);
+  }
 """
 )
 
@@ -306,10 +357,20 @@ process_generic = TestProcess(
 @functools.total_ordering
 class TestBlock(object):
     """One block of tests.  All tests in a block share the same
-       'casetype' and 'process1'."""
+       'casetype' and 'process1'.  The allocation budget for the
+       block is 'alloc_budget' if that is not None, otherwise the
+       casetype's budget.
+
+       In smoke-test mode (see select_cases), every block has its own
+       table of cases, holding only those whose indices are in
+       'selection', or all of them if that is None."""
     allblocks = {}
+    smoke = False
+    selection = None
+    needs_exceptions = False
 
-    def __init__(self, name, casetype, process1, blocksym):
+    def __init__(self, name, casetype, process1, blocksym,
+                 alloc_budget=None):
         if name in self.allblocks:
             raise RuntimeError("duplicate test block name: " + name)
         self.allblocks[name] = self
@@ -323,6 +384,9 @@ class TestBlock(object):
         self.process1 = process1
         self.name = name
         self.blocksym = blocksym
+        if alloc_budget is None:
+            alloc_budget = casetype.alloc_budget
+        self.alloc_budget = alloc_budget
 
     # These are sorted strictly by name because that makes the verbose
     # test-runner output look better.
@@ -332,42 +396,76 @@ class TestBlock(object):
     def __lt__(self, other):
         return self.name < other.name
 
+    def all_cases(self):
+        """Generate all the cases in this block."""
+        return ()
+
+    def require_exceptions(self):
+        self.needs_exceptions = True
+
+    def table_symbol(self):
+        if self.smoke:
+            return "smoke_" + tosymbol(self.name)
+        return self.blocksym
+
     def write_cases(self, outf):
-        pass
+        if self.smoke:
+            self.write_table(outf, (case for i, case
+                                    in enumerate(self.all_cases())
+                                    if self.selection is None
+                                    or i in self.selection))
+
+    def write_table(self, outf, cases):
+        outf.write("const {0} tc_{1}[] = {{\n"
+                   .format(self.casetype.symbol, self.table_symbol()))
+        count = 0
+        for case in cases:
+            self.casetype.write_case(outf, case)
+            count += 1
+        outf.write("}};\n// {} cases\n\n".format(count))
 
-    def write_process_call(self, outf):
+    def write_block_entry(self, outf):
         if self.process1 is None:
             p1sym = "generic"
         else:
             p1sym = self.process1.symbol
-        outf.write('  success &= process("{0}", tc_{1}, process1_{2});\n'
-                   .format(self.name, self.blocksym, p1sym))
+        outf.write('  {{ "{0}", [](const char* tag) {{\n'
+                   '      return process(tag, tc_{1}, process1_{2}); }},\n'
+                   '    {3} }},\n'
+                   .format(self.name, self.table_symbol(), p1sym,
+                           budget_literal(self.alloc_budget)))
 
 
 class GenTB(TestBlock):
     """A block of tests generated from a generator function."""
 
-    def __init__(self, name, casetype, generator):
-        TestBlock.__init__(self, name, casetype, None, tosymbol(name))
+    def __init__(self, name, casetype, generator, alloc_budget=None):
+        TestBlock.__init__(self, name, casetype, None, tosymbol(name),
+                           alloc_budget)
         self.generator = generator
 
+    def all_cases(self):
+        return self.generator()
+
     def write_cases(self, outf):
-        outf.write("const {0} tc_{1}[] = {{\n"
-                   .format(self.casetype.symbol, self.blocksym))
-        count = 0
-        for case in self.generator():
-            self.casetype.write_case(outf, case)
-            count += 1
-        outf.write("}};\n// {} cases\n\n".format(count))
+        if self.smoke:
+            TestBlock.write_cases(self, outf)
+        else:
+            self.write_table(outf, self.generator())
 
 
 class VarTB(TestBlock):
     """A block of tests which reuses an existing block with a different
        'process1' function."""
 
-    def __init__(self, depblock, process1):
+    def __init__(self, depblock, process1, alloc_budget=None):
         TestBlock.__init__(self, depblock.name + " (" + process1.name + ")",
-                           depblock.casetype, process1, depblock.blocksym)
+                           depblock.casetype, process1, depblock.blocksym,
+                           alloc_budget)
+        self.depblock = depblock
+
+    def all_cases(self):
+        return self.depblock.all_cases()
 
 
 class SpecialTB(TestBlock):
@@ -377,16 +475,51 @@ class SpecialTB(TestBlock):
     def __init__(self, name, body):
         TestBlock.__init__(self, name, case_a0, None, tosymbol(name))
         self.processor = TestProcess(name, (), (), body)
+        # Special blocks don't fit case_a0's allocation budget.
+        self.alloc_budget = None
+
+    def write_cases(self, outf):
+        pass
+
+    def require_exceptions(self):
+        TestBlock.require_exceptions(self)
+        self.processor.needs_exceptions = True
+
+    def write_block_entry(self, outf):
+        outf.write('  {{ "{0}", process{1}, {2} }},\n'
+                   .format(self.name, self.processor.symbol,
+                           budget_literal(self.alloc_budget)))
+
+
+def needs_exceptions(block):
+    """Decorator marking a test block which throws exceptions, and so
+       is left out of test programs built without them (see
+       CXXFMT_NO_EXCEPTIONS in fmt.h)."""
+    block.require_exceptions()
+    return block
 
-    def write_process_call(self, outf):
-        outf.write('  success &= process{1}("{0}");\n'
-                   .format(self.name, self.processor.symbol))
 
+@contextlib.contextmanager
+def exceptions_only(outf, needed):
+    """If 'needed', surround whatever is written to 'outf' inside
+       this context with a conditional which leaves it out of
+       programs built without exceptions."""
+    if needed:
+        outf.write("#ifndef CXXFMT_NO_EXCEPTIONS\n")
+    yield
+    if needed:
+        outf.write("#endif\n")
 
-def testgen(casetype, name):
+
+def budget_literal(alloc_budget):
+    """Render an allocation budget for the C++ block table."""
+    return "-1" if alloc_budget is None else str(alloc_budget)
+
+
+def testgen(casetype, name, alloc_budget=None):
     """Decorator to facilitate creation of GenTBs from testcase
        generator functions."""
-    return lambda fn: GenTB(name, casetype, fn)
+    return lambda fn: GenTB(name, casetype, fn, alloc_budget)
 
 
 def special_testgen(name):
@@ -405,6 +538,10 @@ def test_syntax_errors():
         ("no error }}{{{{}}", "no error }{{}"),
         ("absent argument <{}>", "absent argument <[missing]>"),
         ("absent argument <{:}>", "absent argument <[missing]>"),
+        ("absent argument <{4294967296}>", "absent argument <[missing]>"),
+        ("absent argument <{18446744073709551614}>",
+         "absent argument <[missing]>"),
+        "not a number <{99999999999999999999999}>",
         "unbalanced <{>",
         "unbalanced <}>",
         ("unbalanced {{<{>", "unbalanced {<{>"),
@@ -424,6 +561,9 @@ def test_syntax_errors():
         "not a number <{:Z}>",
         "not a number <{:.Z}>",
         "not a number <{:Z.Z}>",
+        "not a number <{:.+1}>",
+        "not a number <{:. 1}>",
+        "not a number <{:.-1}>",
         "trailing junk <{:0.0Z}>",
         "zerofill with alignment <{:=0}>",
         "zerofill with alignment <{:0=0}>",
@@ -445,6 +585,7 @@ def test_syntax_errors():
         ])
 
 
+@needs_exceptions
 @special_testgen("exceptions thrown by conversion methods")
 def test_exceptions_in_conversion():
     obj_template = ("struct {label} {{\n"
@@ -593,6 +734,398 @@ def test_errno():
                      for f in formats)
 
 
+@special_testgen("appending")
+def test_format_append():
+    return r"""
+  string out("prefix:");
+  fmt::format_append(out, " {} {:>5} {m:.0}", 42, "ab");
+  success &= report("format_append", out, "prefix: 42    ab ");
+  fmt::format_append(out, "{:Z}", 1);
+  success &= report("format_append", out,
+                    "prefix: 42    ab \x1b[7m{:Z}\x1b[27m");
+
+  // A string with room to spare is appended to in place.
+  out.clear();
+  out.reserve(100);
+  const char* buf = out.data();
+  for (int i = 0; i < 10; i++)
+    fmt::format_append(out, "{},", i);
+  success &= report("format_append", out, "0,1,2,3,4,5,6,7,8,9,");
+  success &= out.data() == buf;
+
+  // One which has to grow does so geometrically, whatever the
+  // library's reserve() does, so building up a long string piece by
+  // piece is not quadratic.
+  out.clear();
+  out.shrink_to_fit();
+  int moves = 0;
+  for (int i = 0; i < 200; i++) {
+    buf = out.data();
+    fmt::format_append(out, "{},", i);
+    moves += out.data() != buf;
+  }
+  success &= out.size() == 690 && moves <= 8;
+"""
+
+
+@special_testgen("length-delimited format strings")
+def test_format_string():
+    return r"""
+  // Nothing at or past the given length is read, so the same buffer
+  // can be cut short anywhere, even in the middle of a substitution.
+  const char buf[] = "x={:>4} y={}{{}}|{:Z";
+  success &= report("format_string",
+                    format(fmt::format_string(buf, 16), 1, 2),
+                    "x=   1 y=2{}");
+  success &= report("format_string", format({ buf, 9 }, 1, 2), "x=   1 y");
+  success &= report("format_string", format({ buf, 5 }, 1),
+                    "x=\x1b[7m{:>\x1b[27m");
+  success &= report("format_string", format({ buf, 0 }, 1), "");
+  success &= report("format_string", format({ buf + 17, 3 }, 1),
+                    "\x1b[7m{:Z\x1b[27m");
+  success &= fmt::formatted_size({ buf, 9 }, 1, 2) == 8;
+
+  string out("prefix:");
+  fmt::format_append(out, { buf, 7 }, 1);
+  success &= report("format_string", out, "prefix:x=   1");
+
+  // NULs within the length are ordinary characters.
+  success &= format({ "a\0{}\0b", 6 }, 1) == string("a\0" "1\0b", 5);
+"""
+
+
+@special_testgen("joining ranges")
+def test_join():
+    return r"""
+  int ints[] = { 1, 255, -16 };
+  const char* strs[] = { "a", "bb", "ccc" };
+  double dbls[] = { 1.5, 0.25 };
+
+  success &= process1_T("{}", "1,255,-16", fmt::join(ints, ","));
+  success &= process1_T("{:>4x}", "   1,  ff, -10", fmt::join(ints, ","));
+  success &= process1_T("<{:<3}>", "<a  |bb |ccc>", fmt::join(strs, "|"));
+  success &= process1_T("{:.2f}", "1.50 0.25", fmt::join(dbls, " "));
+  success &= process1_T("{0} {0:+}", "1, 255 +1, +255",
+                        fmt::join(ints, ints + 2, ", "));
+  success &= process1_T("[{}] {}", "[] 7", fmt::join(ints, ints, ","), 7);
+  success &= process1_T("{:Z}", "\x1b[7m{:Z}\x1b[27m", fmt::join(ints, ","));
+
+  // Each element goes straight into the output, which only grows
+  // as a string does, rather than once per element.
+  unsigned int many[200];
+  for (unsigned int i = 0; i < 200; i++)
+    many[i] = i;
+  unsigned long allocs = alloc_count;
+  string got = format("{}", fmt::join(many, ","));
+  allocs = alloc_count - allocs;
+  success &= got.size() == 689 && got.compare(0, 8, "0,1,2,3,") == 0;
+  if (allocs > 16) {
+    if (!quiet)
+      cout << "\nFAIL: join made " << allocs << " allocations";
+    success = false;
+  }
+
+  // Nor when each element is padded, which makes room for it first.
+  allocs = alloc_count;
+  got = format("{:>4}", fmt::join(many, many + 150, ","));
+  allocs = alloc_count - allocs;
+  success &= got.size() == 749 && got.compare(0, 10, "   0,   1,") == 0;
+  if (allocs > 16) {
+    if (!quiet)
+      cout << "\nFAIL: padded join made " << allocs << " allocations";
+    success = false;
+  }
+"""
+
+
+@special_testgen("JSON escaping")
+def test_json_special():
+    return r"""
+  // NULs in a std::string are escaped like any other control character.
+  success &= process1_T("{:j}", "a\\u0000b", string("a\0b", 3));
+  success &= process1_T("{:j}", "\x1b[7m5\x1b[27m", 5);
+  const char *strs[] = { "a\"b", "c\\d" };
+  success &= process1_T("[\"{:j}\"]", "[\"a\\\"b\",\"c\\\\d\"]",
+                        fmt::join(strs, "\",\""));
+  success &= process1_T("{:>12j}", "     \\\"x\\\"\\n", "\"x\"\n");
+"""
+
+
+@special_testgen("patterns and catalogs")
+def test_pattern():
+    return r"""
+  fmt::pattern pat("{1} ->{0:>4}{{}}");
+  success &= pat.errors() == 0 && pat.nargs() == 2;
+  success &= report("pattern", format(pat, 1, "a"), "a ->   1{}");
+  success &= report("pattern", format(pat, 1, "a", 3), "a ->   1{}");
+  success &= report("pattern", format(pat, 1),
+                    "\x1b[7m[missing]\x1b[27m ->   1{}");
+  success &= fmt::formatted_size(pat, 1, "a") == 10;
+  success &= fmt::formatted_size(pat, 1) == 27;
+  string out("x:");
+  fmt::format_append(out, pat, 2, "b");
+  success &= report("pattern", out, "x:b ->   2{}");
+
+  errno = ENOENT;
+  success &= report("pattern", format(fmt::pattern("{m}")),
+                    std::strerror(ENOENT));
+
+  fmt::pattern bad("{0} {:Z} } {256}");
+  success &= bad.errors() == 3 && bad.nargs() == 1;
+  success &= report("pattern", format(bad, 1),
+                    "1 \x1b[7m{:Z}\x1b[27m \x1b[7m}\x1b[27m "
+                    "\x1b[7m[missing]\x1b[27m");
+
+  // The literal text stays in the pattern, and is not copied before
+  // being appended to the result.
+  fmt::pattern lit("a long stretch of literal text, {}, and then more");
+  unsigned long allocs = alloc_count;
+  string got = format(lit, 7);
+  allocs = alloc_count - allocs;
+  success &= report("pattern", got,
+                    "a long stretch of literal text, 7, and then more");
+  if (allocs > 3) {
+    if (!quiet)
+      cout << "\nFAIL: pattern made " << allocs << " allocations";
+    success = false;
+  }
+
+  fmt::catalog cat;
+  size_t hello = cat.id("hello");
+  size_t bye = cat.id("bye");
+  success &= cat.id("hello") == hello && hello != bye;
+  success &= report("catalog", cat.format(hello, "x"),
+                    "\x1b[7m[unknown message]\x1b[27m");
+
+  const char en[] =
+    "# English\n\nhello = Hello, {0}!\r\n  bye\t=\tGoodbye, {0} and {1}.\n";
+  success &= cat.load(fmt::format_string(en, sizeof en - 1));
+  success &= report("catalog", cat.format(hello, "world"), "Hello, world!");
+  success &= report("catalog", cat.format(bye, "a", "b"),
+                    "Goodbye, a and b.");
+
+  // IDs are the same across loads, and patterns already fetched
+  // survive them.
+  std::shared_ptr<const fmt::pattern> held = cat.get(hello);
+  const char fr[] = "bye = Au revoir, {1} et {0}.\nhello = Bonjour, {0} !";
+  success &= cat.load(fmt::format_string(fr, sizeof fr - 1));
+  success &= report("catalog", cat.format(hello, "monde"), "Bonjour, monde !");
+  success &= report("catalog", cat.format(bye, "a", "b"), "Au revoir, b et a.");
+  success &= report("catalog", format(*held, "world"), "Hello, world!");
+
+  // Every error is reported, and the contents are left as they were.
+  string errors;
+  const char broken[] =
+    "hello = {0\nno equals sign\n = x\nbye = {0}\nbye = {1}\n";
+  success &= !cat.load(fmt::format_string(broken, sizeof broken - 1),
+                       &errors);
+  success &= report("catalog", errors,
+                    "line 1: malformed template for 'hello'\n"
+                    "line 2: expected 'name = template'\n"
+                    "line 3: expected 'name = template'\n"
+                    "line 5: duplicate message 'bye'\n");
+  success &= report("catalog", cat.format(hello, "monde"), "Bonjour, monde !");
+
+  char path[] = "/tmp/test_fmt_catalogXXXXXX";
+  int fd = mkstemp(path);
+  success &= fd != -1 && write(fd, en, sizeof en - 1) == sizeof en - 1;
+  close(fd);
+  success &= cat.load(path);
+  success &= report("catalog", cat.format(hello, "file"), "Hello, file!");
+  unlink(path);
+  errors.clear();
+  success &= !cat.load(path, &errors);
+  string expected = string(path) + ": " + std::strerror(ENOENT) + "\n";
+  success &= report("catalog", errors, expected.c_str());
+"""
+
+
+@special_testgen("memory resources")
+def test_memory_resource():
+    return r"""
+  // A bump allocator over a fixed buffer, which is never freed.
+  struct arena : fmt::memory_resource {
+    alignas(16) char buf[4096];
+    size_t used = 0;
+    size_t allocs = 0;
+
+    void *allocate(size_t bytes, size_t align) {
+      used = (used + align - 1) & ~(align - 1);
+      if (used + bytes > sizeof buf)
+        std::abort();
+      allocs++;
+      void *p = buf + used;
+      used += bytes;
+      return p;
+    }
+    void deallocate(void *, size_t, size_t) noexcept {}
+  };
+
+  arena a;
+  string long_str("a std::string too long to be stored inline");
+  fmt::pattern pat("[{1}|{0:^7}]");
+
+  // Nothing at all comes from the global heap, including the
+  // formatter's own storage and the result.
+  unsigned long allocs = alloc_count;
+  fmt::pmr_string s =
+    format(a, "{} {:>8.3f} {:#x} {:j} {}", "str", 3.14159, 255, "q\"",
+           long_str);
+  fmt::format_append(s, "; {0}{0}, {1:e}", 42, 1e100);
+  fmt::format_append(s, pat, 1, "pat");
+  fmt::format_append(s, { "; {}!", 4 }, 7);
+  fmt::pmr_string big = format(a, "{:.300f}", 1.0);
+  allocs = alloc_count - allocs;
+
+  success &= report("memory resources", string(s.data(), s.size()),
+                    "str    3.142 0xff q\\\" a std::string too long to be "
+                    "stored inline; 4242, 1.000000e+100[pat|   1   ]; 7");
+  success &= big.size() == 302 && big.compare(0, 4, "1.00") == 0;
+  success &= s.get_allocator().resource() == &a && a.allocs > 0;
+  if (allocs != 0) {
+    if (!quiet)
+      cout << "\nFAIL: " << allocs << " global allocations with an arena";
+    success = false;
+  }
+"""
+
+
+@special_testgen("running out of memory")
+def test_out_of_memory():
+    return r"""
+  // A resource which refuses to have more than 512 bytes outstanding.
+  struct tight : fmt::memory_resource {
+    size_t used = 0;
+
+    void *allocate(size_t bytes, size_t) {
+      if (bytes > 512 - used) {
+#ifdef CXXFMT_NO_EXCEPTIONS
+        return 0;
+#else
+        throw std::bad_alloc();
+#endif
+      }
+      used += bytes;
+      return std::malloc(bytes);
+    }
+    void deallocate(void *p, size_t bytes, size_t) noexcept {
+      used -= bytes;
+      std::free(p);
+    }
+  };
+
+  tight t;
+  string tick("tick");
+  string boom(600, 'x');
+  {
+    // Only the substitution which ran out is lost, if there are
+    // exceptions to say which one it was; otherwise all of it is.
+    fmt::pmr_string s(&t);
+    bool ok = fmt::format_append(s, "{} {}", tick, boom);
+#ifdef CXXFMT_NO_EXCEPTIONS
+    success &= report("out of memory", string(s.data(), s.size()),
+                      "\x1b[7m[out of memory]\x1b[27m");
+#else
+    success &= report("out of memory", string(s.data(), s.size()),
+                      "tick \x1b[7m[out of memory]\x1b[27m");
+#endif
+    success &= !ok;
+
+    // Once the memory is given back, formatting works again.
+    s.clear();
+    ok = fmt::format_append(s, "{} {}", tick, tick);
+    success &= report("after running out", string(s.data(), s.size()),
+                      "tick tick");
+    success &= ok;
+  }
+  // Everything taken from the resource went back to it.
+  success &= t.used == 0;
+
+  string out;
+  success &= fmt::format_append(out, "{} {}", tick, boom);
+"""
+
+
+@special_testgen("deferred formatting")
+def test_deferred():
+    return r"""
+  struct with_str { string str() const { return "str()"; } };
+#ifndef CXXFMT_NO_EXCEPTIONS
+  struct throws { const char* what() const { throw logic_error("boom"); } };
+#else
+  struct throws { const char* what() const { return "boom"; } };
+#endif
+  enum E { A = 7 };
+
+  // A record renders just as format() would have, with errno as it
+  // was when the record was captured.  (Each format call is kept
+  // small enough not to run into the test allocator's size limit.)
+  char rec[256];
+  errno = ENOENT;
+  const char* spec = "{} {:x} {:.2f} {:c} {} {} {:>6} {:8}|{m}";
+  string expected(format(spec, -5, 255u, 3.14159, 'x', "cstr",
+                         string("std::string"), A, (void*)0x10));
+  size_t n = fmt::deferred::capture(rec, sizeof rec, spec, -5, 255u,
+                                    3.14159, 'x', "cstr",
+                                    string("std::string"), A, (void*)0x10);
+  errno = EACCES;
+  success &= n > 0 && n == fmt::deferred::size(rec);
+  success &= report(spec, fmt::deferred::render(rec), expected.c_str());
+
+  spec = "{} {} {}";
+  expected = format(spec, with_str(), logic_error("what()"), throws());
+  n = fmt::deferred::capture(rec, sizeof rec, spec, with_str(),
+                             logic_error("what()"), throws());
+  success &= n > 0 && n == fmt::deferred::size(rec);
+  success &= report(spec, fmt::deferred::render(rec), expected.c_str());
+
+  // So does a range.
+  int ints[] = { 1, 255, -16 };
+  spec = "{:>4x}|{}";
+  expected = format(spec, fmt::join(ints, ","), fmt::join(ints, ints, ","));
+  n = fmt::deferred::capture(rec, sizeof rec, spec, fmt::join(ints, ","),
+                             fmt::join(ints, ints, ","));
+  success &= n > 0 && n == fmt::deferred::size(rec);
+  success &= report(spec, fmt::deferred::render(rec), expected.c_str());
+
+  // Strings with embedded NULs come through whole.
+  n = fmt::deferred::capture(rec, sizeof rec, "<{}>", string("a\0b", 3));
+  success &= n > 0 && fmt::deferred::render(rec) == string("<a\0b>", 5);
+
+  // Records which don't fit are not made.
+  success &= fmt::deferred::capture(rec, 40, "{}", "long string argument")
+             == 0;
+
+  // Records come out of a ring in the order they went in, across
+  // wraparounds, and are refused when it is full.
+  fmt::deferred_ring ring(512);
+  unsigned int lengths[64];
+  unsigned int pushed = 0, popped = 0;
+  string got;
+  for (unsigned int i = 0; i < 40; i++) {
+    for (unsigned int j = 0; j < i % 4; j++) {
+      lengths[pushed] = i;
+      success &= ring.push("record {} {}", pushed++, string(i, '.'));
+    }
+    while (ring.pop(got) && popped < pushed) {
+      success &= report("ring", got,
+                        format("record {} {}", popped,
+                               string(lengths[popped], '.')).c_str());
+      popped++;
+    }
+  }
+  success &= popped == pushed;
+
+  unsigned int filled = 0;
+  while (ring.push("{}", "filler"))
+    filled++;
+  success &= filled > 0;
+  for (; ring.pop(got); filled--)
+    success &= report("ring", got, "filler");
+  success &= filled == 0;
+"""
+
+
 @testgen(case_a1_cs, "formatting strings")
 def test_str():
 
@@ -674,6 +1207,33 @@ test_str_ssstr = VarTB(test_str, TestProcess1(case_a1_cs,
                           ts v0(c.v0);"""))
 
 
+@testgen(case_a1_json, "formatting strings as JSON")
+def test_str_json():
+    # Strings long enough to be scanned a word at a time, with the
+    # characters to be escaped at assorted offsets, and valid and
+    # invalid UTF-8.  (NUL is tested separately.)
+    words = [
+        b'', b'plain', b'plain ASCII, long enough for the fast scan',
+        b'"quoted"', b'back\\slash', b'tab\there', b'line\nbreak\r\n',
+        b'\x01\x1f\x7f', b'bell\x07 and escape\x1b[0m', b'0123456\x08',
+        b'01234567"', b'0123456789abcdef\\', b'\x0c0123456789abcdef',
+        'été 日本 \U0001f600 café',
+        b'bad \xff byte', b'truncated \xe6\x97', b'truncated \xe6\x97 twice \xe6',
+        b'overlong \xc0\xaf and \xe0\x80\xaf', b'surrogate \xed\xa0\x80',
+        b'too high \xf4\x90\x80\x80', b'stray \x80\xbf continuations',
+    ]
+    specs = ['', '.0', '.5', '.11', '20', '<40', '>40', '^40', '*^41',
+             '0>40', '>40.11', '=30']
+    for w in words:
+        for spec in specs:
+            yield (w, spec)
+
+
+test_str_json_stdstr = VarTB(test_str_json,
+                             TestProcess1(case_a1_json, "json std::string",
+                                          "string v0(c.v0);"))
+
+
 @testgen(case_a1_c, "formatting chars")
 def test_char():
     chars = "a!'0\t"
@@ -834,39 +1394,42 @@ test_float_dbl = VarTB(test_float, TestProcess1(case_a1_f,
                                                 "double v0 = c.v0;"))
 
 
-@testgen(case_a1_f, "multiple specs one argument (float)")
+@testgen(case_a1_f, "multiple specs one argument (float)", alloc_budget=9)
 def test_2s1a_float():
     for n in float_test_cases():
         yield (n, "{0:12.6e} {0:<+4f} {0:.6g}")
 
 
-@testgen(case_a1_is, "multiple specs one argument (signed int)")
+@testgen(case_a1_is, "multiple specs one argument (signed int)",
+         alloc_budget=8)
 def test_2s1a_sint():
     for n in integer_test_cases(2**8, True):
         yield (n, "{0:d} {0:o} {0:x}")
 
 
-@testgen(case_a1_iu, "multiple specs one argument (unsigned int)")
+@testgen(case_a1_iu, "multiple specs one argument (unsigned int)",
+         alloc_budget=8)
 def test_2s1a_uint():
     for n in integer_test_cases(2**8, False):
         yield (n, "{0:d} {0:o} {0:x}")
 
 
-@testgen(case_a1_c, "multiple specs one argument (char)")
+@testgen(case_a1_c, "multiple specs one argument (char)", alloc_budget=5)
 def test_2s1a_char():
     for c in "a!'0\t":
         yield (c, "{0:c} {0:o}")
 
 
-@testgen(case_a1_cs, "multiple specs one argument (str)")
+@testgen(case_a1_cs, "multiple specs one argument (str)", alloc_budget=10)
 def test_2s1a_str():
     for c in ["", "i", "of", "sis", "fice", "drisk"]:
         yield (c, "{0:s} {0:<5} {0:>10s} {0:^15}")
 
 
-test_2s1a_stdstr = VarTB(test_2s1a_str, process1_str_stdstr)
+test_2s1a_stdstr = VarTB(test_2s1a_str, process1_str_stdstr, alloc_budget=10)
 
 
+@needs_exceptions
 @testgen(case_a3_s_s_s, "exceptions thrown internally")
 def test_exceptions_internal():
     # We have a custom ::operator new which will throw bad_alloc if it
@@ -906,6 +1469,349 @@ def test_exceptions_internal():
     ]
 
 
+#
+# Benchmarks.
+#
+
+@functools.total_ordering
+class BenchBlock(object):
+    """One family of benchmark cases.  Every case in the family is
+       formatted with fmt::format and, for comparison, with the
+       nearest equivalent snprintf and std::ostringstream operations.
+       'casetype' is the TestCaseType used to declare the cases, and
+       'ctype' is the printf length modifier and conversion class
+       for the argument ('d', 'u', 'lld', 'llu', 'f', 's', or 'm'
+       for strerror(errno), in which case 'casetype' must be case_a0).
+       'generator' yields (value, spec) pairs.  'impl' names the C++
+       functor which takes the place of fmt::format, for families
+       which measure some other entry point (such as fmt::deferred)."""
+    allbenches = {}
+
+    def __init__(self, name, casetype, ctype, generator, shared=None,
+                 impl="fmt_impl"):
+        if name in self.allbenches:
+            raise RuntimeError("duplicate benchmark name: " + name)
+        self.allbenches[name] = self
+
+        if (ctype == 'm') != (casetype is case_a0):
+            raise RuntimeError("benchmark {}: ctype 'm' requires case_a0"
+                               .format(name))
+        self.name = name
+        self.casetype = casetype
+        self.ctype = ctype
+        self.generator = generator
+        self.shared = shared
+        self.impl = impl
+        self.blocksym = tosymbol(name)
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def write_cases(self, outf):
+        cases = list(self.generator())
+        outf.write("const {0} bc_{1}[] = {{\n"
+                   .format(self.casetype.symbol, self.blocksym))
+        for val, spec in cases:
+            if self.ctype == 'm':
+                self.casetype.write_case(outf, (spec, spec))
+            else:
+                self.casetype.write_case(outf, (val, spec))
+        outf.write("};\n")
+        outf.write("const baseline bl_{0}[] = {{\n".format(self.blocksym))
+        for val, spec in cases:
+            outf.write("  " + bench_baseline(spec, self.ctype) + ",\n")
+        outf.write("}};\n// {} cases\n\n".format(len(cases)))
+
+    def write_bench_call(self, outf):
+        outf.write('    bench("{0}", bc_{1}, bl_{1}, {2}());\n'
+                   .format(self.name, self.blocksym, self.impl))
+
+    def write_scale_call(self, outf):
+        if self.shared is not None:
+            outf.write('    scale_family("{0}", "{1}", bc_{2});\n'
+                       .format(self.name,
+                               ", ".join(json.dumps(s)
+                                         for s in self.shared)
+                               .replace('"', '\\"'),
+                               self.blocksym))
+
+
+def benchgen(casetype, ctype, name, shared=None, impl="fmt_impl"):
+    """Decorator to facilitate creation of BenchBlocks from case
+       generator functions.  Families with 'shared' (a tuple naming
+       the shared state they touch: "locale", "strerror", or "alloc")
+       are also run in the multi-threaded scaling benchmark."""
+    return lambda fn: BenchBlock(name, casetype, ctype, fn, shared, impl)
+
+
+_bench_spec_re = re.compile(r"""\A(?:(?P<fill>.)?(?P<align>[<>=^]))?
+                                (?P<sign>[-+ ])?(?P<alt>\#)?(?P<zero>0)?
+                                (?P<width>[0-9]+)?(?:\.(?P<prec>[0-9]+))?
+                                (?P<type>[a-zA-Z])?\Z""", re.VERBOSE)
+
+
+def bench_baseline(spec, ctype):
+    """Translate the format string 'spec' (or a bare format spec, as
+       accepted by case_a1) into the C++ initializer for a 'baseline'
+       structure: an equivalent printf format, and the stream flags,
+       width, precision and fill to apply to a std::ostringstream
+       before each insertion.  Neither printf nor iostreams can
+       center a field or pad with an arbitrary character, so those
+       are approximated by right alignment and the default fill."""
+    if '{' not in spec:
+        spec = '{:' + spec + '}'
+
+    fields = list(string.Formatter().parse(spec))
+    positional = sum(1 for f in fields if f[1] is not None) > 1
+
+    pfmt = ""
+    lit = ""
+    pieces = []
+    for text, field, fspec, _ in fields:
+        lit += text
+        if field is None:
+            continue
+        m = _bench_spec_re.match(fspec)
+        if not m:
+            raise ValueError("cannot translate format spec {!r}"
+                             .format(fspec))
+        align = m.group("align") or ('<' if ctype in ('s', 'm') else '')
+        sign = m.group("sign") or ''
+        width = m.group("width") or ''
+        prec = m.group("prec")
+        conv = m.group("type") or ''
+
+        pflags = ""
+        sflags = ["std::ios::dec"]
+        fill = m.group("fill") or ' '
+        if align == '<':
+            if width:
+                pflags += '-'
+            sflags.append("std::ios::left")
+        elif align == '=':
+            sflags.append("std::ios::internal")
+        else:
+            sflags.append("std::ios::right")
+        if sign in ('+', ' '):
+            pflags += sign
+        if sign == '+':
+            sflags.append("std::ios::showpos")
+        if m.group("alt"):
+            pflags += '#'
+            sflags.append("std::ios::showbase")
+        if m.group("zero") or (align == '=' and fill == '0'):
+            pflags += '0'
+            sflags[1] = "std::ios::internal"
+            fill = '0'
+        if fill not in (' ', '0'):
+            fill = ' '
+
+        if ctype in ('s', 'm'):
+            pconv = 's'
+        elif ctype == 'f':
+            pconv = conv or 'g'
+            if conv in ('e', 'E'):
+                sflags.append("std::ios::scientific")
+            elif conv in ('f', 'F'):
+                sflags.append("std::ios::fixed")
+        else:
+            pconv = conv or 'd'
+            if pconv == 'd' and ctype.endswith('u'):
+                pconv = 'u'
+            if pconv == 'o':
+                sflags[0] = "std::ios::oct"
+            elif pconv in ('x', 'X'):
+                sflags[0] = "std::ios::hex"
+            pconv = ctype[:-1] + pconv
+        if conv in ('E', 'F', 'G', 'X'):
+            sflags.append("std::ios::uppercase")
+
+        pfmt += lit.replace('%', '%%') + "%"
+        if positional:
+            pfmt += "1$"
+        pfmt += pflags + width
+        if prec is not None and ctype in ('f', 's', 'm'):
+            pfmt += "." + prec
+        pfmt += pconv
+
+        pieces.append("{{ {}, {}, {}, {}, {} }}".format(
+            json.dumps(lit),
+            "|".join(sflags),
+            width or "0",
+            prec if prec is not None else "-1",
+            "'0'" if fill == '0' else "' '"))
+        lit = ""
+
+    if len(pieces) > 4:
+        raise ValueError("too many substitutions in {!r}".format(spec))
+    return "{{ {}, {}, {}, {{ {} }} }}".format(
+        json.dumps(pfmt + lit.replace('%', '%%')), json.dumps(lit),
+        len(pieces), ", ".join(pieces))
+
+
+# The families below are chosen to cover each of the major paths
+# through fmt.cc without multiplying out every combination of
+# modifiers, as the tests do: each family is timed as a whole, so it
+# should consist of cases that exercise the same feature.
+
+def bench_int_families(casetype, ctype, tname, limit, any_negative,
+                       shared=None):
+    numbers = [n for n in integer_test_cases(limit, any_negative)
+               if abs(n) in (0, 1, 255, 65535, 2**31-1, 2**63-1)]
+
+    @benchgen(casetype, ctype, tname + " default", shared)
+    def bench_default():
+        for n in numbers:
+            yield (n, '')
+            yield (n, 'd')
+
+    @benchgen(casetype, ctype, tname + " align")
+    def bench_align():
+        for n in numbers:
+            for a in ['<', '>', '^', '=', '*<', '*>', '*^', '*=']:
+                yield (n, a + '12')
+
+    @benchgen(casetype, ctype, tname + " sign")
+    def bench_sign():
+        for n in numbers:
+            for s in ['+', '-', ' ']:
+                yield (n, s)
+                yield (n, s + '12')
+
+    @benchgen(casetype, ctype, tname + " width")
+    def bench_width():
+        for n in numbers:
+            for w in ['1', '6', '12', '24', '06', '012']:
+                yield (n, w)
+
+    @benchgen(casetype, ctype, tname + " base")
+    def bench_base():
+        for n in numbers:
+            for t in ['o', 'x', 'X', '#o', '#x', '#X']:
+                yield (n, t)
+
+
+bench_int_families(case_a1_is, 'd', "int", 2**32, True, ("locale", "alloc"))
+bench_int_families(case_a1_iu, 'u', "unsigned int", 2**32, False)
+bench_int_families(case_a1_lls, 'lld', "long long", 2**64, True)
+bench_int_families(case_a1_llu, 'llu', "unsigned long long", 2**64, False)
+
+
+def bench_float_family(typecode):
+    @benchgen(case_a1_f, 'f', "float " + (typecode or "default"),
+              None if typecode else ("locale", "alloc"))
+    def bench_float():
+        for n in float_test_cases():
+            for p in ['', '12', '.3', '+12.3']:
+                yield (n, p + typecode)
+
+
+for t in ['', 'e', 'f', 'g', 'E', 'F', 'G']:
+    bench_float_family(t)
+
+
+bench_words = ['', 'i', 'sis', 'botanist', 'schizognath',
+               'the quick brown fox jumps over the lazy dog']
+
+
+@benchgen(case_a1_cs, 's', "str default", ("alloc",))
+def bench_str():
+    for w in bench_words:
+        yield (w, '')
+        yield (w, 's')
+
+
+@benchgen(case_a1_cs, 's', "str precision")
+def bench_str_precision():
+    for w in bench_words:
+        for p in ['.0', '.3', '.8', '.20']:
+            yield (w, p)
+
+
+@benchgen(case_a1_json, 's', "str json")
+def bench_str_json():
+    for w in bench_words + ['say "hi"\n', 'tab\tseparated\tvalues']:
+        yield (w, '')
+
+
+@benchgen(case_a1_cs, 's', "str align")
+def bench_str_align():
+    for w in bench_words:
+        for a in ['<12', '>12', '^12', '12.3', '>12.8']:
+            yield (w, a)
+
+
+# Mostly literal text, with a single substitution.
+bench_templates = [
+    "HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+    "Cache-Control: no-cache, no-store, must-revalidate\r\n"
+    "Connection: keep-alive\r\nContent-Length: {}\r\n\r\n",
+    "SELECT id, name, email, created_at FROM users "
+    "WHERE account_id = {} AND deleted_at IS NULL "
+    "ORDER BY created_at DESC LIMIT 50",
+]
+
+
+@benchgen(case_a1_is, 'd', "long literal")
+def bench_long_literal():
+    for t in bench_templates:
+        for n in (0, 65535):
+            yield (n, t)
+
+
+@benchgen(case_a1_is, 'd', "multi int", ("locale", "alloc"))
+def bench_multi_int():
+    for n in integer_test_cases(2**8, True):
+        yield (n, "{0:d} {0:o} {0:x}")
+
+
+@benchgen(case_a1_f, 'f', "multi float")
+def bench_multi_float():
+    for n in float_test_cases():
+        yield (n, "{0:12.6e} {0:<+4f} {0:.6g}")
+
+
+@benchgen(case_a1_cs, 's', "multi str")
+def bench_multi_str():
+    for w in bench_words:
+        yield (w, "{0:s} {0:<5} {0:>10s} {0:^15}")
+
+
+# Deferred formatting: the cost at the call site is capturing the
+# arguments, which is what these measure; the snprintf and
+# ostringstream columns are what formatting them eagerly would cost.
+@benchgen(case_a1_is, 'd', "deferred capture int", impl="capture_impl")
+def bench_deferred_int():
+    for n in integer_test_cases(2**16, True):
+        yield (n, '')
+        yield (n, 'x')
+
+
+@benchgen(case_a1_cs, 's', "deferred capture str", impl="capture_impl")
+def bench_deferred_str():
+    for w in bench_words:
+        yield (w, '')
+        yield (w, '>12')
+
+
+@benchgen(case_a1_cs, 's', "deferred ring push", impl="ring_push_impl")
+def bench_deferred_ring():
+    for w in bench_words:
+        yield (w, '')
+        yield (w, '>12')
+
+
+# Alignment markers would be mangled by case_a0, so use only
+# the default (left) alignment and centering here.
+@benchgen(case_a0, 'm', "errno", ("strerror", "alloc"))
+def bench_errno():
+    for s in ["{m}", "open failed: {m}", "{m:50}", "{m:^50}", "{m:.10}"]:
+        yield (None, s)
+
+
 skeleton_0 = r"""// Tester for cxxfmt.
 
 // Copyright 2012, 2013, 2020 Zachary Weinberg <zackw@panix.com>.
@@ -918,28 +1824,49 @@ skeleton_0 = r"""// Tester for cxxfmt.
 
 #include <fmt.h>
 
+#include <algorithm>
+#include <chrono>
+#include <cerrno>
+#include <cstdint>
+#include <cstdio>
 #include <cstring>
 #include <cstdlib>
 #include <iostream>
 #include <new>
 #include <stdexcept>
 
+#include <unistd.h>
+
 using std::cout;
 using std::exception;
 using std::logic_error;
 using std::flush;
+using std::sscanf;
 using std::strcmp;
+using std::strstr;
 using std::string;
 using fmt::format;
 
-// see test_exceptions_internal
+// see test_exceptions_internal and process1_T
+static unsigned long alloc_count = 0;
+static unsigned long alloc_bytes = 0;
+
+// Without exceptions, allocation failure can only abort, and the
+// blocks which provoke it are left out.
 void *
 operator new(size_t n)
 {
+#ifdef CXXFMT_NO_EXCEPTIONS
+  void* v = std::malloc(n);
+  if (!v) std::abort();
+#else
   if (n > 1152)
     throw std::bad_alloc();
   void* v = std::malloc(n);
   if (!v) throw std::bad_alloc();
+#endif
+  alloc_count++;
+  alloc_bytes += n;
   return v;
 }
 void
@@ -953,9 +1880,119 @@ operator delete(void *p, size_t) noexcept
   std::free(p);
 }
 
+// Coverage recording (see -c).  For this, fmt.cc is compiled with
+// -fsanitize-coverage=trace-pc, which makes the compiler insert a
+// call to __sanitizer_cov_trace_pc into each of its basic blocks.
+// Each distinct caller is given a small number, and the numbers
+// reached by the current test case are collected in cover_case.
+// Fixed-size tables are used so as not to disturb the allocation
+// accounting.
+static const unsigned cover_max = 1 << 15;
+static bool cover_active = false;
+static uintptr_t cover_pcs[cover_max];  // hash table of callers...
+static unsigned cover_nums[cover_max];  // ... and their numbers
+static unsigned cover_npcs = 0;
+static unsigned cover_mark[cover_max];  // last case to reach each number
+static unsigned cover_gen = 0;
+static unsigned cover_case[cover_max];
+static unsigned cover_ncase = 0;
+
+#ifdef __GNUC__
+extern "C" void
+__sanitizer_cov_trace_pc(void)
+{
+  if (!cover_active)
+    return;
+  uintptr_t pc = (uintptr_t)__builtin_return_address(0);
+  unsigned h = (unsigned)((pc * 0x9E3779B97F4A7C15ull) >> 49);
+  while (cover_pcs[h] != pc) {
+    if (cover_pcs[h] == 0) {
+      if (cover_npcs == cover_max / 2) {
+        std::fputs("too many coverage points\n", stderr);
+        std::abort();
+      }
+      cover_pcs[h] = pc;
+      cover_nums[h] = cover_npcs++;
+      break;
+    }
+    h = (h + 1) & (cover_max - 1);
+  }
+  unsigned n = cover_nums[h];
+  if (cover_mark[n] != cover_gen) {
+    cover_mark[n] = cover_gen;
+    cover_case[cover_ncase++] = n;
+  }
+}
+#endif
+
 namespace {
 
 bool quiet = false;
+bool cover_mode = false;
+
+// Cases in the block currently running whose coverage has already
+// been reported, by hash of the set of numbers they reached.
+const unsigned cover_sig_max = 1 << 17;
+uint64_t cover_sigs[cover_sig_max];
+size_t cover_sig_case[cover_sig_max];
+
+void
+cover_block_begin()
+{
+  std::fill(cover_sigs, cover_sigs + cover_sig_max, 0);
+}
+
+void
+cover_begin()
+{
+  if (!cover_mode)
+    return;
+  cover_gen++;
+  cover_ncase = 0;
+  cover_active = true;
+}
+
+// Report the coverage of case INDEX of block TAG.  If an earlier case
+// reached exactly the same code, just say which one.
+void
+cover_end(const char* tag, size_t index)
+{
+  if (!cover_mode)
+    return;
+  cover_active = false;
+  std::sort(cover_case, cover_case + cover_ncase);
+  uint64_t sig = 14695981039346656037ull;
+  for (unsigned i = 0; i < cover_ncase; i++) {
+    sig ^= cover_case[i];
+    sig *= 1099511628211ull;
+  }
+  sig |= 1;
+
+  unsigned h = (unsigned)(sig >> 47);
+  while (cover_sigs[h] != 0 && cover_sigs[h] != sig)
+    h = (h + 1) & (cover_sig_max - 1);
+  if (cover_sigs[h] == sig) {
+    cout << "cover " << index << " = " << cover_sig_case[h]
+         << ' ' << tag << '\n';
+    return;
+  }
+  cover_sigs[h] = sig;
+  cover_sig_case[h] = index;
+  cout << "cover " << index << ' ' << cover_ncase;
+  for (unsigned i = 0; i < cover_ncase; i++)
+    cout << ' ' << cover_case[i];
+  cout << ' ' << tag << '\n';
+}
+
+// Allocations made by format() calls in the block currently running.
+struct alloc_stats
+{
+  unsigned long calls;
+  unsigned long max_allocs;
+  unsigned long total_allocs;
+  unsigned long total_bytes;
+};
+alloc_stats block_allocs;
 
 // Note: Plain arrays of POD structures are used because some
 // compilers are not yet very good at optimizing std::initializer_list,
@@ -1000,7 +2037,28 @@ template <typename... TS>
 static bool
 process1_T(const char *spec, const char *expected, TS&&... vs)
 {
+  unsigned long allocs = alloc_count;
+  unsigned long bytes = alloc_bytes;
   string got(format(spec, vs...));
+  allocs = alloc_count - allocs;
+  bytes = alloc_bytes - bytes;
+
+  block_allocs.calls++;
+  block_allocs.total_allocs += allocs;
+  block_allocs.total_bytes += bytes;
+  if (allocs > block_allocs.max_allocs)
+    block_allocs.max_allocs = allocs;
+
+  // formatted_size must agree with format, unless format ran out of
+  // memory (see test_exceptions_internal), which measuring may not.
+  size_t size = fmt::formatted_size(spec, vs...);
+  if (size != got.size() && !strstr(got.c_str(), "[out of memory]")) {
+    if (!quiet)
+      cout << "\nFAIL: " << spec << ": formatted_size is " << size
+           << ", want " << got.size();
+    return false;
+  }
+
   return report(spec, got, expected);
 }
 
@@ -1009,8 +2067,7 @@ template <typename case_,
 static bool
 process1_generic(const case_& c)
 {
-  string got(format(c.spec));
-  return report(c.spec, got, c.expected);
+  return process1_T(c.spec, c.expected);
 }
 
 template <typename case_,
@@ -1046,55 +2103,738 @@ process1_generic(const case_& c)
 """
 
 skeleton_2 = r"""
+struct test_block
+{
+  const char* name;
+  bool (*run)(const char* tag);
+  long alloc_budget;    // -1: no budget
+};
+
+const test_block blocks[] = {
+"""
+
+skeleton_3 = r"""};
+
+bool
+selected(const char* name, char** filters, int n_filters)
+{
+  if (n_filters == 0)
+    return true;
+  for (int i = 0; i < n_filters; i++)
+    if (strstr(name, filters[i]))
+      return true;
+  return false;
+}
+
 } // anonymous namespace
 
+// Usage: test_fmt [-q|-v] [-t] [-a] [-c] [--list] [--shard I/N] [BLOCK...]
+//
+// Runs every test block whose name contains one of the BLOCKs, or all
+// of them if no BLOCKs are given.  With --shard, the blocks are dealt
+// out round-robin into N shards, and only those in shard I (counting
+// from zero) are run.  -t reports the time taken by each block, and
+// --list lists the blocks that would be run instead of running them.
+//
+// -a turns on allocation accounting: the largest and mean number of
+// allocations, and the mean number of bytes allocated, by each
+// format() call are reported for each block, and a block fails if
+// any call made more allocations than its budget.  The budgets assume
+// short strings do not allocate, so they are not enforced with the
+// old copy-on-write std::string.
+//
+// -c reports which basic blocks of fmt.cc each test case reaches, if
+// fmt.cc was compiled for that (see cover_begin); this is used by
+// runtests.py to choose the cases for the smoke test.
+#if defined __GLIBCXX__ && !_GLIBCXX_USE_CXX11_ABI
+const bool enforce_budgets = false;
+#else
+const bool enforce_budgets = true;
+#endif
+
 int
 main(int argc, char** argv)
 {
-  if (argc > 1 && !strcmp(argv[1], "-q"))
-    quiet = true;
+  bool list = false;
+  bool timing = false;
+  bool accounting = false;
+  unsigned int shard = 0, nshards = 1;
+
+  int i;
+  for (i = 1; i < argc && argv[i][0] == '-'; i++) {
+    if (!strcmp(argv[i], "-q"))
+      quiet = true;
+    else if (!strcmp(argv[i], "-v"))
+      quiet = false;
+    else if (!strcmp(argv[i], "-t"))
+      timing = true;
+    else if (!strcmp(argv[i], "-a"))
+      accounting = true;
+    else if (!strcmp(argv[i], "-c"))
+      cover_mode = true;
+    else if (!strcmp(argv[i], "--list"))
+      list = true;
+    else if (!strcmp(argv[i], "--shard") && i + 1 < argc
+             && sscanf(argv[i+1], "%u/%u", &shard, &nshards) == 2
+             && shard < nshards)
+      i++;
+    else {
+      std::cerr << argv[0] << ": bad argument '" << argv[i] << "'\n";
+      return 2;
+    }
+  }
+
   bool success = true;
+  const size_t nblocks = sizeof blocks / sizeof blocks[0];
+  for (size_t b = shard; b < nblocks; b += nshards) {
+    if (!selected(blocks[b].name, argv + i, argc - i))
+      continue;
+    if (list) {
+      cout << blocks[b].name << '\n';
+      continue;
+    }
+
+    block_allocs = alloc_stats();
+    if (cover_mode)
+      cover_block_begin();
+    std::chrono::steady_clock::time_point start
+      = std::chrono::steady_clock::now();
+    success &= blocks[b].run(blocks[b].name);
+    if (timing)
+      cout << "time "
+           << std::chrono::duration<double, std::milli>(
+                std::chrono::steady_clock::now() - start).count()
+           << ' ' << blocks[b].name << '\n';
+
+    if (accounting && block_allocs.calls > 0) {
+      const alloc_stats& a = block_allocs;
+      cout << "allocs " << a.max_allocs
+           << ' ' << double(a.total_allocs) / a.calls
+           << ' ' << double(a.total_bytes) / a.calls
+           << ' ' << blocks[b].name << '\n';
+      if (enforce_budgets && blocks[b].alloc_budget >= 0
+          && a.max_allocs > (unsigned long)blocks[b].alloc_budget) {
+        success = false;
+        if (!quiet)
+          cout << "FAIL: " << blocks[b].name << ": "
+               << a.max_allocs << " allocations in one call, budget is "
+               << blocks[b].alloc_budget << '\n';
+      }
+    }
+  }
 
+  return success ? 0 : 1;
+}
 """
 
-skeleton_3 = r"""
-  return success ? 0 : 1;
+
+bench_skeleton_0 = r"""// Benchmark for cxxfmt.
+
+// Copyright 2012, 2013, 2020 Zachary Weinberg <zackw@panix.com>.
+// Use, modification, and distribution are subject to the
+// Boost Software License, Version 1.0.  See the file LICENSE
+// or http://www.boost.org/LICENSE_1_0.txt for detailed terms.
+
+// This program was generated by test_fmt_gen.py.  DO NOT EDIT.
+// Edit test_fmt_gen.py instead.
+
+#include <fmt.h>
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <ios>
+#include <iostream>
+#include <new>
+#include <sstream>
+#include <thread>
+#include <vector>
+
+using std::cout;
+using std::string;
+using fmt::format;
+
+// Count every allocation, so we can report allocations per call.
+// The count is per thread, so that counting does not itself become
+// a point of contention in the scaling benchmark.
+static thread_local unsigned long alloc_count = 0;
+
+void *
+operator new(size_t n)
+{
+  alloc_count++;
+  void* v = std::malloc(n ? n : 1);
+  if (!v) {
+#ifdef CXXFMT_NO_EXCEPTIONS
+    std::abort();
+#else
+    throw std::bad_alloc();
+#endif
+  }
+  return v;
+}
+void
+operator delete(void *p) noexcept
+{
+  std::free(p);
 }
+void
+operator delete(void *p, size_t) noexcept
+{
+  std::free(p);
+}
+
+namespace {
+
+// The snprintf and iostreams equivalents of one benchmark case.
+struct piece
+{
+  const char* lit;            // literal text preceding this conversion
+  std::ios::fmtflags flags;
+  int width;
+  int precision;              // -1: none specified
+  char fill;
+};
+
+struct baseline
+{
+  const char* pfmt;           // printf format
+  const char* trail;          // literal text after the last conversion
+  unsigned int npieces;
+  piece pieces[4];
+};
+
 """
 
+bench_skeleton_1 = r"""
+template <typename T>
+class has_v0
+{
+  struct one { char x[1]; };
+  struct two { char x[2]; };
+  template <typename C> static one test(decltype(&C::v0));
+  template <typename C> static two test(...);
+public:
+  enum { value = sizeof(test<T>(0)) == sizeof(char) };
+};
+
+// The argument to format for each case: its 'v0', or strerror(errno)
+// for cases with no arguments (which use {m}).
+template <typename case_>
+static typename std::enable_if<has_v0<case_>::value,
+                               decltype(case_::v0)>::type
+arg_of(const case_& c)
+{
+  return c.v0;
+}
+
+template <typename case_>
+static typename std::enable_if<!has_v0<case_>::value, const char*>::type
+arg_of(const case_&)
+{
+  return std::strerror(errno);
+}
 
-def main():
-    if len(sys.argv) > 1:
-        outf = open(sys.argv[1], "w")
-    else:
-        outf = sys.stdout
+struct fmt_impl
+{
+  template <typename case_>
+  typename std::enable_if<has_v0<case_>::value, size_t>::type
+  operator()(const case_& c, const baseline&) const
+  {
+    return format(c.spec, c.v0).size();
+  }
 
-    with outf:
-        outf.write(skeleton_0)
+  template <typename case_>
+  typename std::enable_if<!has_v0<case_>::value, size_t>::type
+  operator()(const case_& c, const baseline&) const
+  {
+    return format(c.spec).size();
+  }
+};
+
+// Record the call instead of formatting it (see fmt::deferred).
+// The record goes through a volatile pointer; otherwise, capturing
+// the same arguments over and over can be optimized away.
+char capture_buf[512];
+char* volatile capture_to = capture_buf;
 
-        casets = sorted(TestCaseType.allcasetypes.values())
-        for ct in casets:
-            ct.write_decl(outf)
+struct capture_impl
+{
+  template <typename case_>
+  size_t operator()(const case_& c, const baseline&) const
+  {
+    return fmt::deferred::capture(capture_to, sizeof capture_buf,
+                                  c.spec, c.v0);
+  }
+};
+
+// Push the call into a ring.  Nothing pops, so a full ring is
+// replaced with an empty one; that is rare enough not to matter.
+const size_t ring_capacity = 1 << 16;
+alignas(fmt::deferred_ring) char ring_space[sizeof(fmt::deferred_ring)];
+fmt::deferred_ring* ring = 0;
+
+struct ring_push_impl
+{
+  template <typename case_>
+  size_t operator()(const case_& c, const baseline&) const
+  {
+    if (!ring)
+      ring = new (ring_space) fmt::deferred_ring(ring_capacity);
+    if (!ring->push(c.spec, c.v0)) {
+      ring->~deferred_ring();
+      ring = new (ring_space) fmt::deferred_ring(ring_capacity);
+      ring->push(c.spec, c.v0);
+    }
+    return std::strlen(c.spec);
+  }
+};
 
-        blocks = sorted(TestBlock.allblocks.values())
-        for b in blocks:
+// Both baselines produce a std::string, as fmt::format does.
+struct snprintf_impl
+{
+  template <typename case_>
+  size_t operator()(const case_& c, const baseline& b) const
+  {
+    char buf[1024];
+    int n = std::snprintf(buf, sizeof buf, b.pfmt, arg_of(c));
+    return string(buf, n < 0 ? 0 : n).size();
+  }
+};
+
+struct ostringstream_impl
+{
+  template <typename T>
+  static void
+  put(std::ostream& os, const T& v, const piece&)
+  {
+    os << v;
+  }
+
+  static void
+  put(std::ostream& os, const char* v, const piece& p)
+  {
+    if (p.precision < 0)
+      os << v;
+    else {
+      size_t n = 0;
+      while (n < size_t(p.precision) && v[n])
+        n++;
+      os << string(v, n);
+    }
+  }
+
+  template <typename case_>
+  size_t operator()(const case_& c, const baseline& b) const
+  {
+    std::ostringstream os;
+    for (unsigned int i = 0; i < b.npieces; i++) {
+      const piece& p = b.pieces[i];
+      os << p.lit;
+      os.flags(p.flags);
+      os.fill(p.fill);
+      os.precision(p.precision < 0 ? 6 : p.precision);
+      os.width(p.width);
+      put(os, arg_of(c), p);
+    }
+    os << b.trail;
+    return os.str().size();
+  }
+};
+
+struct measurement
+{
+  double ns_per_call;
+  double allocs_per_call;
+  double bytes_per_sec;
+};
+
+double min_time_ns = 50e6;
+char** filters = 0;
+int n_filters = 0;
+volatile size_t sink;
+bool first_family = true;
+
+// Run every case in a family through 'impl' repeatedly, until at
+// least 'min_time_ns' nanoseconds have elapsed.
+template <typename case_, size_t n, typename impl>
+static measurement
+measure(const case_ (&cases)[n], const baseline (&bl)[n], impl fn)
+{
+  using namespace std::chrono;
+  unsigned long iters = 1;
+  for (;;) {
+    size_t bytes = 0;
+    unsigned long allocs_before = alloc_count;
+    steady_clock::time_point start = steady_clock::now();
+    for (unsigned long i = 0; i < iters; i++)
+      for (size_t j = 0; j < n; j++)
+        bytes += fn(cases[j], bl[j]);
+    steady_clock::time_point stop = steady_clock::now();
+    unsigned long allocs = alloc_count - allocs_before;
+    double ns = duration<double, std::nano>(stop - start).count();
+
+    if (ns >= min_time_ns || iters >= (1UL << 30)) {
+      sink = bytes;
+      double calls = double(iters) * n;
+      measurement m = { ns / calls, allocs / calls, bytes / (ns * 1e-9) };
+      return m;
+    }
+    if (ns * 10 < min_time_ns)
+      iters *= 10;
+    else
+      iters = (unsigned long)(iters * 1.1 * min_time_ns / ns) + 1;
+  }
+}
+
+static void
+report(const char* label, const measurement& m, bool last)
+{
+  cout << "      \"" << label << "\": { \"ns_per_call\": " << m.ns_per_call
+       << ", \"allocs_per_call\": " << m.allocs_per_call
+       << ", \"bytes_per_sec\": " << m.bytes_per_sec
+       << (last ? " }\n" : " },\n");
+}
+
+static bool
+selected(const char* name)
+{
+  if (n_filters == 0)
+    return true;
+  for (int i = 0; i < n_filters; i++)
+    if (std::strstr(name, filters[i]))
+      return true;
+  return false;
+}
+
+template <typename case_, size_t n, typename impl>
+static void
+bench(const char* name, const case_ (&cases)[n], const baseline (&bl)[n],
+      impl fn)
+{
+  if (!selected(name))
+    return;
+  errno = ENOENT;
+  measurement f = measure(cases, bl, fn);
+  measurement s = measure(cases, bl, snprintf_impl());
+  measurement o = measure(cases, bl, ostringstream_impl());
+
+  cout << (first_family ? "" : ",\n")
+       << "    \"" << name << "\": {\n"
+       << "      \"cases\": " << n << ",\n";
+  report("fmt", f, false);
+  report("snprintf", s, false);
+  report("ostringstream", o, true);
+  cout << "    }" << std::flush;
+  first_family = false;
+}
+
+// Multi-threaded scaling (see --threads).  Each family is run by 1,
+// 2, 4, ... up to max_threads threads at once, each making calls for
+// at least min_time_ns.  Calls are timed in batches of scale_batch,
+// and latency percentiles are computed from the batch times.
+unsigned int max_threads = 0;
+const unsigned int scale_batch = 8;
+const size_t scale_max_samples = 1 << 16;
+
+struct thread_result
+{
+  unsigned long calls;
+  double seconds;
+  size_t bytes;
+  std::vector<double> samples;  // ns per call, one per batch
+};
+
+template <typename fn>
+static void
+scale_thread(fn body, std::atomic<unsigned int>* ready,
+             unsigned int nthreads, thread_result* r)
+{
+  using namespace std::chrono;
+  r->samples.reserve(scale_max_samples);
+  errno = ENOENT;
+
+  // Start together, so that every call is made under contention.
+  ++*ready;
+  while (ready->load() < nthreads)
+    std::this_thread::yield();
+
+  size_t bytes = 0;
+  unsigned long calls = 0;
+  steady_clock::time_point start = steady_clock::now();
+  steady_clock::time_point stop = start;
+  do {
+    steady_clock::time_point t0 = stop;
+    for (unsigned int i = 0; i < scale_batch; i++)
+      bytes += body(calls + i);
+    stop = steady_clock::now();
+    calls += scale_batch;
+    if (r->samples.size() < scale_max_samples)
+      r->samples.push_back(duration<double, std::nano>(stop - t0).count()
+                           / scale_batch);
+  } while (duration<double, std::nano>(stop - start).count() < min_time_ns);
+
+  r->bytes = bytes;
+  r->calls = calls;
+  r->seconds = duration<double>(stop - start).count();
+}
+
+static double
+percentile(std::vector<double>& v, double p)
+{
+  if (v.empty())
+    return 0;
+  std::vector<double>::iterator k = v.begin() + size_t(p * (v.size() - 1));
+  std::nth_element(v.begin(), k, v.end());
+  return *k;
+}
+
+// Run 'body', which makes one call given a call number, with each
+// number of threads in turn.  'uses' lists the shared state which it
+// touches, as JSON strings.
+template <typename fn>
+static void
+scale(const char* name, const char* uses, fn body)
+{
+  if (!selected(name))
+    return;
+  cout << (first_family ? "" : ",\n")
+       << "    \"" << name << "\": {\n"
+       << "      \"uses\": [" << uses << "],\n"
+       << "      \"runs\": [";
+
+  double base = 0;
+  for (unsigned int n = 1;; n = std::min(n * 2, max_threads)) {
+    std::vector<thread_result> results(n);
+    std::vector<std::thread> threads;
+    std::atomic<unsigned int> ready(0);
+    for (unsigned int t = 0; t < n; t++)
+      threads.push_back(std::thread(scale_thread<fn>, body, &ready, n,
+                                    &results[t]));
+    for (unsigned int t = 0; t < n; t++)
+      threads[t].join();
+
+    // Threads which were not all running at once would overstate the
+    // sum of their rates, so divide by the longest time instead.
+    double calls = 0;
+    double seconds = 0;
+    double worst_p99 = 0;
+    std::vector<double> all;
+    for (unsigned int t = 0; t < n; t++) {
+      calls += results[t].calls;
+      seconds = std::max(seconds, results[t].seconds);
+      sink = results[t].bytes;
+      worst_p99 = std::max(worst_p99, percentile(results[t].samples, 0.99));
+      all.insert(all.end(), results[t].samples.begin(),
+                 results[t].samples.end());
+    }
+    double total = calls / seconds;
+    if (n == 1)
+      base = total;
+
+    cout << (n == 1 ? "\n" : ",\n")
+         << "        { \"threads\": " << n
+         << ", \"calls_per_sec\": " << total
+         << ", \"efficiency\": " << total / (base * n)
+         << ", \"p50_ns\": " << percentile(all, 0.5)
+         << ", \"p90_ns\": " << percentile(all, 0.9)
+         << ", \"p99_ns\": " << percentile(all, 0.99)
+         << ", \"worst_thread_p99_ns\": " << worst_p99 << " }";
+    if (n >= max_threads)
+      break;
+  }
+  cout << "\n      ]\n    }" << std::flush;
+  first_family = false;
+}
+
+const baseline no_baseline = baseline();
+
+template <typename case_, size_t n>
+static void
+scale_family(const char* name, const char* uses, const case_ (&cases)[n])
+{
+  scale(name, uses, [&cases](unsigned long i) -> size_t {
+    return fmt_impl()(cases[i % n], no_baseline);
+  });
+}
+
+// Each of these exercises just one piece of shared state which
+// formatting touches, so that their scaling can be compared with the
+// formatting families'.
+static void
+scale_probes()
+{
+  // Every std::ostringstream (as used by do_numeric_format) copies
+  // the global locale, adjusting its reference count.
+  scale("probe locale", "\"locale\"", [](unsigned long) -> size_t {
+    std::ostringstream os;
+    return os.good();
+  });
+  scale("probe strerror", "\"strerror\"", [](unsigned long) -> size_t {
+    return std::strlen(std::strerror(ENOENT));
+  });
+  // Strings too long for the small-string optimization.
+  scale("probe alloc", "\"alloc\"", [](unsigned long i) -> size_t {
+    return string(32 + i % 64, 'x').size();
+  });
+}
+
+} // anonymous namespace
+
+// Usage: bench_fmt [--min-time MS] [--threads N] [FILTER...]
+// Only families whose names contain one of the FILTERs are run.
+// With --threads, the scaling benchmark is run instead (see scale).
+// Results are written to stdout as JSON.
+int
+main(int argc, char** argv)
+{
+  int i = 1;
+  for (; i + 1 < argc; i += 2) {
+    if (!std::strcmp(argv[i], "--min-time"))
+      min_time_ns = std::atof(argv[i+1]) * 1e6;
+    else if (!std::strcmp(argv[i], "--threads"))
+      max_threads = std::atoi(argv[i+1]);
+    else
+      break;
+  }
+  filters = argv + i;
+  n_filters = argc - i;
+
+  cout.precision(6);
+  cout << "{\n  \"min_time_ms\": " << min_time_ns / 1e6;
+  if (max_threads > 0)
+    cout << ",\n  \"threads\": " << max_threads;
+  cout << ",\n  \"families\": {\n";
+
+  if (max_threads == 0) {
+"""
+
+bench_skeleton_2 = r"""  } else {
+"""
+
+bench_skeleton_3 = r"""    scale_probes();
+  }
+
+  cout << "\n  }\n}\n";
+  return 0;
+}
+"""
+
+
+def set_cover(sets):
+    """Return a small list of keys of 'sets' (a dictionary of sets)
+       whose sets between them contain everything that all of the sets
+       do.  They are chosen greedily: at each step, the set which
+       contains the most elements not yet covered is taken, preferring
+       the lowest key among equals."""
+    uncovered = set().union(*sets.values())
+    keys = sorted(sets)
+    chosen = []
+    while uncovered:
+        best = max(keys, key=lambda k: len(sets[k] & uncovered))
+        chosen.append(best)
+        uncovered -= sets[best]
+    return sorted(chosen)
+
+
+def select_cases(coverage):
+    """Put every test block in smoke-test mode, selecting from each
+       block just enough cases to reach all the code in fmt.cc that
+       the whole block reaches.  'coverage' is the data recorded by
+       runtests.py: for each block, its number of cases and, for each
+       case reaching a distinct set of code, that set.  Blocks for
+       which there is no data, or whose number of cases has changed
+       since the data was recorded, keep all their cases."""
+    TestBlock.smoke = True
+    for block in TestBlock.allblocks.values():
+        data = coverage["blocks"].get(block.name)
+        if data is None:
+            continue
+        if data["cases"] != sum(1 for _ in block.all_cases()):
+            sys.stderr.write("{}: coverage data is out of date\n"
+                             .format(block.name))
+            continue
+        block.selection = set(set_cover({
+            int(i): set(reached) for i, reached in data["coverage"].items()
+        }))
+        if not block.selection:
+            block.selection = {0}
+
+
+def write_tests(outf):
+    outf.write(skeleton_0)
+
+    casets = sorted(TestCaseType.allcasetypes.values())
+    for ct in casets:
+        ct.write_decl(outf)
+
+    blocks = sorted(TestBlock.allblocks.values())
+    for b in blocks:
+        with exceptions_only(outf, b.needs_exceptions):
             b.write_cases(outf)
 
-        outf.write(skeleton_1)
+    outf.write(skeleton_1)
 
-        p1s = sorted(TestProcess1.all_process1_fns.values())
-        for p in p1s:
-            p.write_fn(outf)
+    p1s = sorted(TestProcess1.all_process1_fns.values())
+    for p in p1s:
+        p.write_fn(outf)
 
-        ps = sorted(TestProcess.all_process_fns.values())
-        for p in ps:
+    ps = sorted(TestProcess.all_process_fns.values())
+    for p in ps:
+        with exceptions_only(outf, p.needs_exceptions):
             p.write_fn(outf)
 
-        outf.write(skeleton_2)
-        for b in blocks:
-            b.write_process_call(outf)
+    outf.write(skeleton_2)
+    for b in blocks:
+        with exceptions_only(outf, b.needs_exceptions):
+            b.write_block_entry(outf)
+
+    outf.write(skeleton_3)
+
+
+def write_benchmarks(outf):
+    outf.write(bench_skeleton_0)
 
-        outf.write(skeleton_3)
+    benches = sorted(BenchBlock.allbenches.values())
+    casets = sorted({b.casetype.symbol: b.casetype
+                     for b in benches}.values())
+    for ct in casets:
+        ct.write_decl(outf)
+
+    for b in benches:
+        b.write_cases(outf)
+
+    outf.write(bench_skeleton_1)
+    for b in benches:
+        b.write_bench_call(outf)
+    outf.write(bench_skeleton_2)
+    for b in benches:
+        b.write_scale_call(outf)
+    outf.write(bench_skeleton_3)
+
+
+def main():
+    args = sys.argv[1:]
+    writer = write_tests
+    if len(args) > 0 and args[0] == "--bench":
+        writer = write_benchmarks
+        args.pop(0)
+    elif len(args) > 1 and args[0] == "--smoke":
+        with open(args[1]) as f:
+            select_cases(json.load(f))
+        del args[:2]
+
+    if len(args) > 0:
+        outf = open(args[0], "w")
+    else:
+        outf = sys.stdout
+
+    with outf:
+        writer(outf)
 
 
 assert __name__ == '__main__'